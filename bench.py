@@ -0,0 +1,391 @@
+"""
+Contention benchmarks for transactional saves.
+
+Drives a number of concurrent workers through plain form.save(),
+transactional_save(), TransactionalMixin.tsave() and the transactional
+CreateView and UpdateView, with a configurable proportion of operations
+using a small set of "hot" keys that collide. Prints one JSON object per
+line per mode, so results can be kept and compared over time:
+
+    python bench.py sqlite
+    python bench.py --workers 16 --collision-rate 0.5 postgresql
+
+With no database, runs against each of them in turn (skipping any that
+aren't available). Databases are configured as in runtests.py; sqlite
+uses a file database in WAL mode.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import django
+from django.conf import settings
+
+DATABASES = {
+    'postgresql': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'django_database_constraints',
+        'USER': '',
+        'PASSWORD': '',
+        'HOST': 'localhost',
+        'PORT': '',
+    },
+    'mysql': {
+        'ENGINE': 'django.db.backends.mysql',
+        'NAME': 'test_dummy',
+        'USER': '',
+        'PASSWORD': '',
+        'HOST': 'localhost',
+        'PORT': '',
+    },
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'django_database_constraints_bench.sqlite3'),
+        'TEST': {
+            'NAME': os.path.join(tempfile.gettempdir(), 'test_django_database_constraints_bench.sqlite3'),
+        },
+    },
+}
+
+MODES = ['save', 'transactional_save', 'tsave', 'create_view', 'update_view']
+
+# fresh (non-colliding) keys are allocated from here up, with a separate
+# range per worker process
+FRESH_KEY_BASE = 1000000
+FRESH_KEYS_PER_PROCESS = 1000000000
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('databases', nargs='*', metavar='DATABASE', help=', '.join(sorted(DATABASES.keys())))
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=200, help='per worker, per mode')
+    parser.add_argument('--collision-rate', type=float, default=0.2, help='proportion of operations using a hot key')
+    parser.add_argument('--hot-keys', type=int, default=10)
+    parser.add_argument('--processes', action='store_true', help='use processes rather than threads for workers')
+    parser.add_argument('--retry', action='store_true', help='use a RetryPolicy for contention')
+    parser.add_argument('--advisory-lock', action='store_true', help='take advisory locks on the unique values in tsave and the views')
+    parser.add_argument('--trust-database', action='store_true', help='use trust_database for tsave and the views, so conflicts reach the database')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--output', help='append results to this file rather than printing them')
+    options = parser.parse_args(argv)
+    for db in options.databases:
+        if db not in DATABASES:
+            parser.error("unknown database %s" % db)
+    return options
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+
+def mean(values):
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+
+class Worker(object):
+    """
+    Runs operations for one mode, returning (outcome, latency, saving)
+    triples, where saving is whether the operation got past validation
+    to the save itself (so a conflict there reached the database).
+    """
+
+    def __init__(self, options, mode, index):
+        from django.test.client import RequestFactory
+        from django_database_constraints.retry import RetryPolicy
+
+        self.options = options
+        self.mode = mode
+        self.index = index
+        self.random = random.Random(index)
+        self.factory = RequestFactory()
+        self.retry = RetryPolicy() if options.retry else None
+        self.fresh_keys = itertools.count(
+            FRESH_KEY_BASE + FRESH_KEYS_PER_PROCESS * index
+        )
+        self.saving = False
+
+    def key(self):
+        if self.random.random() < self.options.collision_rate:
+            return self.random.randrange(self.options.hot_keys)
+        return next(self.fresh_keys)
+
+    def run(self, operations):
+        from django.db import connection
+
+        run_one = getattr(self, 'run_%s' % self.mode)
+        if self.mode == 'update_view':
+            self.setup_update_view()
+        results = []
+        try:
+            for _ in range(operations):
+                key = self.key()
+                self.saving = False
+                started = time.time()
+                try:
+                    outcome = run_one(key)
+                except Exception:
+                    outcome = 'error'
+                results.append((outcome, time.time() - started, self.saving))
+        finally:
+            connection.close()
+        return results
+
+    def run_save(self, key):
+        # the baseline: Django's own validation, then an unprotected save
+        from django.db import IntegrityError
+        from django_database_constraints.tests import TestForm
+
+        form = TestForm({'unique': key})
+        if not form.is_valid():
+            return 'conflict'
+        self.saving = True
+        try:
+            form.save()
+        except IntegrityError:
+            return 'conflict'
+        return 'committed'
+
+    def run_transactional_save(self, key):
+        import django.forms
+        from django_database_constraints.forms import transactional_save
+        from django_database_constraints.tests import TestForm
+
+        form = TestForm({'unique': key})
+        if not form.is_valid():
+            return 'conflict'
+        self.saving = True
+        try:
+            transactional_save(form, retry=self.retry)
+        except django.forms.ValidationError:
+            return 'conflict'
+        return 'committed'
+
+    def run_tsave(self, key):
+        import django.forms
+        from django_database_constraints.tests import TransactionalTestForm
+
+        form = TransactionalTestForm({'unique': key})
+        form.trust_database = self.options.trust_database
+        if not form.is_valid():
+            return 'conflict'
+        self.saving = True
+        try:
+            form.tsave(retry=self.retry, advisory_lock=self.options.advisory_lock)
+        except django.forms.ValidationError:
+            return 'conflict'
+        return 'committed'
+
+    def get_view(self, view_class):
+        from django_database_constraints.tests import TestForm
+        from testapp.models import TestModel
+
+        worker = self
+
+        class BenchView(view_class):
+            model = TestModel
+            form_class = TestForm
+            success_url = '/'
+            tsave_retry = self.retry
+            trust_database = self.options.trust_database
+            tsave_advisory_lock = self.options.advisory_lock
+
+            def save_form(self, form, convertors):
+                worker.saving = True
+                return super(BenchView, self).save_form(form, convertors)
+        return BenchView.as_view()
+
+    def run_create_view(self, key):
+        from django_database_constraints.views import CreateView
+
+        if not hasattr(self, 'create_view'):
+            self.create_view = self.get_view(CreateView)
+        response = self.create_view(self.factory.post('/', {'unique': str(key)}))
+        return 'committed' if response.status_code == 302 else 'conflict'
+
+    def setup_update_view(self):
+        from testapp.models import TestModel
+        from django_database_constraints.views import UpdateView
+
+        self.update_view = self.get_view(UpdateView)
+        self.object = TestModel.objects.create(unique=next(self.fresh_keys))
+
+    def run_update_view(self, key):
+        response = self.update_view(self.factory.post('/', {'unique': str(key)}), pk=self.object.pk)
+        return 'committed' if response.status_code == 302 else 'conflict'
+
+
+def _run_worker(args):
+    options, mode, index = args
+    return Worker(options, mode, index).run(options.operations)
+
+
+def _close_connections():
+    # workers mustn't share the parent's connections
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+
+def run_mode(options, db, mode):
+    from django.db import connection
+    from django_database_constraints.metrics import StatsCollector
+    from testapp.models import TestModel
+
+    TestModel.objects.all().delete()
+    # the hot keys start out free, so each is inserted once and then
+    # collides from then on
+    collector = StatsCollector().connect()
+    jobs = [(options, mode, i) for i in range(options.workers)]
+    started = time.time()
+    if options.processes:
+        _close_connections()
+        pool = multiprocessing.Pool(options.workers, initializer=_close_connections)
+        try:
+            per_worker = pool.map(_run_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        per_worker = [None] * len(jobs)
+
+        def run(i):
+            per_worker[i] = _run_worker(jobs[i])
+        threads = [threading.Thread(target=run, args=[i]) for i in range(len(jobs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.time() - started
+    collector.disconnect()
+
+    results = [r for worker in per_worker for r in worker]
+    latencies = sorted(latency for outcome, latency, saving in results)
+    by_outcome = {}
+    for outcome, latency, saving in results:
+        by_outcome.setdefault(outcome, []).append(latency)
+    committed = mean(by_outcome.get('committed', []))
+    conflict = mean(by_outcome.get('conflict', []))
+    # conflicts caught by validation never open a transaction, so are
+    # cheaper than a commit; only those from the save itself tell us
+    # what a failed statement and rollback cost
+    saving_conflicts = [
+        latency for outcome, latency, saving in results
+        if outcome == 'conflict' and saving
+    ]
+    saving_conflict = mean(saving_conflicts)
+    return {
+        'database': db,
+        'vendor': connection.vendor,
+        'mode': mode,
+        'workers': options.workers,
+        'processes': options.processes,
+        'retry': options.retry,
+        'trust_database': options.trust_database,
+        'advisory_lock': options.advisory_lock,
+        'collision_rate': options.collision_rate,
+        'hot_keys': options.hot_keys,
+        'operations': len(results),
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'outcomes': dict((outcome, len(l)) for outcome, l in by_outcome.items()),
+        'conflict_rate': len(by_outcome.get('conflict', [])) / float(len(results)) if results else None,
+        'latency_committed_mean': committed,
+        'latency_conflict_mean': conflict,
+        'conflicts_saving': len(saving_conflicts),
+        'latency_conflict_saving_mean': saving_conflict,
+        # how much more a conflict from the save itself costs than a
+        # successful save: mostly the failed statement and the rollback
+        'rollback_cost': (
+            saving_conflict - committed
+            if committed is not None and saving_conflict is not None else None
+        ),
+        # not available in process mode, since signals stay in the worker
+        'saves': collector.snapshot()['saves'] if not options.processes else None,
+    }
+
+
+def run_against(options, db):
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='django_database_constraints',
+        # as for runtests.py, since we use the test models
+        INSTALLED_APPS=[
+            'django.contrib.admin',
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.messages',
+            'django.contrib.sessions',
+            'django_database_constraints',
+            # the models for the tests
+            'testapp',
+        ],
+        DATABASES={
+            'default': DATABASES[db],
+        },
+        TEMPLATES=[
+            {
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'DIRS': [],
+                'APP_DIRS': True,
+                'OPTIONS': {
+                    'context_processors': [],
+                },
+            },
+        ],
+    )
+    django.setup()
+
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+
+    def wal(sender, connection, **kwargs):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA busy_timeout=5000')
+    connection_created.connect(wal)
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        for mode in options.modes:
+            result = run_mode(options, db, mode)
+            line = json.dumps(result, sort_keys=True)
+            if options.output:
+                with open(options.output, 'a') as f:
+                    f.write(line + '\n')
+            else:
+                print(line)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    if len(options.databases) == 1:
+        run_against(options, options.databases[0])
+    else:
+        # as with runtests.py, one database per process
+        failures = 0
+        for db in options.databases or sorted(DATABASES.keys()):
+            rc = subprocess.call([sys.executable, sys.argv[0], db] + [
+                a for a in sys.argv[1:] if a not in DATABASES
+            ])
+            if rc != 0:
+                sys.stderr.write("Benchmark against %s failed (is it available?)\n" % db)
+                failures += 1
+        sys.exit(1 if failures == len(options.databases or DATABASES) else 0)
@@ -0,0 +1,255 @@
+"""
+Transactional saves in the admin.
+
+The admin saves in ModelAdmin.save_model() and save_formset(), long
+after validation, so an IntegrityError there is a 500. We save through
+transactional_save() and transactional_formset_save() instead. To show
+the resulting errors we can't just carry on, since the admin has already
+decided the form is valid; so we roll back and run the view again, with
+the errors added to the forms as they're validated.
+
+Changelist (list_editable) edits are run in one transaction, with the
+rows written by a single bulk_update at the end rather than a save per
+row.
+"""
+from django import forms
+from django.contrib import admin, messages
+from django.db import router, transaction, IntegrityError
+from django.http import HttpResponseRedirect
+from django.utils.translation import gettext_lazy as _
+
+from .forms import add_validationerror_to_form, transactional_save, validationerror_from_integrityerror
+from .formsets import UPDATE, Row, bisect_failures, transactional_formset_save, updated_fields
+
+
+# request attributes, since a ModelAdmin is shared between requests
+ERRORS_ATTR = '_database_constraints_errors'
+PENDING_ATTR = '_database_constraints_pending'
+MESSAGES_ATTR = '_database_constraints_messages'
+
+ACTION_FAILED_MESSAGE = _('The action could not be completed: %(error)s')
+
+
+class _SaveFailed(Exception):
+    def __init__(self, errors):
+        super(_SaveFailed, self).__init__()
+        # form (or formset) prefix -> errors to add when it's validated
+        # again; the ModelForm's prefix is None
+        self.errors = errors
+
+
+def _form_errors(form):
+    return forms.ValidationError(dict(
+        (field, list(message_list)) for field, message_list in form.errors.items()
+    ))
+
+
+def _add_saved_errors(form, error):
+    # validating again can find the problem for itself (a conflicting
+    # row committed since we first validated is there to see now), so
+    # only add the messages the form doesn't already have
+    new_errors = {}
+    for field, messages in error.update_error_dict({}).items():
+        if field in form.fields:
+            existing = form.errors.get(field, ())
+        else:
+            existing = form.errors.get(forms.forms.NON_FIELD_ERRORS, ())
+        messages = [m for m in forms.ValidationError(messages).messages if m not in existing]
+        if messages:
+            new_errors[field] = messages
+    if new_errors:
+        add_validationerror_to_form(form, forms.ValidationError(new_errors))
+
+
+def _with_errors(form_class, errors):
+    class FormWithErrors(form_class):
+        def full_clean(self):
+            super(FormWithErrors, self).full_clean()
+            if self.is_bound and self.prefix in errors:
+                _add_saved_errors(self, errors[self.prefix])
+    FormWithErrors.__name__ = form_class.__name__
+    return FormWithErrors
+
+
+def _formset_with_errors(formset_class, errors):
+    class FormSetWithErrors(formset_class):
+        form = _with_errors(formset_class.form, errors)
+
+        def full_clean(self):
+            super(FormSetWithErrors, self).full_clean()
+            if self.is_bound:
+                for message in errors.get(self.prefix, ()):
+                    if message not in self._non_form_errors:
+                        self._non_form_errors.append(message)
+    FormSetWithErrors.__name__ = formset_class.__name__
+    return FormSetWithErrors
+
+
+class TransactionalModelAdminMixin(object):
+    # rows per UPDATE for changelist edits
+    tsave_batch_size = None
+
+    def validationerror_from_integrityerror(self, ierror):
+        # as for TransactionalModelFormMixin
+        return None
+
+    def get_convertors(self):
+        return [ lambda i: self.validationerror_from_integrityerror(i) ]
+
+    def get_form(self, request, *args, **kwargs):
+        form_class = super(TransactionalModelAdminMixin, self).get_form(request, *args, **kwargs)
+        errors = getattr(request, ERRORS_ATTR, None)
+        if errors is not None:
+            form_class = _with_errors(form_class, errors)
+        return form_class
+
+    def get_formsets_with_inlines(self, request, *args, **kwargs):
+        errors = getattr(request, ERRORS_ATTR, None)
+        for formset_class, inline in super(TransactionalModelAdminMixin, self).get_formsets_with_inlines(request, *args, **kwargs):
+            if errors is not None:
+                formset_class = _formset_with_errors(formset_class, errors)
+            yield formset_class, inline
+
+    def get_changelist_formset(self, request, **kwargs):
+        formset_class = super(TransactionalModelAdminMixin, self).get_changelist_formset(request, **kwargs)
+        errors = getattr(request, ERRORS_ATTR, None)
+        if errors is not None:
+            formset_class = _formset_with_errors(formset_class, errors)
+        return formset_class
+
+    def save_model(self, request, obj, form, change):
+        pending = getattr(request, PENDING_ATTR, None)
+        if pending is not None:
+            # a changelist edit; written with the rest by changelist_view()
+            pending.append(Row(form, obj, UPDATE, updated_fields(obj._meta, form.changed_data)))
+            return
+        # the admin's own transaction will be rolled back on failure, so
+        # we don't need a savepoint
+        try:
+            transactional_save(
+                form, self.get_convertors(), savepoint=False,
+                save=lambda: super(TransactionalModelAdminMixin, self).save_model(request, obj, form, change),
+            )
+        except forms.ValidationError:
+            raise _SaveFailed({ form.prefix: _form_errors(form) })
+
+    def save_formset(self, request, form, formset, change):
+        try:
+            transactional_formset_save(formset, self.get_convertors(), savepoint=False)
+        except forms.ValidationError:
+            errors = dict(
+                (f.prefix, _form_errors(f)) for f in formset.forms if f.errors
+            )
+            errors[formset.prefix] = list(formset.non_form_errors())
+            raise _SaveFailed(errors)
+
+    def changeform_view(self, request, *args, **kwargs):
+        try:
+            return super(TransactionalModelAdminMixin, self).changeform_view(request, *args, **kwargs)
+        except _SaveFailed as e:
+            # everything has been rolled back; show the form again
+            setattr(request, ERRORS_ATTR, e.errors)
+            return super(TransactionalModelAdminMixin, self).changeform_view(request, *args, **kwargs)
+
+    def changelist_view(self, request, *args, **kwargs):
+        if not (request.method == 'POST' and self.list_editable and '_save' in request.POST):
+            return super(TransactionalModelAdminMixin, self).changelist_view(request, *args, **kwargs)
+        setattr(request, PENDING_ATTR, [])
+        setattr(request, MESSAGES_ATTR, [])
+        errors = None
+        try:
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                response = super(TransactionalModelAdminMixin, self).changelist_view(request, *args, **kwargs)
+                self.save_changelist_rows(request, getattr(request, PENDING_ATTR))
+        except _SaveFailed as e:
+            errors = e.errors
+        finally:
+            delattr(request, PENDING_ATTR)
+            deferred = getattr(request, MESSAGES_ATTR)
+            delattr(request, MESSAGES_ATTR)
+        if errors is not None:
+            # everything has been rolled back; show the changelist again
+            setattr(request, ERRORS_ATTR, errors)
+            return super(TransactionalModelAdminMixin, self).changelist_view(request, *args, **kwargs)
+        # only now do we know the changes were saved
+        for message_args, message_kwargs in deferred:
+            self.message_user(request, *message_args, **message_kwargs)
+        return response
+
+    def save_changelist_rows(self, request, rows):
+        """Write the rows changed in the changelist, all at once."""
+        if not rows:
+            return
+        using = router.db_for_write(self.model)
+        failures = bisect_failures(rows, using, self.tsave_batch_size)
+        if failures:
+            errors = {}
+            for row, ierror in failures:
+                v = validationerror_from_integrityerror(ierror, self.get_convertors(), row.instance, using)
+                add_validationerror_to_form(row.form, v)
+                errors[row.form.prefix] = _form_errors(row.form)
+            raise _SaveFailed(errors)
+
+    def message_user(self, request, *args, **kwargs):
+        deferred = getattr(request, MESSAGES_ATTR, None)
+        if deferred is not None:
+            deferred.append((args, kwargs))
+            return
+        return super(TransactionalModelAdminMixin, self).message_user(request, *args, **kwargs)
+
+    def response_action(self, request, *args, **kwargs):
+        # run bulk actions in one transaction, and report a constraint
+        # violation rather than a 500
+        try:
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                return super(TransactionalModelAdminMixin, self).response_action(request, *args, **kwargs)
+        except IntegrityError as e:
+            v = validationerror_from_integrityerror(e, self.get_convertors())
+            self.message_user(
+                request,
+                ACTION_FAILED_MESSAGE % { 'error': ' '.join(v.messages) },
+                messages.ERROR,
+            )
+            return HttpResponseRedirect(request.get_full_path())
+
+
+class ModelAdmin(TransactionalModelAdminMixin, admin.ModelAdmin):
+    pass
+
+
+_transactional_admin_classes = {}
+
+
+def transactional_admin_class(admin_class):
+    """admin_class, with TransactionalModelAdminMixin."""
+    if issubclass(admin_class, TransactionalModelAdminMixin):
+        return admin_class
+    transactional = _transactional_admin_classes.get(admin_class)
+    if transactional is None:
+        transactional = _transactional_admin_classes[admin_class] = type(
+            admin_class.__name__, (TransactionalModelAdminMixin, admin_class), {
+                '__module__': admin_class.__module__,
+            },
+        )
+    return transactional
+
+
+def patch_admin(site=None):
+    """
+    Make every ModelAdmin on site (by default the admin's own site)
+    transactional, including any registered later.
+    """
+    if site is None:
+        site = admin.site
+    for model_admin in list(site._registry.values()):
+        model_admin.__class__ = transactional_admin_class(type(model_admin))
+    if getattr(site, '_database_constraints_patched', False):
+        return
+    register = site.register
+
+    def patched_register(model_or_iterable, admin_class=None, **options):
+        if admin_class is None:
+            admin_class = admin.ModelAdmin
+        return register(model_or_iterable, transactional_admin_class(admin_class), **options)
+    site.register = patched_register
+    site._database_constraints_patched = True
@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class DatabaseConstraintsConfig(AppConfig):
+    name = 'django_database_constraints'
+    verbose_name = 'Database constraints'
+    # what migrations/0001_initial.py has, whatever DEFAULT_AUTO_FIELD says
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from . import constraints
+        # the index itself is built on first use
+        constraints.connect_signals()
+        if getattr(settings, 'DATABASE_CONSTRAINTS_PATCH_ADMIN', False):
+            from .admin import patch_admin
+            patch_admin()
@@ -0,0 +1,124 @@
+"""
+Async versions of transactional_save() and the transactional views.
+
+Django's database layer is synchronous, and a transaction has to stay on
+the thread (and so the connection) that opened it. Rather than
+serialising everything on asgiref's single thread-sensitive executor, we
+run each transactional save, from start to commit, on a thread of our
+own pool. Each of those threads has its own connection, so as many saves
+can be in flight at once as the pool has threads, and the event loop
+only awaits the result.
+
+This needs Python 3.5 or later, so it isn't imported by the rest of the
+package.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import close_old_connections
+
+from .forms import transactional_save
+from .views import CreateView, UpdateView
+
+
+# threads in the executor, and so also the most database connections it
+# will hold open at once
+DEFAULT_WORKERS = 8
+
+_executor = None
+
+
+def get_executor():
+    """The executor async saves run on, created on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'DATABASE_CONSTRAINTS_ASYNC_WORKERS', DEFAULT_WORKERS),
+            thread_name_prefix='django_database_constraints',
+        )
+    return _executor
+
+
+def set_executor(executor):
+    """
+    Use executor for async saves (for instance to share one, or to size
+    it to your connection limits). Returns the previous one, if any; it's
+    up to you to shut it down.
+    """
+    global _executor
+    previous, _executor = _executor, executor
+    return previous
+
+
+def _in_thread(func, args, kwargs):
+    # as for a request: don't start with, or leave behind, a connection
+    # that's broken or past CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Await func(*args, **kwargs), run on a thread of the executor."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(_in_thread, func, args, kwargs),
+    )
+
+
+async def atransactional_save(form, *args, **kwargs):
+    """
+    transactional_save(), awaitable. The transaction is on the executor
+    thread's connection, so this can't join one the caller has open.
+    """
+    return await run_in_executor(transactional_save, form, *args, **kwargs)
+
+
+class AsyncTransactionalViewMixin(object):
+    """
+    Handle GET and POST on the executor, so that the object lookup,
+    validation and transactional save all use the same connection.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(AsyncTransactionalViewMixin, cls).as_view(**initkwargs)
+        if django.VERSION >= (4, 1):
+            # Django spots the async handlers itself
+            return view
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            # http_method_not_allowed() and options() are still sync
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        # carries over view_class and view_initkwargs
+        functools.update_wrapper(async_view, view)
+        return async_view
+
+    async def get(self, request, *args, **kwargs):
+        return await run_in_executor(
+            super(AsyncTransactionalViewMixin, self).get, request, *args, **kwargs
+        )
+
+    async def post(self, request, *args, **kwargs):
+        return await run_in_executor(
+            super(AsyncTransactionalViewMixin, self).post, request, *args, **kwargs
+        )
+
+    async def put(self, request, *args, **kwargs):
+        return await self.post(request, *args, **kwargs)
+
+
+class AsyncCreateView(AsyncTransactionalViewMixin, CreateView):
+    pass
+
+
+class AsyncUpdateView(AsyncTransactionalViewMixin, UpdateView):
+    pass
@@ -0,0 +1,191 @@
+"""
+Compare what Django checks in Python when validating a model (or a
+ModelForm for it) with the constraints the database actually has.
+
+A check the database also enforces costs queries on every save and buys
+nothing (since it can race anyway): the database will reject the row,
+and TransactionalMixin's trust_database and trust_database_foreign_keys
+will turn that into the same form error. A check only Python makes is
+an invariant that concurrent saves can break.
+
+Query counts are estimates for a ModelForm saving one object with every
+field filled in.
+"""
+from django.db import models
+from django.db.models import ForeignKey
+
+from . import constraints
+
+
+REDUNDANT = 'redundant'
+UNENFORCED = 'unenforced'
+
+# queries per save for each kind of check
+UNIQUE_QUERIES = 1
+# the form field's choice lookup, and ForeignKey.validate()
+FOREIGN_KEY_QUERIES = 2
+
+
+def _finding(kind, check, fields, constraint, queries, note):
+    return {
+        'kind': kind,
+        'check': check,
+        'fields': list(fields),
+        'constraint': constraint,
+        'queries_per_save': queries,
+        'note': note,
+    }
+
+
+def _columns(model, field_names):
+    opts = model._meta
+    return frozenset(opts.get_field(name).column for name in field_names)
+
+
+def _unique_findings(unique_checks, date_checks, db_constraints):
+    findings = []
+    for model_class, unique_check in unique_checks:
+        if tuple(unique_check) == (model_class._meta.pk.name,):
+            # forms don't validate automatic primary keys
+            continue
+        table = model_class._meta.db_table
+        columns = _columns(model_class, unique_check)
+        name = None
+        for constraint_name, info in db_constraints.get(table, {}).items():
+            if info['unique'] and frozenset(info['columns']) == columns:
+                name = constraint_name
+                break
+        if name is not None:
+            findings.append(_finding(
+                REDUNDANT, 'unique', unique_check, name, UNIQUE_QUERIES,
+                'enforced by the database; set trust_database to skip the query',
+            ))
+        else:
+            findings.append(_finding(
+                UNENFORCED, 'unique', unique_check, None, UNIQUE_QUERIES,
+                'no unique constraint in the database, so concurrent saves can duplicate it',
+            ))
+    for model_class, lookup_type, field, unique_for in date_checks:
+        findings.append(_finding(
+            UNENFORCED, 'unique_for_%s' % lookup_type, [field, unique_for], None, UNIQUE_QUERIES,
+            "databases can't enforce this, so concurrent saves can duplicate it",
+        ))
+    return findings
+
+
+def _foreign_key_findings(model, db_constraints):
+    findings = []
+    opts = model._meta
+    for field in opts.local_fields:
+        if not isinstance(field, ForeignKey) or not field.editable:
+            continue
+        table_constraints = db_constraints.get(opts.db_table, {})
+        name = None
+        for constraint_name, info in table_constraints.items():
+            if info['foreign_key'] and info['columns'] == [field.column]:
+                name = constraint_name
+                break
+        if name is None:
+            findings.append(_finding(
+                UNENFORCED, 'foreign_key', [field.name], None, FOREIGN_KEY_QUERIES,
+                'no foreign key constraint in the database, so the object can be '
+                'deleted between validation and saving',
+            ))
+        elif field.remote_field.limit_choices_to:
+            # the database can't check limit_choices_to, so the queries
+            # still do something
+            continue
+        else:
+            findings.append(_finding(
+                REDUNDANT, 'foreign_key', [field.name], name, FOREIGN_KEY_QUERIES,
+                'enforced by the database; set trust_database_foreign_keys to skip the queries',
+            ))
+    return findings
+
+
+def _meta_constraint_findings(model, db_constraints, unique_checks):
+    # Django 4.1+ validates Meta.constraints in Python too, with a query
+    # each (those already covered as unique checks aside)
+    if not hasattr(models.Model, 'validate_constraints'):
+        return []
+    findings = []
+    covered = set(tuple(check) for model_class, check in unique_checks)
+    table_constraints = db_constraints.get(model._meta.db_table, {})
+    for constraint in model._meta.constraints:
+        fields = getattr(constraint, 'fields', ())
+        if fields and tuple(fields) in covered and not getattr(constraint, 'condition', None):
+            continue
+        if constraint.name in table_constraints:
+            findings.append(_finding(
+                REDUNDANT, 'constraint', fields, constraint.name, 1,
+                'enforced by the database; set trust_database to skip the query',
+            ))
+        else:
+            findings.append(_finding(
+                UNENFORCED, 'constraint', fields, constraint.name, 1,
+                'not in the database (not migrated, or not supported by it)',
+            ))
+    return findings
+
+
+def _clean_findings(model):
+    findings = []
+    for klass in model.__mro__:
+        if klass is models.Model:
+            break
+        if 'clean' in klass.__dict__:
+            findings.append(_finding(
+                UNENFORCED, 'clean', [], None, None,
+                '%s.clean() is Python only; anything it checks against other '
+                'rows can race' % klass.__name__,
+            ))
+            break
+    return findings
+
+
+def audit_model(model, db_constraints):
+    """
+    Findings for model, given db_constraints (table -> the database's
+    constraints, as from introspection.get_constraints()).
+    """
+    unique_checks, date_checks = constraints.unique_checks(model)
+    return (
+        _unique_findings(unique_checks, date_checks, db_constraints) +
+        _foreign_key_findings(model, db_constraints) +
+        _meta_constraint_findings(model, db_constraints, unique_checks) +
+        _clean_findings(model)
+    )
+
+
+def audit(model_list, connection):
+    """A JSON-serialisable report on model_list, against connection."""
+    with connection.cursor() as cursor:
+        tables = set(connection.introspection.table_names(cursor))
+        db_constraints = {}
+        report = []
+        for model in sorted(model_list, key=lambda m: m._meta.label):
+            opts = model._meta
+            if opts.abstract or opts.proxy or not opts.managed or opts.swapped:
+                continue
+            entry = {'model': opts.label, 'table': opts.db_table}
+            if opts.db_table not in tables:
+                entry['missing'] = True
+                report.append(entry)
+                continue
+            for parent in [model] + list(opts.get_parent_list()):
+                table = parent._meta.db_table
+                if table not in db_constraints:
+                    db_constraints[table] = connection.introspection.get_constraints(cursor, table)
+            findings = audit_model(model, db_constraints)
+            entry['findings'] = findings
+            entry['redundant_queries_per_save'] = sum(
+                f['queries_per_save'] for f in findings if f['kind'] == REDUNDANT
+            )
+            entry['unenforced'] = len([f for f in findings if f['kind'] == UNENFORCED])
+            report.append(entry)
+    return {
+        'database': connection.alias,
+        'models': report,
+        'redundant_queries_per_save': sum(e.get('redundant_queries_per_save', 0) for e in report),
+        'unenforced': sum(e.get('unenforced', 0) for e in report),
+    }
@@ -0,0 +1,241 @@
+"""
+Decoding database errors into something we can attribute to fields.
+
+Each database backend reports constraint violations differently, so we
+have one decoder per vendor which reads whatever structured information
+the driver gives us (falling back to patterns on the message text only
+where that's all there is). The decoder is chosen once per connection
+alias and reused for every error after that.
+"""
+import re
+from collections import namedtuple
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import constraints
+
+
+# Kinds of error that aren't constraint violations, but mean the
+# transaction lost out to another one and could succeed if retried.
+SERIALIZATION_FAILURE = 'serialization_failure'
+DEADLOCK = 'deadlock'
+# lock wait timeouts, SQLite's "database is locked" and the like
+LOCKED = 'locked'
+# a statement ran for longer than we allowed it; not retryable, since
+# it would most likely just happen again
+STATEMENT_TIMEOUT = 'statement_timeout'
+
+RETRYABLE = frozenset([SERIALIZATION_FAILURE, DEADLOCK, LOCKED])
+
+# kind is one of constraints.UNIQUE, constraints.FOREIGN_KEY,
+# constraints.CHECK, constraints.NOT_NULL, one of the kinds above or
+# None if we don't know;
+# constraint_name, table and columns are whatever the database told us
+# (any may be None); code is the backend's own error code (SQLSTATE,
+# errno or SQLite extended result code).
+ErrorInfo = namedtuple(
+    'ErrorInfo',
+    ['kind', 'constraint_name', 'table', 'columns', 'code'],
+)
+
+
+def _cause(error):
+    # Django wraps the driver's exception, leaving it as __cause__
+    return getattr(error, '__cause__', None) or error
+
+
+class BaseDecoder(object):
+    """Used for backends we don't know anything about."""
+
+    def decode(self, error):
+        return None
+
+
+class PostgreSQLDecoder(BaseDecoder):
+    SQLSTATES = {
+        '23505': constraints.UNIQUE,
+        '23503': constraints.FOREIGN_KEY,
+        '23514': constraints.CHECK,
+        '23502': constraints.NOT_NULL,
+        '40001': SERIALIZATION_FAILURE,
+        '40P01': DEADLOCK,
+        '55P03': LOCKED,
+        '57014': STATEMENT_TIMEOUT,
+    }
+
+    def decode(self, error):
+        cause = _cause(error)
+        # psycopg2 calls it pgcode, psycopg 3 sqlstate
+        code = getattr(cause, 'sqlstate', None) or getattr(cause, 'pgcode', None)
+        diag = getattr(cause, 'diag', None)
+        if code is None and diag is not None:
+            code = diag.sqlstate
+        if code is None:
+            return None
+        columns = None
+        column_name = getattr(diag, 'column_name', None)
+        if column_name:
+            columns = (column_name,)
+        return ErrorInfo(
+            self.SQLSTATES.get(code),
+            getattr(diag, 'constraint_name', None),
+            getattr(diag, 'table_name', None),
+            columns,
+            code,
+        )
+
+
+class MySQLDecoder(BaseDecoder):
+    # MySQL gives us an errno, but the constraint name is only in the text
+    ER_DUP_ENTRY = 1062
+    ER_NO_REFERENCED_ROW = 1216
+    ER_ROW_IS_REFERENCED = 1217
+    ER_ROW_IS_REFERENCED_2 = 1451
+    ER_NO_REFERENCED_ROW_2 = 1452
+    ER_BAD_NULL_ERROR = 1048
+    ER_CHECK_CONSTRAINT_VIOLATED = 3819
+    ER_LOCK_WAIT_TIMEOUT = 1205
+    ER_LOCK_DEADLOCK = 1213
+    ER_LOCK_NOWAIT = 3572
+    ER_QUERY_TIMEOUT = 3024
+
+    KINDS = {
+        ER_LOCK_WAIT_TIMEOUT: LOCKED,
+        ER_LOCK_DEADLOCK: DEADLOCK,
+        ER_LOCK_NOWAIT: LOCKED,
+        ER_QUERY_TIMEOUT: STATEMENT_TIMEOUT,
+    }
+
+    DUP_ENTRY_RE = re.compile(r"for key '(?:(?P<table>[^'.]+)\.)?(?P<name>[^']+)'")
+    FOREIGN_KEY_RE = re.compile(
+        r"fails \(`[^`]+`\.`(?P<table>[^`]+)`, CONSTRAINT `(?P<name>[^`]+)` "
+        r"FOREIGN KEY \(`(?P<column>[^`]+)`\)"
+    )
+    CHECK_RE = re.compile(r"Check constraint '(?P<name>[^']+)' is violated")
+    BAD_NULL_RE = re.compile(r"Column '(?P<column>[^']+)' cannot be null")
+
+    def decode(self, error):
+        args = getattr(error, 'args', ())
+        if len(args) < 2 or not isinstance(args[0], int):
+            args = getattr(_cause(error), 'args', ())
+        if len(args) < 2 or not isinstance(args[0], int):
+            return None
+        code, message = args[0], str(args[1])
+
+        if code == self.ER_DUP_ENTRY:
+            m = self.DUP_ENTRY_RE.search(message)
+            if m is None:
+                return ErrorInfo(constraints.UNIQUE, None, None, None, code)
+            return ErrorInfo(constraints.UNIQUE, m.group('name'), m.group('table'), None, code)
+        elif code in (self.ER_NO_REFERENCED_ROW, self.ER_NO_REFERENCED_ROW_2,
+                      self.ER_ROW_IS_REFERENCED, self.ER_ROW_IS_REFERENCED_2):
+            m = self.FOREIGN_KEY_RE.search(message)
+            if m is None:
+                return ErrorInfo(constraints.FOREIGN_KEY, None, None, None, code)
+            return ErrorInfo(
+                constraints.FOREIGN_KEY, m.group('name'), m.group('table'),
+                (m.group('column'),), code,
+            )
+        elif code == self.ER_CHECK_CONSTRAINT_VIOLATED:
+            m = self.CHECK_RE.search(message)
+            name = m.group('name') if m is not None else None
+            return ErrorInfo(constraints.CHECK, name, None, None, code)
+        elif code == self.ER_BAD_NULL_ERROR:
+            m = self.BAD_NULL_RE.search(message)
+            columns = (m.group('column'),) if m is not None else None
+            return ErrorInfo(constraints.NOT_NULL, None, None, columns, code)
+        return ErrorInfo(self.KINDS.get(code), None, None, None, code)
+
+
+class SQLiteDecoder(BaseDecoder):
+    # extended result codes; the sqlite3 module exposes them on the
+    # exception from Python 3.11, otherwise we look at the message
+    SQLITE_CONSTRAINT_CHECK = 275
+    SQLITE_CONSTRAINT_FOREIGNKEY = 787
+    SQLITE_CONSTRAINT_NOTNULL = 1299
+    SQLITE_CONSTRAINT_PRIMARYKEY = 1555
+    SQLITE_CONSTRAINT_UNIQUE = 2067
+    # primary result codes, which we check with any extended code masked off
+    SQLITE_BUSY = 5
+    SQLITE_LOCKED = 6
+
+    CODES = {
+        SQLITE_CONSTRAINT_CHECK: constraints.CHECK,
+        SQLITE_CONSTRAINT_FOREIGNKEY: constraints.FOREIGN_KEY,
+        SQLITE_CONSTRAINT_NOTNULL: constraints.NOT_NULL,
+        SQLITE_CONSTRAINT_PRIMARYKEY: constraints.UNIQUE,
+        SQLITE_CONSTRAINT_UNIQUE: constraints.UNIQUE,
+    }
+    KINDS = {
+        'UNIQUE': constraints.UNIQUE,
+        'FOREIGN KEY': constraints.FOREIGN_KEY,
+        'CHECK': constraints.CHECK,
+        'NOT NULL': constraints.NOT_NULL,
+    }
+
+    MESSAGE_RE = re.compile(
+        r"^(?P<kind>UNIQUE|FOREIGN KEY|CHECK|NOT NULL) constraint failed(?:: (?P<detail>.*))?$"
+    )
+    INDEX_RE = re.compile(r"^index '(?P<name>[^']+)'$")
+    LOCKED_RE = re.compile(r"^database (?:table )?is locked")
+
+    def decode(self, error):
+        cause = _cause(error)
+        code = getattr(cause, 'sqlite_errorcode', None)
+        m = self.MESSAGE_RE.match(str(error))
+        if m is None:
+            if (code is not None and code & 0xff in (self.SQLITE_BUSY, self.SQLITE_LOCKED)) or self.LOCKED_RE.match(str(error)):
+                return ErrorInfo(LOCKED, None, None, None, code)
+            if code is None:
+                return None
+            return ErrorInfo(self.CODES.get(code), None, None, None, code)
+        kind = self.CODES.get(code) or self.KINDS[m.group('kind')]
+        detail = m.group('detail')
+        if not detail:
+            return ErrorInfo(kind, None, None, None, code)
+
+        index = self.INDEX_RE.match(detail)
+        if index is not None:
+            return ErrorInfo(kind, index.group('name'), None, None, code)
+        if kind == constraints.CHECK:
+            # a named constraint (older SQLite gives the expression instead)
+            return ErrorInfo(kind, detail, None, None, code)
+
+        # "table.column[, table.column...]"
+        table = None
+        columns = []
+        for part in detail.split(', '):
+            table, _, column = part.rpartition('.')
+            columns.append(column)
+        return ErrorInfo(kind, None, table or None, tuple(columns), code)
+
+
+DECODERS = {
+    'postgresql': PostgreSQLDecoder,
+    'mysql': MySQLDecoder,
+    'sqlite': SQLiteDecoder,
+}
+
+_decoders = {}
+
+
+def get_decoder(using=None):
+    """The decoder for a connection alias, chosen once and cached."""
+    if using is None:
+        using = DEFAULT_DB_ALIAS
+    decoder = _decoders.get(using)
+    if decoder is None:
+        decoder_class = DECODERS.get(connections[using].vendor, BaseDecoder)
+        decoder = _decoders[using] = decoder_class()
+    return decoder
+
+
+def decode(error, using=None):
+    """An ErrorInfo for a database error, or None if we can't tell."""
+    return get_decoder(using).decode(error)
+
+
+def is_retryable(error, using=None):
+    """Could the transaction that raised error succeed if run again?"""
+    info = decode(error, using)
+    return info is not None and info.kind in RETRYABLE
@@ -0,0 +1,325 @@
+"""
+A short-circuit for duplicate submissions we've just seen fail.
+
+During a signup storm or a bot flood the same duplicate values arrive
+again and again, and each one opens a transaction, fails its INSERT,
+rolls back and has its IntegrityError converted, only to produce the
+same field error as last time. With a conflict cache, each unique
+violation transactional_save() converts is remembered (as the values
+that clashed, and the row that already has them), and a later save
+with the same values gets the same field error straight away, without
+opening a transaction.
+
+Entries are forgotten after a while (the TTL), when the cache is full
+(least recently used first), and when the row that owns the values is
+changed or deleted through the ORM (ie when post_save or post_delete is
+sent for it). Changes that don't send those signals (QuerySet.update(),
+raw SQL, other applications) are only noticed once the TTL runs out, so
+keep it short. LocalConflictCache is private to the process, so it
+only sees this process's changes; DjangoConflictCache shares entries
+(and invalidations) through one of Django's caches.
+
+Only violations attributed through the constraint index are cached, and
+a hit gives the error that conversion would have, so convertors passed
+to transactional_save() aren't consulted for hits.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils.encoding import force_str
+
+from . import constraints
+from .retry import monotonic
+
+
+# entries kept by the default LocalConflictCache
+DEFAULT_MAX_SIZE = 10000
+# seconds an entry lives, at most
+DEFAULT_TTL = 60
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()
+
+
+def conflict_key(model, fields, values):
+    """
+    The key for values (strings) of the unique fields of model, in an
+    order that doesn't depend on how the constraint lists them.
+    """
+    pairs = sorted(zip(fields, values))
+    return _digest([model._meta.db_table, [list(pair) for pair in pairs]])
+
+
+def owner_key(model, pk):
+    """The key for the row of model with primary key pk."""
+    return _digest([model._meta.db_table, force_str(pk)])
+
+
+def _values(model, fields, instance):
+    # the values of fields as strings, or None if any are NULL (which
+    # never conflict)
+    values = []
+    for field_name in fields:
+        value = getattr(instance, model._meta.get_field(field_name).attname)
+        if value is None:
+            return None
+        values.append(force_str(value))
+    return values
+
+
+class ConflictCache(object):
+    """
+    Remembers which unique values conflicted, and with which row. The
+    storage is up to subclasses, which implement get(), add() and
+    invalidate() on the keys made by conflict_key() and owner_key().
+    """
+
+    def get(self, key):
+        """The (owner, constraint name) stored for key, or None."""
+        raise NotImplementedError
+
+    def add(self, key, owner, name):
+        """Remember that key conflicted with owner's row, on name."""
+        raise NotImplementedError
+
+    def invalidate(self, owner):
+        """Forget every key that conflicted with owner's row."""
+        raise NotImplementedError
+
+    def connect(self):
+        """Invalidate when rows are changed or deleted through the ORM."""
+        post_save.connect(self._saved, dispatch_uid=id(self))
+        post_delete.connect(self._deleted, dispatch_uid=id(self))
+        return self
+
+    def disconnect(self):
+        post_save.disconnect(dispatch_uid=id(self))
+        post_delete.disconnect(dispatch_uid=id(self))
+
+    def _saved(self, sender, instance, created=False, raw=False, using=None, **kwargs):
+        if not created:
+            self._invalidate_later(sender, instance, using)
+
+    def _deleted(self, sender, instance, using=None, **kwargs):
+        self._invalidate_later(sender, instance, using)
+
+    def _invalidate_later(self, sender, instance, using):
+        if not _has_unique_values(sender):
+            return
+        pk = instance.pk
+        # an inherited unique field is checked (and so cached) on the
+        # parent, for which no signals are sent
+        owners = [owner_key(model, pk) for model in [sender] + list(sender._meta.get_parent_list())]
+
+        def invalidate():
+            for owner in owners:
+                self.invalidate(owner)
+        # until the change commits, the row still has the old values,
+        # and a conflict on them can be cached again
+        transaction.on_commit(invalidate, using=using)
+
+    def check(self, instance):
+        """
+        A ConstraintInfo for a cached conflict with instance's unique
+        values (other than with instance's own row), or None.
+        """
+        unique_checks, date_checks = instance._get_unique_checks()
+        pk_name = instance._meta.pk.name
+        for model_class, unique_check in unique_checks:
+            if tuple(unique_check) == (pk_name,):
+                continue
+            values = _values(model_class, unique_check, instance)
+            if values is None:
+                continue
+            entry = self.get(conflict_key(model_class, unique_check, values))
+            if entry is None:
+                continue
+            owner, name = entry
+            if not instance._state.adding and owner == owner_key(model_class, instance.pk):
+                # it's ours (perhaps from before a change we haven't
+                # heard about), so let the database decide
+                continue
+            return constraints.ConstraintInfo(name, model_class, tuple(unique_check), constraints.UNIQUE, None)
+        return None
+
+    def record(self, constraint, instance, using):
+        """
+        Remember a violation of constraint (a ConstraintInfo) by
+        instance, looking up (on using) the row it conflicted with.
+        """
+        if constraint.kind != constraints.UNIQUE:
+            return
+        if getattr(constraint.constraint, 'condition', None) is not None:
+            # whether values conflict depends on more than the values
+            return
+        model = constraint.model
+        if tuple(constraint.fields) == (model._meta.pk.name,):
+            return
+        values = _values(model, constraint.fields, instance)
+        if values is None:
+            return
+        lookup = dict(
+            (model._meta.get_field(name).attname, getattr(instance, model._meta.get_field(name).attname))
+            for name in constraint.fields
+        )
+        owners = model._base_manager.using(using).filter(**lookup).values_list('pk', flat=True)[:1]
+        for pk in owners:
+            self.add(conflict_key(model, constraint.fields, values), owner_key(model, pk), constraint.name)
+
+
+_unique_values = {}
+
+
+def _has_unique_values(model):
+    # whether model has unique checks other than its primary key, ie
+    # whether any of its rows can own a cached conflict
+    try:
+        return _unique_values[model]
+    except KeyError:
+        pass
+    opts = model._meta
+    result = False
+    if not opts.abstract:
+        unique_checks, date_checks = constraints.unique_checks(model)
+        result = any(
+            tuple(check) != (model_class._meta.pk.name,)
+            for model_class, check in unique_checks
+        )
+    _unique_values[model] = result
+    return result
+
+
+class LocalConflictCache(ConflictCache):
+    """
+    A conflict cache in this process's memory, holding at most max_size
+    entries, each for at most ttl seconds (by default the
+    DATABASE_CONSTRAINTS_CONFLICT_CACHE_SIZE and _TTL settings).
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        if max_size is None:
+            max_size = getattr(settings, 'DATABASE_CONSTRAINTS_CONFLICT_CACHE_SIZE', DEFAULT_MAX_SIZE)
+        if ttl is None:
+            ttl = getattr(settings, 'DATABASE_CONSTRAINTS_CONFLICT_CACHE_TTL', DEFAULT_TTL)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (owner, name, expires), least recently used first
+        self._entries = OrderedDict()
+        # owner -> set of keys
+        self._owners = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            owner, name, expires = entry
+            if expires <= monotonic():
+                self._remove(key)
+                return None
+            # most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return owner, name
+
+    def add(self, key, owner, name):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (owner, name, monotonic() + self.ttl)
+            self._owners.setdefault(owner, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, owner):
+        with self._lock:
+            for key in list(self._owners.get(owner, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+
+    def _remove(self, key):
+        owner, name, expires = self._entries.pop(key)
+        keys = self._owners[owner]
+        keys.discard(key)
+        if not keys:
+            del self._owners[owner]
+
+
+class DjangoConflictCache(ConflictCache):
+    """
+    A conflict cache kept in one of Django's caches (by alias), so that
+    processes share what they've seen, and each other's invalidations.
+    Every lookup is a round trip to the cache, as is every change to a
+    model with unique fields, so use a fast one.
+    """
+
+    def __init__(self, alias='default', ttl=None, prefix='django_database_constraints:conflict:'):
+        from django.core.cache import caches
+        if ttl is None:
+            ttl = getattr(settings, 'DATABASE_CONSTRAINTS_CONFLICT_CACHE_TTL', DEFAULT_TTL)
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        entry = self.cache.get(self.prefix + key)
+        if entry is None:
+            return None
+        return tuple(entry)
+
+    def add(self, key, owner, name):
+        self.cache.set(self.prefix + key, (owner, name), self.ttl)
+        # so the owner's keys can be found to invalidate them; a racing
+        # add can lose a key here, which the TTL then takes care of
+        owner_entry = self.prefix + 'owner:' + owner
+        keys = self.cache.get(owner_entry) or []
+        if key not in keys:
+            keys.append(key)
+        self.cache.set(owner_entry, keys, self.ttl)
+
+    def invalidate(self, owner):
+        owner_entry = self.prefix + 'owner:' + owner
+        keys = self.cache.get(owner_entry)
+        if keys is not None:
+            self.cache.delete_many([self.prefix + key for key in keys] + [owner_entry])
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    The conflict cache used by transactional_save(conflict_cache=True),
+    a connected LocalConflictCache created on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LocalConflictCache().connect()
+        return _cache
+
+
+def set_cache(cache):
+    """
+    Use cache (which should be connected) as the default conflict cache.
+    Returns the previous one, if any, which is left connected.
+    """
+    global _cache
+    with _cache_lock:
+        previous, _cache = _cache, cache
+    return previous
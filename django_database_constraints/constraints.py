@@ -0,0 +1,276 @@
+"""
+An index from database constraint names to the model fields they cover.
+
+This is built once (on the first lookup, and again for any model class
+prepared after that) so that attributing an `IntegrityError` to a form
+field is a dictionary lookup on the constraint name reported by the
+database, rather than anything cleverer at the point of failure. Not
+when the app registry is ready, since working out some names can need a
+connection (on mysql, whether the server supports CHECK constraints),
+and loading the apps mustn't need a database.
+
+The names indexed are the ones Django itself generates when creating
+constraints via migrations, the names the database generates for
+constraints declared inline in `CREATE TABLE`, and any explicit names
+given in `Meta.constraints`.
+"""
+import threading
+from collections import namedtuple
+
+from django.apps import apps
+from django.db import connections
+from django.db.models.signals import class_prepared
+
+
+UNIQUE = 'unique'
+FOREIGN_KEY = 'foreign_key'
+CHECK = 'check'
+NOT_NULL = 'not_null'
+
+# name is the constraint name as the database reports it; fields are the
+# names of the model fields (and hence usually form fields) it covers;
+# constraint is the Meta.constraints entry it came from, if any.
+ConstraintInfo = namedtuple(
+    'ConstraintInfo',
+    ['name', 'model', 'fields', 'kind', 'constraint'],
+)
+
+# constraint name -> tuple of ConstraintInfo (names aren't necessarily
+# unique across tables, eg on MySQL an inline unique key is named after
+# its column)
+_by_name = {}
+# (db_table, constraint name) -> ConstraintInfo
+_by_table = {}
+# (db_table, frozenset of columns) -> ConstraintInfo, for unique
+# constraints on backends (ie SQLite) which report columns not names
+_by_columns = {}
+# (db_table, column) -> ConstraintInfo for the field's NOT NULL
+_by_column = {}
+_built = False
+_build_lock = threading.Lock()
+
+
+def _ensure_index():
+    if not _built:
+        with _build_lock:
+            if not _built:
+                build_index()
+
+
+def lookup(name, model=None):
+    """
+    Find the ConstraintInfo for a constraint name as reported by the
+    database, or None. If model is given, prefer that model's table
+    (which is the only way to disambiguate non-unique names).
+    """
+    _ensure_index()
+    if model is not None:
+        info = _by_table.get((model._meta.db_table, name))
+        if info is not None:
+            return info
+    infos = _by_name.get(name, ())
+    if len(infos) == 1:
+        return infos[0]
+    return None
+
+
+def lookup_columns(table, columns):
+    """Find the unique constraint on exactly these columns, or None."""
+    _ensure_index()
+    return _by_columns.get((table, frozenset(columns)))
+
+
+def lookup_column(table, column):
+    """Find the NOT NULL constraint for a column, or None."""
+    _ensure_index()
+    return _by_column.get((table, column))
+
+
+def _postgresql_inline_name(table, columns, label):
+    # PostgreSQL's own name for an unnamed constraint (see makeObjectName
+    # in src/backend/commands/indexcmds.c), truncating the longer part
+    # until it fits into NAMEDATALEN - 1. We don't mimic the numeric
+    # suffix it uses to avoid collisions.
+    name1 = table
+    name2 = '_'.join(columns)
+    avail = 63 - len(label) - 1
+    if name2:
+        avail -= 1
+    n1, n2 = len(name1), len(name2)
+    while n1 + n2 > avail:
+        if n1 > n2:
+            n1 -= 1
+        else:
+            n2 -= 1
+    parts = [name1[:n1]]
+    if name2:
+        parts.append(name2[:n2])
+    parts.append(label)
+    return '_'.join(parts)
+
+
+def _candidate_names(connection, schema_editor, table, columns, kind, primary_key=False, to_table=None, to_column=None):
+    """Yield the names connection may use for an unnamed constraint."""
+    if kind == UNIQUE:
+        suffix = '_uniq'
+    elif kind == FOREIGN_KEY:
+        # matches BaseDatabaseSchemaEditor._fk_constraint_name
+        suffix = '_fk_%s_%s' % (to_table, to_column)
+    else:
+        suffix = '_check'
+    yield schema_editor._create_index_name(table, columns, suffix=suffix)
+
+    if connection.vendor == 'postgresql':
+        if primary_key:
+            yield _postgresql_inline_name(table, [], 'pkey')
+        elif kind == UNIQUE:
+            yield _postgresql_inline_name(table, columns, 'key')
+        elif kind == FOREIGN_KEY:
+            yield _postgresql_inline_name(table, columns, 'fkey')
+        else:
+            yield _postgresql_inline_name(table, columns, 'check')
+    elif connection.vendor == 'mysql':
+        if primary_key:
+            yield 'PRIMARY'
+        elif kind == UNIQUE:
+            yield columns[0]
+
+
+def _check_fields(q):
+    # the field names referred to by a CheckConstraint's Q object
+    fields = []
+    for child in getattr(q, 'children', ()):
+        if isinstance(child, tuple):
+            name = child[0].split('__', 1)[0]
+            if name not in fields:
+                fields.append(name)
+        else:
+            for name in _check_fields(child):
+                if name not in fields:
+                    fields.append(name)
+    return fields
+
+
+def _register(info, table):
+    existing = _by_name.get(info.name, ())
+    if info not in existing:
+        _by_name[info.name] = existing + (info,)
+    _by_table[(table, info.name)] = info
+
+
+def register_model(model):
+    """Add all the constraints for model to the index."""
+    opts = model._meta
+    if opts.proxy or opts.auto_created or opts.swapped:
+        return
+    table = opts.db_table
+
+    def add(name, fields, kind, constraint=None):
+        _register(ConstraintInfo(name, model, tuple(fields), kind, constraint), table)
+
+    def add_columns(fields, constraint=None):
+        columns = frozenset(opts.get_field(f).column for f in fields)
+        _by_columns[(table, columns)] = ConstraintInfo(None, model, tuple(fields), UNIQUE, constraint)
+
+    for field in opts.local_fields:
+        if field.column is None:
+            continue
+        if field.unique:
+            add_columns([field.name])
+        if not field.null:
+            _by_column[(table, field.column)] = ConstraintInfo(None, model, (field.name,), NOT_NULL, None)
+    for field_names in opts.unique_together:
+        add_columns(field_names)
+
+    for alias in connections:
+        connection = connections[alias]
+        try:
+            schema_editor = connection.schema_editor()
+        except NotImplementedError:
+            # the dummy backend, when no databases are configured
+            continue
+
+        for field in opts.local_fields:
+            if field.column is None:
+                continue
+            if field.unique:
+                for name in _candidate_names(connection, schema_editor, table, [field.column], UNIQUE, primary_key=field.primary_key):
+                    add(name, [field.name], UNIQUE)
+            if field.remote_field is not None and getattr(field, 'db_constraint', False) and not isinstance(field.remote_field.model, str):
+                target = field.target_field
+                to_table = target.model._meta.db_table.split('.')[-1].strip('"')
+                for name in _candidate_names(connection, schema_editor, table, [field.column], FOREIGN_KEY, to_table=to_table, to_column=target.column):
+                    add(name, [field.name], FOREIGN_KEY)
+            if field.db_check(connection):
+                for name in _candidate_names(connection, schema_editor, table, [field.column], CHECK):
+                    add(name, [field.name], CHECK)
+
+        for field_names in opts.unique_together:
+            columns = [opts.get_field(f).column for f in field_names]
+            for name in _candidate_names(connection, schema_editor, table, columns, UNIQUE):
+                add(name, field_names, UNIQUE)
+
+    for constraint in getattr(opts, 'constraints', ()):
+        fields = getattr(constraint, 'fields', None)
+        if fields:
+            add(constraint.name, fields, UNIQUE, constraint)
+            add_columns(fields, constraint)
+        else:
+            add(constraint.name, _check_fields(getattr(constraint, 'check', None)), CHECK, constraint)
+
+
+def _total_unique_constraints(opts):
+    # Options.total_unique_constraints is Django 3.1+
+    if hasattr(opts, 'total_unique_constraints'):
+        return opts.total_unique_constraints
+    return [
+        c for c in getattr(opts, 'constraints', ())
+        if getattr(c, 'fields', None) and getattr(c, 'condition', None) is None
+    ]
+
+
+def unique_checks(model):
+    """
+    The unique checks (model class, field names) and date checks (model
+    class, lookup type, field name, unique_for field name) for model, as
+    from Model._get_unique_checks() but without needing an instance.
+    """
+    unique = []
+    dates = []
+    for model_class in [model] + list(model._meta.get_parent_list()):
+        opts = model_class._meta
+        for check in opts.unique_together:
+            unique.append((model_class, tuple(check)))
+        for constraint in _total_unique_constraints(opts):
+            unique.append((model_class, tuple(constraint.fields)))
+        for field in opts.local_fields:
+            if field.unique:
+                unique.append((model_class, (field.name,)))
+            for lookup_type in ('date', 'year', 'month'):
+                unique_for = getattr(field, 'unique_for_%s' % lookup_type)
+                if unique_for:
+                    dates.append((model_class, lookup_type, field.name, unique_for))
+    return unique, dates
+
+
+def build_index():
+    """(Re)build the index for every installed model."""
+    global _built
+    _by_name.clear()
+    _by_table.clear()
+    _by_columns.clear()
+    _by_column.clear()
+    for model in apps.get_models():
+        register_model(model)
+    _built = True
+
+
+def _class_prepared(sender, **kwargs):
+    # models defined after the index is built (eg in tests), but not
+    # the historical models built by migrations
+    if _built and sender._meta.apps is apps:
+        register_model(sender)
+
+
+def connect_signals():
+    class_prepared.connect(_class_prepared, dispatch_uid='django_database_constraints.constraints')
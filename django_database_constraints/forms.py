@@ -1,6 +1,73 @@
+import math
+import sys
+
 from django import forms
-from django.db import transaction, IntegrityError
-from django.utils.encoding import force_text
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router, transaction, DEFAULT_DB_ALIAS, DatabaseError, IntegrityError, OperationalError
+from django.db.models import ForeignKey
+from django.utils.encoding import force_str
+from django.utils.translation import gettext_lazy as _
+
+from . import backends, conflicts, constraints, locks, signals
+from .retry import monotonic
+
+
+def validationerror_from_constraint(constraint, instance=None):
+    """
+    Build the ValidationError Django would have raised itself, had it
+    spotted this constraint violation before saving.
+    """
+    model = constraint.model
+    fields = constraint.fields
+    if len(fields) == 1:
+        key = fields[0]
+    else:
+        key = forms.forms.NON_FIELD_ERRORS
+    if constraint.kind == constraints.UNIQUE:
+        if not isinstance(instance, model):
+            instance = model()
+        message = instance.unique_error_message(model, fields)
+    elif constraint.kind == constraints.NOT_NULL:
+        message = forms.ValidationError(
+            model._meta.get_field(key).error_messages['null'],
+            code='null',
+        )
+    elif constraint.kind == constraints.FOREIGN_KEY:
+        message = forms.ValidationError(
+            forms.ModelChoiceField.default_error_messages['invalid_choice'],
+            code='invalid_choice',
+        )
+    else:
+        message = forms.ValidationError(
+            _('Constraint "%(name)s" is violated.'),
+            code='constraint',
+            params={'name': constraint.name},
+        )
+    return forms.ValidationError({key: [message]})
+
+
+def constraint_conversion(ierror, instance=None, using=None):
+    info = backends.decode(ierror, using)
+    if info is None:
+        return None
+    model = type(instance) if instance is not None else None
+    constraint = None
+    if info.constraint_name is not None:
+        constraint = constraints.lookup(info.constraint_name, model)
+    if constraint is None and info.columns:
+        table = info.table
+        if table is None and model is not None:
+            table = model._meta.db_table
+        if info.kind == constraints.NOT_NULL:
+            constraint = constraints.lookup_column(table, info.columns[0])
+        elif info.kind == constraints.UNIQUE:
+            constraint = constraints.lookup_columns(table, info.columns)
+    if constraint is None:
+        return None
+    v = validationerror_from_constraint(constraint, instance)
+    # so we can report which constraint it was
+    v.constraint = constraint
+    return v
 
 
 def fallback_conversion(ierror):
@@ -10,9 +77,21 @@ def fallback_conversion(ierror):
 DEFAULT_CONVERTORS = [ fallback_conversion ]
 
 
-def validationerror_from_integrityerror(ierror, convertors=None):
-    if convertors is None:
-        convertors = []
+RETRY_MESSAGE = _('The database was busy and your changes were not saved. Please try again.')
+
+
+def validationerror_from_operationalerror(oerror):
+    # for contention we couldn't (or weren't asked to) retry our way out of
+    v = forms.ValidationError(RETRY_MESSAGE, code='retry')
+    v.cause = oerror
+    return v
+
+
+def validationerror_from_integrityerror(ierror, convertors=None, instance=None, using=None):
+    # user-supplied convertors get first go, then we try to attribute
+    # the error via the constraint index, then we give up
+    convertors = list(convertors or [])
+    convertors.append(lambda e: constraint_conversion(e, instance, using))
     convertors.extend(DEFAULT_CONVERTORS)
     for convertor in convertors:
         v = convertor(ierror)
@@ -33,38 +112,601 @@ def add_error_to_form(form, error, field=None):
     form._errors[field].append(error)
 
 
-def transactional_save(form, convertors=None, tx_context_manager=None):
+# How transactional_save isolated form.save(), recorded on the form as
+# form.transaction_strategy so it can be measured.
+#
+# outside any atomic block, so in a transaction of our own
+TRANSACTION = 'transaction'
+# inside someone else's atomic block, so in a savepoint
+SAVEPOINT = 'savepoint'
+# inside someone else's atomic block, without a savepoint because the
+# caller doesn't need their transaction to survive a failed save
+NO_SAVEPOINT = 'no_savepoint'
+
+
+def transaction_strategy(connection, savepoint=True):
+    """Pick the cheapest correct way of isolating a save on connection."""
+    if not connection.in_atomic_block:
+        return TRANSACTION
+    elif savepoint:
+        return SAVEPOINT
+    else:
+        return NO_SAVEPOINT
+
+
+DEFERRED = 'DEFERRED'
+IMMEDIATE = 'IMMEDIATE'
+
+
+def set_constraints(connection, names, mode):
+    """
+    SET CONSTRAINTS names (or ALL, if names is True) to mode, DEFERRED
+    or IMMEDIATE. Only postgresql has deferrable constraints, so this
+    does nothing elsewhere.
+    """
+    if connection.vendor != 'postgresql' or not names:
+        return
+    if names is True:
+        target = 'ALL'
+    else:
+        target = ', '.join(connection.ops.quote_name(name) for name in names)
+    with connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS %s %s' % (target, mode))
+
+
+def check_deferred_constraints(connection, names):
+    """
+    Check constraints deferred with set_constraints() now, rather than
+    at COMMIT, and then put them back in the mode they were declared
+    with (Django's foreign keys are INITIALLY DEFERRED) for the rest of
+    the transaction, which isn't ours.
+    """
+    if connection.vendor != 'postgresql' or not names:
+        return
+    set_constraints(connection, names, IMMEDIATE)
+    sql = (
+        'SELECT DISTINCT n.nspname, c.conname FROM pg_constraint c '
+        'JOIN pg_namespace n ON n.oid = c.connamespace '
+        'WHERE c.condeferrable AND c.condeferred AND n.nspname = ANY(current_schemas(false))'
+    )
+    params = []
+    if names is not True:
+        sql += ' AND c.conname = ANY(%s)'
+        params.append(list(names))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        deferred = [
+            '%s.%s' % (connection.ops.quote_name(schema), connection.ops.quote_name(name))
+            for schema, name in cursor.fetchall()
+        ]
+        if deferred:
+            cursor.execute('SET CONSTRAINTS %s %s' % (', '.join(deferred), DEFERRED))
+
+
+# timeouts we can turn into a "please try again" error
+TIMEOUTS = frozenset([backends.LOCKED, backends.STATEMENT_TIMEOUT])
+
+
+def set_timeouts(connection, lock_timeout=None, statement_timeout=None, nested=True):
+    """
+    Limit how long (in seconds) statements in the current atomic block
+    may wait for locks, and run for, on postgresql (lock_timeout and
+    statement_timeout) or mysql (innodb_lock_wait_timeout, and
+    max_execution_time, which only applies to SELECTs).
+
+    Returns a function that puts the old values back, or None if there
+    is nothing to put back (on postgresql these only last until the end
+    of the transaction, so only matter if nested in someone else's). It
+    should be called before leaving the block, and may be called again
+    afterwards.
+    """
+    if lock_timeout is None and statement_timeout is None:
+        return None
+    if connection.vendor == 'postgresql':
+        settings = []
+        values = []
+        if lock_timeout is not None:
+            settings.append('lock_timeout')
+            values.append('%dms' % max(1, int(lock_timeout * 1000)))
+        if statement_timeout is not None:
+            settings.append('statement_timeout')
+            values.append('%dms' % max(1, int(statement_timeout * 1000)))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT %s' % ', '.join(
+                    ["current_setting('%s')" % setting for setting in settings] +
+                    ["set_config('%s', %%s, true)" % setting for setting in settings]
+                ),
+                values,
+            )
+            previous = list(cursor.fetchone()[:len(settings)])
+        if not nested:
+            return None
+        sql = 'SELECT %s' % ', '.join(
+            "set_config('%s', %%s, true)" % setting for setting in settings
+        )
+    elif connection.vendor == 'mysql':
+        assignments = []
+        values = []
+        if lock_timeout is not None:
+            assignments.append(('innodb_lock_wait_timeout', max(1, int(math.ceil(lock_timeout)))))
+        if statement_timeout is not None:
+            assignments.append(('max_execution_time', max(1, int(statement_timeout * 1000))))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SET %s' % ', '.join(
+                    '@django_database_constraints_%s = @@SESSION.%s, SESSION %s = %%s' % (name, name, name)
+                    for name, value in assignments
+                ),
+                [value for name, value in assignments],
+            )
+        previous = []
+        sql = 'SET %s' % ', '.join(
+            'SESSION %s = @django_database_constraints_%s' % (name, name)
+            for name, value in assignments
+        )
+    else:
+        return None
+
+    restored = []
+
+    def restore():
+        if restored:
+            return
+        restored.append(True)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, previous)
+        except DatabaseError:
+            # the transaction is broken, and will take the values with it
+            pass
+    return restore
+
+
+class nested_atomic(object):
+    """
+    A context manager like transaction.atomic() over several databases,
+    for a save that writes to more than one, and to pass to
+    transactional_save() as tx_context_manager: it opens an atomic block
+    on each alias in turn, so they are committed in the reverse order.
+
+    This isn't two-phase commit. If a commit fails, the blocks outside it
+    are rolled back, but those inside it have already committed, so put
+    last the aliases whose commit can fail (with deferred constraints):
+    they're committed first, while the rest can still be rolled back.
+    """
+
+    def __init__(self, using, savepoint=True):
+        self.using = list(using)
+        self.savepoint = savepoint
+        self._atomics = []
+
+    def __enter__(self):
+        # transactional_save() uses us afresh for each attempt
+        self._atomics = []
+        try:
+            for alias in self.using:
+                atomic = transaction.atomic(using=alias, savepoint=self.savepoint)
+                atomic.__enter__()
+                self._atomics.append(atomic)
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # innermost first; if a commit fails, the blocks outside it see
+        # its exception, and so roll back
+        error = None
+        while self._atomics:
+            atomic = self._atomics.pop()
+            try:
+                atomic.__exit__(exc_type, exc_value, traceback)
+            except BaseException as e:
+                error = e
+                exc_type, exc_value, traceback = sys.exc_info()
+        if error is not None:
+            raise error
+        return False
+
+
+def transactional_save(form, convertors=None, tx_context_manager=None, check_constraints=False, savepoint=True, retry=None, save=None, defer_constraints=None, advisory_lock=False, advisory_lock_timeout=None, lock_timeout=None, statement_timeout=None, prepare=None, using=None, conflict_cache=None):
     # tx_context_manager must be equivalent to transaction.atomic();
     # its main purpose here is to allow the use of django-ballads so
     # you can register compensating transactions for external services.
+    #
+    # Deferred constraints (such as Django's foreign keys on postgresql)
+    # are only checked when the outermost transaction commits, which is
+    # too late for us if we're inside someone else's atomic block; set
+    # check_constraints to check them before we leave ours.
+    #
+    # Inside someone else's atomic block we need a savepoint so their
+    # transaction is still usable after an IntegrityError. If nothing
+    # will touch the database between us failing and the end of their
+    # block, pass savepoint=False to save the SAVEPOINT and RELEASE; a
+    # failure then marks their transaction for rollback.
+    #
+    # Pass a retry.RetryPolicy as retry to run the whole transaction
+    # again on serialization failures, deadlocks and lock timeouts; if
+    # they persist they become a non-field "please try again" error.
+    # We only retry if it's our transaction, since otherwise it's the
+    # outer one that needs running again.
+    #
+    # save, if given, is called instead of form.save() (see eg
+    # insert.insert_form).
+    #
+    # using is the database alias to save on; by default, wherever the
+    # router sends writes of the form's instance. The transaction, error
+    # decoding, retries, timeouts and locks are all on that connection.
+    # A tx_context_manager must be on it too (see nested_atomic for saves
+    # that write to more than one database).
+    #
+    # prepare, if given, is called (once) before the transaction is
+    # opened, to do whatever slow work save() needs that doesn't need
+    # the database, so the transaction is held open for as short a time
+    # as possible (see TransactionalMixin.prepare). A ValidationError
+    # from it goes onto the form just like one from save().
+    #
+    # defer_constraints is a list of names of DEFERRABLE constraints (or
+    # True for all of them) to defer until the end of the transaction, so
+    # that save() can pass through states that would violate them (such
+    # as reordering rows with a unique order). A violation then comes
+    # from the COMMIT, which we convert just the same. If it isn't our
+    # transaction, we check them before we finish, while we can still
+    # do something about it, and put them back as they were declared.
+    #
+    # Set advisory_lock to take advisory locks on the values of the
+    # instance's unique fields before saving (see locks.py), so that
+    # racers for the same values queue rather than all doing the work
+    # and all but one failing. If we had to wait, we check uniqueness
+    # again (cheaply, since the winner has committed) before saving. We
+    # wait at most advisory_lock_timeout seconds (0 to fail at once)
+    # before giving up with a "please try again" error.
+    #
+    # lock_timeout and statement_timeout, in seconds, limit how long any
+    # statement may wait for a lock or run for inside our block (see
+    # set_timeouts), so that a save stuck behind someone else's lock
+    # can't tie up the process. Hitting either gives the same "please
+    # try again" error, unless retry says to try again ourselves.
+    #
+    # conflict_cache is a conflicts.ConflictCache (or True for the
+    # default one): unique violations we convert are remembered there,
+    # and a save whose unique values are remembered as conflicting is
+    # given the same error without opening a transaction (see
+    # conflicts.py).
+    if save is None:
+        save = form.save
+    instance = getattr(form, 'instance', None)
+    if using is None:
+        if instance is not None:
+            using = router.db_for_write(type(instance), instance=instance)
+        else:
+            using = DEFAULT_DB_ALIAS
+    connection = transaction.get_connection(using)
+    strategy = transaction_strategy(connection, savepoint)
+    form.transaction_strategy = strategy
     if tx_context_manager is None:
-        tx_context_manager = transaction.atomic()
+        tx_context_manager = transaction.atomic(using=using, savepoint=strategy != NO_SAVEPOINT)
+    check_constraints = check_constraints and strategy != TRANSACTION
+    if conflict_cache is True:
+        conflict_cache = conflicts.get_cache()
+    if conflict_cache is False or instance is None:
+        conflict_cache = None
+    if retry is not None and strategy == TRANSACTION:
+        delays = retry.delays()
+    else:
+        delays = iter(())
+    if instance is not None:
+        # so a retry after a failed commit doesn't think it's an update
+        instance_state = (instance.pk, instance._state.adding)
+
+    # for signals.transactional_save_finished
+    outcome = signals.RERAISED
+    attempts = 0
+    lock_wait_time = 0.0 if advisory_lock else None
+    prepare_time = None
+    transaction_time = 0.0
+    conversion_time = 0.0
+    constraint_name = None
+    constraint = None
+    conflict_cache_hit = None
     try:
+        if prepare is not None:
+            started = monotonic()
+            try:
+                prepare()
+            finally:
+                prepare_time = monotonic() - started
+        if conflict_cache is not None:
+            hit = conflict_cache.check(instance)
+            conflict_cache_hit = hit is not None
+            if hit is not None:
+                constraint = hit
+                constraint_name = hit.name
+                raise validationerror_from_constraint(hit, instance)
         try:
-            with tx_context_manager:
-                # all "transactional" saves commit at once
-                return form.save()
+            while True:
+                attempts += 1
+                started = monotonic()
+                release = None
+                restore_timeouts = None
+                try:
+                    try:
+                        with tx_context_manager:
+                            restore_timeouts = set_timeouts(
+                                connection, lock_timeout, statement_timeout, strategy != TRANSACTION,
+                            )
+                            set_constraints(connection, defer_constraints, DEFERRED)
+                            if advisory_lock and instance is not None:
+                                lock_started = monotonic()
+                                try:
+                                    contended, release = locks.acquire(
+                                        connection, locks.lock_keys(instance), advisory_lock_timeout,
+                                    )
+                                finally:
+                                    lock_wait_time += monotonic() - lock_started
+                                if contended and hasattr(form, '_get_validation_exclusions'):
+                                    # whoever we waited for may have taken our values
+                                    instance.validate_unique(exclude=form._get_validation_exclusions())
+                            # all "transactional" saves commit at once
+                            saved = save()
+                            if strategy != TRANSACTION:
+                                check_deferred_constraints(connection, defer_constraints)
+                            if check_constraints:
+                                connection.check_constraints()
+                            if restore_timeouts is not None:
+                                restore_timeouts()
+                    finally:
+                        transaction_time += monotonic() - started
+                        if release is not None:
+                            release()
+                        if restore_timeouts is not None:
+                            # if we failed on mysql, where they outlive
+                            # the transaction
+                            restore_timeouts()
+                    outcome = signals.COMMITTED
+                    return saved
+                except locks.LockTimeout:
+                    raise forms.ValidationError(RETRY_MESSAGE, code='retry')
+                except OperationalError as e:
+                    if retry is None or not backends.is_retryable(e, using):
+                        timeouts = lock_timeout is not None or statement_timeout is not None
+                        info = backends.decode(e, using)
+                        if timeouts and info is not None and info.kind in TIMEOUTS:
+                            raise validationerror_from_operationalerror(e)
+                        raise
+                    delay = next(delays, None)
+                    if delay is None:
+                        raise validationerror_from_operationalerror(e)
+                    if instance is not None:
+                        instance.pk, instance._state.adding = instance_state
+                    retry.sleep(delay)
         except IntegrityError as e:
-            raise validationerror_from_integrityerror(e, convertors)
+            if instance is not None:
+                # it may have failed on COMMIT, after being saved
+                instance.pk, instance._state.adding = instance_state
+            started = monotonic()
+            v = validationerror_from_integrityerror(e, convertors, instance, using)
+            conversion_time = monotonic() - started
+            constraint = getattr(v, 'constraint', None)
+            if constraint is not None:
+                constraint_name = constraint.name
+            else:
+                info = backends.decode(e, using)
+                if info is not None:
+                    constraint_name = info.constraint_name
+            if conflict_cache is not None and constraint is not None and strategy != NO_SAVEPOINT:
+                # (without a savepoint, the outer transaction is broken
+                # and we can't look up the row we conflicted with)
+                conflict_cache.record(constraint, instance, using)
+            raise v
     except forms.ValidationError as e:
-        error_dict = e.update_error_dict({})
-        for field, messages in error_dict.items():
-            message_list = []
-            for message in messages:
-                if isinstance(message, forms.ValidationError):
-                    message_list.extend(message.messages)
-                else:
-                    message_list.append(force_text(message))
-            for m in message_list:
-                add_error_to_form(form, m, field)
+        outcome = signals.CONVERTED
+        add_validationerror_to_form(form, e)
         raise
+    finally:
+        signals.transactional_save_finished.send(
+            sender=type(instance) if instance is not None else type(form),
+            form=form,
+            outcome=outcome,
+            strategy=strategy,
+            attempts=attempts,
+            transaction_time=transaction_time,
+            conversion_time=conversion_time,
+            lock_wait_time=lock_wait_time,
+            prepare_time=prepare_time,
+            conflict_cache_hit=conflict_cache_hit,
+            constraint_name=constraint_name,
+            model=constraint.model if constraint is not None else None,
+        )
+
+
+def add_validationerror_to_form(form, error):
+    """Add the messages from a ValidationError to form's errors."""
+    error_dict = error.update_error_dict({})
+    for field, messages in error_dict.items():
+        message_list = []
+        for message in messages:
+            if isinstance(message, forms.ValidationError):
+                message_list.extend(message.messages)
+            else:
+                message_list.append(force_str(message))
+        if field != forms.forms.NON_FIELD_ERRORS and field not in form.fields:
+            # eg a unique field that isn't on the form
+            field = forms.forms.NON_FIELD_ERRORS
+        for m in message_list:
+            add_error_to_form(form, m, field)
+
+
+class DeferredModelChoiceField(forms.ModelChoiceField):
+    """
+    A ModelChoiceField which doesn't check the chosen object exists,
+    leaving that to the database's foreign key constraint. The cleaned
+    value is an instance with everything but the key deferred.
+    """
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if self.queryset.query.has_filters():
+            # the database can't enforce limit_choices_to for us
+            return super(DeferredModelChoiceField, self).to_python(value)
+        model = self.queryset.model
+        key = self.to_field_name or 'pk'
+        if isinstance(value, model):
+            value = getattr(value, key)
+        if key == 'pk':
+            field = model._meta.pk
+        else:
+            field = model._meta.get_field(key)
+        try:
+            value = field.to_python(value)
+        except forms.ValidationError:
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return model.from_db(self.queryset.db, [field.attname], [value])
+
+
+def defer_foreign_key_checks(form):
+    """
+    Switch a ModelForm's foreign key fields to DeferredModelChoiceField,
+    returning the names of the fields switched.
+    """
+    opts = form._meta.model._meta
+    deferred = []
+    for name, field in form.fields.items():
+        if type(field) is not forms.ModelChoiceField:
+            continue
+        try:
+            model_field = opts.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if isinstance(model_field, ForeignKey) and model_field.db_constraint:
+            field.__class__ = DeferredModelChoiceField
+            deferred.append(name)
+    return deferred
 
 
 class TransactionalMixin(object):
-    def tsave(self, convertors=None):
+    # Set this to skip Django's pre-save uniqueness queries (and, on
+    # Django 4.1+, its Meta.constraints queries) during validation,
+    # leaving the database as the single check. Violations then come
+    # back from .tsave() as the same field errors. Don't use this with
+    # a form that will be saved with plain .save().
+    trust_database = False
+    # Similarly, set this to skip the query per foreign key field that
+    # checks the chosen object exists. A missing object comes back from
+    # .tsave() as the field's "invalid choice" error.
+    trust_database_foreign_keys = False
+    # passed to transactional_save(); see there
+    tsave_savepoint = True
+    tsave_retry = None
+    tsave_defer_constraints = None
+    tsave_advisory_lock = False
+    tsave_advisory_lock_timeout = None
+    tsave_lock_timeout = None
+    tsave_statement_timeout = None
+    tsave_conflict_cache = None
+    _deferred_foreign_keys = ()
+
+    def __init__(self, *args, **kwargs):
+        super(TransactionalMixin, self).__init__(*args, **kwargs)
+        if self.trust_database_foreign_keys:
+            self._deferred_foreign_keys = defer_foreign_key_checks(self)
+
+    def prepare(self):
+        # Called by .tsave() before its transaction is opened. Override
+        # this to do slow work that doesn't need the database (hashing a
+        # password, resizing an upload, building related objects) here
+        # rather than in save(), so that the transaction, and any row
+        # locks it takes, are held for as short a time as possible.
+        # Raise ValidationError to stop the save.
+        pass
+
+    def tsave(self, convertors=None, retry=None, advisory_lock=None, advisory_lock_timeout=None, lock_timeout=None, statement_timeout=None, conflict_cache=None):
         # this allows you to override the behaviour, although since
         # it's pretty gnarly you may be better off not doing so
-        return transactional_save(self, convertors)
+        if retry is None:
+            retry = self.tsave_retry
+        if advisory_lock is None:
+            advisory_lock = self.tsave_advisory_lock
+        if advisory_lock_timeout is None:
+            advisory_lock_timeout = self.tsave_advisory_lock_timeout
+        if lock_timeout is None:
+            lock_timeout = self.tsave_lock_timeout
+        if statement_timeout is None:
+            statement_timeout = self.tsave_statement_timeout
+        if conflict_cache is None:
+            conflict_cache = self.tsave_conflict_cache
+        return transactional_save(
+            self, convertors,
+            check_constraints=self.trust_database_foreign_keys,
+            savepoint=self.tsave_savepoint,
+            retry=retry,
+            defer_constraints=self.tsave_defer_constraints,
+            advisory_lock=advisory_lock,
+            advisory_lock_timeout=advisory_lock_timeout,
+            lock_timeout=lock_timeout,
+            statement_timeout=statement_timeout,
+            prepare=self.prepare,
+            conflict_cache=conflict_cache,
+        )
+
+    def atsave(self, *args, **kwargs):
+        # awaitable tsave(), taking the same arguments, run on the async
+        # executor (see asynchronous.py)
+        from .asynchronous import run_in_executor
+        return run_in_executor(self.tsave, *args, **kwargs)
+
+    def _get_validation_exclusions(self):
+        exclude = super(TransactionalMixin, self)._get_validation_exclusions()
+        # model validation of a foreign key also checks it exists
+        if isinstance(exclude, set):
+            # Django 4.1+
+            return exclude | set(self._deferred_foreign_keys)
+        return list(exclude) + list(self._deferred_foreign_keys)
+
+    def validate_unique(self):
+        # unique checks involving deferred foreign keys still apply
+        exclude = super(TransactionalMixin, self)._get_validation_exclusions()
+        if not self.trust_database:
+            try:
+                self.instance.validate_unique(exclude=exclude)
+            except forms.ValidationError as e:
+                self._update_errors(e)
+            return
+        # the database enforces all of these except unique_for_date and
+        # friends, so they're all we check here
+        unique_checks, date_checks = self.instance._get_unique_checks(exclude=exclude)
+        errors = self.instance._perform_date_checks(date_checks)
+        if errors:
+            self._update_errors(forms.ValidationError(errors))
+
+    def _post_clean(self):
+        if not self.trust_database or not hasattr(self.instance, 'validate_constraints'):
+            return super(TransactionalMixin, self)._post_clean()
+        # Django 4.1+ validates Meta.constraints in full_clean()
+        self.instance.validate_constraints = lambda exclude=None: None
+        try:
+            return super(TransactionalMixin, self)._post_clean()
+        finally:
+            del self.instance.validate_constraints
+
+
+_trusting_form_classes = {}
+
+
+def trust_database_form(form_class):
+    """
+    A subclass of form_class (which must be a ModelForm) with
+    TransactionalMixin and trust_database set, created once per class.
+    """
+    trusting = _trusting_form_classes.get(form_class)
+    if trusting is None:
+        bases = (form_class,)
+        if not issubclass(form_class, TransactionalMixin):
+            bases = (TransactionalMixin,) + bases
+        trusting = type(form_class.__name__, bases, {'trust_database': True})
+        _trusting_form_classes[form_class] = trusting
+    return trusting
 
 
 class ModelForm(TransactionalMixin, forms.ModelForm):
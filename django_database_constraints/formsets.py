@@ -0,0 +1,233 @@
+"""
+Saving a whole model formset (or inline formset) in one transaction.
+
+Rather than a save, and so a round trip, per row, we write the rows in
+bulk: deletes, then a bulk_update of the changed rows, then a
+bulk_create of the new ones. If that raises an IntegrityError we need to
+know which rows were at fault, so we bisect: retry each half of the rows
+in a savepoint, keeping the halves that work, until we're down to the
+single rows that fail. That's about 2 * log2(rows) savepoints per
+failing row, rather than one per row every time.
+
+As with any bulk write, Model.save() isn't called for updated or created
+rows and pre_save and post_save aren't sent (except where we have to
+fall back to saving new rows one by one because the database can't tell
+us their primary keys from a bulk insert).
+"""
+from django import forms
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router, transaction, IntegrityError
+from django.forms.models import BaseModelFormSet as _BaseModelFormSet, BaseInlineFormSet as _BaseInlineFormSet
+from django.utils.encoding import force_str
+
+from .forms import (
+    DEFERRED, NO_SAVEPOINT, add_validationerror_to_form, check_deferred_constraints,
+    set_constraints, transaction_strategy, validationerror_from_integrityerror,
+)
+
+
+# what's to be done for a row
+DELETE = 'delete'
+UPDATE = 'update'
+INSERT = 'insert'
+
+
+class _RowsFailed(Exception):
+    pass
+
+
+class Row(object):
+    def __init__(self, form, instance, op, fields=()):
+        self.form = form
+        self.instance = instance
+        self.op = op
+        # the model fields to write, for UPDATE
+        self.fields = fields
+        # as it was before we wrote anything
+        self.state = (instance.pk, instance._state.adding)
+
+    def restore(self):
+        # after a rollback: creating sets the primary key, and deleting
+        # clears it
+        self.instance.pk, self.instance._state.adding = self.state
+
+
+def _can_return_rows_from_bulk_insert(connection):
+    features = connection.features
+    # renamed in Django 3.0
+    return getattr(
+        features, 'can_return_rows_from_bulk_insert',
+        getattr(features, 'can_return_ids_from_bulk_insert', False),
+    )
+
+
+def updated_fields(opts, changed_data):
+    """The model fields an UPDATE must write for a form's changed_data."""
+    fields = []
+    for name in changed_data:
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if getattr(field, 'concrete', False) and not field.primary_key and not field.many_to_many:
+            fields.append(field.name)
+    return fields
+
+
+def formset_rows(formset):
+    """
+    Run formset.save(commit=False) and return a Row for each object it
+    would delete, update or insert, in that order.
+    """
+    formset.save(commit=False)
+    forms_by_instance = dict((id(form.instance), form) for form in formset.forms)
+    opts = formset.model._meta
+    rows = []
+    for obj in formset.deleted_objects:
+        rows.append(Row(forms_by_instance.get(id(obj)), obj, DELETE))
+    for obj, changed_data in formset.changed_objects:
+        rows.append(Row(forms_by_instance.get(id(obj)), obj, UPDATE, updated_fields(opts, changed_data)))
+    for obj in formset.new_objects:
+        rows.append(Row(forms_by_instance.get(id(obj)), obj, INSERT))
+    return rows
+
+
+def write_rows(rows, using, batch_size=None):
+    """Write rows with as few statements as we can."""
+    connection = connections[using]
+    deletes = [row for row in rows if row.op == DELETE]
+    updates = [row for row in rows if row.op == UPDATE]
+    inserts = [row for row in rows if row.op == INSERT]
+    for row in deletes:
+        # through the collector, for cascades and signals
+        row.instance.delete(using=using)
+    if updates:
+        fields = set()
+        for row in updates:
+            fields.update(row.fields)
+        queryset = type(updates[0].instance)._base_manager.using(using)
+        if not fields:
+            pass
+        elif hasattr(queryset, 'bulk_update'):
+            queryset.bulk_update(
+                [row.instance for row in updates], sorted(fields), batch_size=batch_size,
+            )
+        else:
+            # before Django 2.2
+            for row in updates:
+                row.instance.save(update_fields=row.fields, using=using)
+    if inserts:
+        model = type(inserts[0].instance)
+        if _can_return_rows_from_bulk_insert(connection) and not model._meta.parents:
+            model._base_manager.using(using).bulk_create(
+                [row.instance for row in inserts], batch_size=batch_size,
+            )
+        else:
+            # we need the primary keys, for save_m2m and to hand back
+            for row in inserts:
+                row.instance.save(force_insert=True, using=using)
+
+
+def bisect_failures(rows, using, batch_size=None, check_constraints=False, defer_constraints=None):
+    """
+    Write rows, each half in a savepoint of its own, recursing into
+    halves that fail. Return (row, IntegrityError) for the rows that
+    fail on their own (given the rows before them).
+
+    defer_constraints are deferred while writing, and checked at the end
+    of each step.
+    """
+    connection = connections[using]
+    # if the transaction isn't ours, the COMMIT won't check them
+    nested = connection.in_atomic_block
+    try:
+        with transaction.atomic(using=using):
+            set_constraints(connection, defer_constraints, DEFERRED)
+            write_rows(rows, using, batch_size)
+            if nested:
+                check_deferred_constraints(connection, defer_constraints)
+            if check_constraints:
+                connection.check_constraints()
+        return []
+    except IntegrityError as e:
+        for row in rows:
+            row.restore()
+        if len(rows) == 1:
+            return [(rows[0], e)]
+        middle = len(rows) // 2
+        return (
+            bisect_failures(rows[:middle], using, batch_size, check_constraints, defer_constraints) +
+            bisect_failures(rows[middle:], using, batch_size, check_constraints, defer_constraints)
+        )
+
+
+def transactional_formset_save(formset, convertors=None, check_constraints=False, savepoint=True, batch_size=None, defer_constraints=None):
+    # The formset equivalent of forms.transactional_save(): save every
+    # row in one transaction (or savepoint, if we're inside someone
+    # else's), converting IntegrityErrors into errors on the forms of
+    # the rows that caused them. If any row fails, nothing is saved and
+    # we raise a ValidationError with all the messages.
+    #
+    # check_constraints, savepoint and defer_constraints are as for
+    # transactional_save(); note that since we always need a savepoint
+    # around the bulk write so we can bisect it, savepoint=False only
+    # saves the outer one, and deferred constraints are checked before
+    # each savepoint is released.
+    model = formset.model
+    using = router.db_for_write(model)
+    connection = connections[using]
+    strategy = transaction_strategy(connection, savepoint)
+    formset.transaction_strategy = strategy
+
+    rows = formset_rows(formset)
+    failures = []
+    try:
+        with transaction.atomic(using=using, savepoint=strategy != NO_SAVEPOINT):
+            failures = bisect_failures(rows, using, batch_size, check_constraints, defer_constraints)
+            if failures:
+                # roll back the rows that did work
+                raise _RowsFailed()
+            formset.save_m2m()
+    except (IntegrityError, _RowsFailed) as e:
+        for row in rows:
+            row.restore()
+        if not failures:
+            # from the commit, so we can't tell which row it was
+            failures = [(None, e)]
+        errors = []
+        for row, ierror in failures:
+            if row is None or row.form is None:
+                v = validationerror_from_integrityerror(ierror, convertors)
+                for message in v.messages:
+                    formset.non_form_errors().append(force_str(message))
+            else:
+                v = validationerror_from_integrityerror(ierror, convertors, row.instance, using)
+                add_validationerror_to_form(row.form, v)
+            errors.append(v)
+        raise forms.ValidationError(errors)
+    return list(formset.new_objects) + [obj for obj, changed in formset.changed_objects]
+
+
+class TransactionalFormSetMixin(object):
+    # passed to transactional_formset_save(); see there
+    tsave_savepoint = True
+    tsave_check_constraints = False
+    tsave_batch_size = None
+    tsave_defer_constraints = None
+
+    def tsave(self, convertors=None):
+        return transactional_formset_save(
+            self, convertors,
+            check_constraints=self.tsave_check_constraints,
+            savepoint=self.tsave_savepoint,
+            batch_size=self.tsave_batch_size,
+            defer_constraints=self.tsave_defer_constraints,
+        )
+
+
+class BaseModelFormSet(TransactionalFormSetMixin, _BaseModelFormSet):
+    pass
+
+
+class BaseInlineFormSet(TransactionalFormSetMixin, _BaseInlineFormSet):
+    pass
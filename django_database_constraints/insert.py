@@ -0,0 +1,174 @@
+"""
+Inserting rows without letting a unique constraint violation fail the
+statement.
+
+For create-or-reject flows on hot keys most of the cost of a conflict is
+the failed INSERT, the rollback and the exception handling. Instead we
+can ask the database to skip the row on a conflict (`ON CONFLICT DO
+NOTHING` on postgresql and sqlite, `INSERT IGNORE` on mysql), notice
+that nothing was inserted, and only then go looking for the row we
+conflicted with.
+
+INSERT IGNORE also turns every other error the INSERT could raise
+(foreign key, NOT NULL and CHECK violations, values that don't fit)
+into a warning, and inserts the row anyway with its values coerced to
+fit. So on mysql we read the warnings back, and raise anything other
+than a duplicate key as the error it would have been.
+"""
+from django import forms
+from django.db import connections, router, DataError, IntegrityError
+from django.db.models import Q, signals
+from django.db.models.sql import InsertQuery
+
+from . import backends, constraints
+from .forms import RETRY_MESSAGE, validationerror_from_constraint
+
+
+# the mysql warnings that would have been errors without IGNORE
+_MYSQL_INTEGRITY_ERRORS = frozenset([
+    backends.MySQLDecoder.ER_NO_REFERENCED_ROW,
+    backends.MySQLDecoder.ER_NO_REFERENCED_ROW_2,
+    backends.MySQLDecoder.ER_ROW_IS_REFERENCED,
+    backends.MySQLDecoder.ER_ROW_IS_REFERENCED_2,
+    backends.MySQLDecoder.ER_BAD_NULL_ERROR,
+    backends.MySQLDecoder.ER_CHECK_CONSTRAINT_VIOLATED,
+])
+
+
+def _ignore_conflicts_sql(connection, sql):
+    if connection.vendor == 'mysql':
+        # see _check_mysql_warnings()
+        return sql.replace('INSERT INTO', 'INSERT IGNORE INTO', 1)
+    elif connection.vendor == 'sqlite' and connection.Database.sqlite_version_info < (3, 24, 0):
+        # this also skips rows violating NOT NULL and CHECK constraints,
+        # which then look like conflicts we can't find
+        return sql.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+    return '%s ON CONFLICT DO NOTHING' % sql
+
+
+def _check_mysql_warnings(connection, cursor):
+    # raise the first warning from INSERT IGNORE other than a duplicate
+    # key, so that the transaction is rolled back rather than keeping a
+    # row with coerced values. The count comes back with the INSERT, so
+    # this is only another round trip if there's something to see.
+    if not connection.connection.warning_count():
+        return
+    cursor.execute('SHOW WARNINGS')
+    for level, code, message in cursor.fetchall():
+        if code == backends.MySQLDecoder.ER_DUP_ENTRY:
+            continue
+        if code in _MYSQL_INTEGRITY_ERRORS:
+            raise IntegrityError(code, message)
+        raise DataError(code, message)
+
+
+def insert_ignoring_conflicts(obj, using=None):
+    """
+    INSERT obj, unless that would violate a unique constraint. Return
+    True (setting obj's primary key if needed) if we inserted it.
+    """
+    model = type(obj)
+    opts = model._meta
+    if opts.parents:
+        raise ValueError("Can't insert multi-table inherited models ignoring conflicts.")
+    if using is None:
+        using = router.db_for_write(model, instance=obj)
+    connection = connections[using]
+
+    fields = opts.local_concrete_fields
+    if obj.pk is None:
+        fields = [f for f in fields if f is not opts.auto_field]
+    query = InsertQuery(model)
+    query.insert_values(fields, [obj])
+    [(sql, params)] = query.get_compiler(using=using).as_sql()
+    sql = _ignore_conflicts_sql(connection, sql)
+    returning = connection.features.can_return_columns_from_insert
+    if returning:
+        returning_sql, returning_params = connection.ops.return_insert_columns([opts.pk])
+        sql = '%s %s' % (sql, returning_sql)
+        params = tuple(params) + tuple(returning_params)
+
+    signals.pre_save.send(sender=model, instance=obj, raw=False, using=using, update_fields=None)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        if returning:
+            row = cursor.fetchone()
+            inserted = row is not None
+            pk = row[0] if inserted else None
+        else:
+            inserted = cursor.rowcount != 0
+            pk = connection.ops.last_insert_id(cursor, opts.db_table, opts.pk.column) if inserted else None
+        if connection.vendor == 'mysql':
+            # after we've read what the INSERT did, which this replaces
+            _check_mysql_warnings(connection, cursor)
+    if not inserted:
+        return False
+    if obj.pk is None:
+        setattr(obj, opts.pk.attname, pk)
+    obj._state.adding = False
+    obj._state.db = using
+    signals.post_save.send(sender=model, instance=obj, created=True, update_fields=None, raw=False, using=using)
+    return True
+
+
+def find_conflict(obj, using=None):
+    """
+    Find the existing row obj conflicts with on a unique constraint,
+    returning it and the unique check (a model class and field names, as
+    from Model._get_unique_checks()) or (None, None). This looks on the
+    database obj would be written to, so that inside the transaction
+    that failed to insert it, it sees what the INSERT did.
+    """
+    model = type(obj)
+    if using is None:
+        using = router.db_for_write(model, instance=obj)
+    unique_checks, date_checks = obj._get_unique_checks()
+    checks = []
+    q = Q()
+    for model_class, unique_check in unique_checks:
+        lookup = {}
+        for field_name in unique_check:
+            field = model_class._meta.get_field(field_name)
+            value = getattr(obj, field.attname)
+            if value is None:
+                break
+            lookup[str(field_name)] = value
+        else:
+            checks.append((model_class, unique_check, lookup))
+            q |= Q(**lookup)
+    if not checks:
+        return None, None
+    for existing in model._base_manager.using(using).filter(q)[:1]:
+        for model_class, unique_check, lookup in checks:
+            if all(
+                getattr(existing, model_class._meta.get_field(f).attname) == v
+                for f, v in lookup.items()
+            ):
+                return existing, (model_class, unique_check)
+    return None, None
+
+
+def insert_form(form, return_existing=False, using=None):
+    """
+    Save a ModelForm for a new object ignoring conflicts. On a conflict,
+    raise the same ValidationError as a unique constraint violation
+    would give, or with return_existing return the existing row.
+    """
+    obj = form.save(commit=False)
+    if using is None:
+        # the same for the INSERT and for finding what it conflicted with
+        using = router.db_for_write(type(obj), instance=obj)
+    if insert_ignoring_conflicts(obj, using):
+        form.save_m2m()
+        return obj
+    existing, unique_check = find_conflict(obj, using)
+    if existing is None:
+        # gone again already, or (on mysql) something other than a
+        # unique constraint stopped the INSERT
+        raise forms.ValidationError(RETRY_MESSAGE, code='retry')
+    if return_existing:
+        form.instance = existing
+        return existing
+    model_class, fields = unique_check
+    constraint = constraints.ConstraintInfo(None, model_class, tuple(fields), constraints.UNIQUE, None)
+    raise validationerror_from_constraint(constraint, obj)
@@ -0,0 +1,159 @@
+"""
+Advisory locks on the values of an instance's unique fields.
+
+When lots of requests race to create the same row, all but one will do
+all their work only to fail on the INSERT and roll back. If instead each
+takes a lock keyed on the unique values first, the losers wait cheaply
+for the winner to commit, and can then see the row it created (or give
+up once they've waited long enough).
+
+On postgresql we use transaction-scoped advisory locks
+(pg_advisory_xact_lock), which are released when the transaction ends.
+On mysql we use GET_LOCK, which is held by the connection, so must be
+released explicitly once the transaction is over. Other databases don't
+have advisory locks, and we do nothing.
+"""
+import hashlib
+import json
+import math
+import struct
+
+from django.db import DatabaseError
+from django.utils.encoding import force_str
+
+from . import backends
+
+
+class LockTimeout(Exception):
+    """We waited as long as we were allowed for an advisory lock."""
+
+
+def lock_keys(instance):
+    """
+    Signed 64 bit keys (as postgresql wants) for the values of each of
+    instance's unique checks, excluding its primary key, in the order
+    they should be taken.
+    """
+    unique_checks, date_checks = instance._get_unique_checks()
+    pk_name = instance._meta.pk.name
+    keys = set()
+    for model_class, unique_check in unique_checks:
+        if tuple(unique_check) == (pk_name,):
+            # updates to a row already queue on its row lock
+            continue
+        values = []
+        for field_name in unique_check:
+            field = model_class._meta.get_field(field_name)
+            value = getattr(instance, field.attname)
+            if value is None:
+                # NULLs never conflict
+                break
+            values.append([field_name, force_str(value)])
+        else:
+            text = json.dumps([model_class._meta.db_table, values])
+            digest = hashlib.sha1(text.encode('utf-8')).digest()
+            keys.add(struct.unpack('>q', digest[:8])[0])
+    # always in the same order, so two savers can't deadlock
+    return sorted(keys)
+
+
+def _mysql_name(key):
+    # GET_LOCK names are per server, not per database
+    return 'django_database_constraints:%016x' % (key & 0xffffffffffffffff)
+
+
+def _postgresql_acquire(connection, keys, timeout):
+    with connection.cursor() as cursor:
+        # first without waiting, which is all we need most of the time,
+        # and one at a time, so that we never hold a later key while
+        # waiting for an earlier one (which could deadlock)
+        for i, key in enumerate(keys):
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [key])
+            if not cursor.fetchone()[0]:
+                missing = keys[i:]
+                break
+        else:
+            return False
+        if timeout == 0:
+            raise LockTimeout()
+        # unnest() produces the keys in order, and each is locked as its
+        # row is produced
+        locks_sql = 'SELECT count(pg_advisory_xact_lock(k)) FROM unnest(%s::bigint[]) AS k'
+        try:
+            if timeout is None:
+                cursor.execute(locks_sql, [missing])
+            else:
+                # lock_timeout only for this statement, since it's SET
+                # LOCAL and we put it back afterwards
+                cursor.execute(
+                    "SELECT current_setting('lock_timeout'), set_config('lock_timeout', %s, true)",
+                    ['%dms' % max(1, int(timeout * 1000))],
+                )
+                previous = cursor.fetchone()[0]
+                cursor.execute(
+                    "SELECT set_config('lock_timeout', %%s, true) FROM (%s) AS locked" % locks_sql,
+                    [previous, missing],
+                )
+        except DatabaseError as e:
+            info = backends.decode(e, connection.alias)
+            if info is not None and info.kind == backends.LOCKED:
+                raise LockTimeout()
+            raise
+    return True
+
+
+def _mysql_release(connection, names):
+    if not names:
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT %s' % ', '.join(['RELEASE_LOCK(%s)'] * len(names)),
+                names,
+            )
+    except DatabaseError:
+        # if the connection has gone, so have its locks
+        pass
+
+
+def _mysql_acquire(connection, keys, timeout):
+    names = [_mysql_name(key) for key in keys]
+    held = []
+    contended = False
+    try:
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute('SELECT GET_LOCK(%s, 0)', [name])
+                if cursor.fetchone()[0] != 1:
+                    contended = True
+                    if timeout == 0:
+                        raise LockTimeout()
+                    cursor.execute(
+                        'SELECT GET_LOCK(%s, %s)',
+                        [name, -1 if timeout is None else int(math.ceil(timeout))],
+                    )
+                    if cursor.fetchone()[0] != 1:
+                        raise LockTimeout()
+                held.append(name)
+    except BaseException:
+        _mysql_release(connection, held)
+        raise
+    return contended, lambda: _mysql_release(connection, held)
+
+
+def acquire(connection, keys, timeout=None):
+    """
+    Take advisory locks on keys, within the current transaction,
+    waiting at most timeout seconds (forever if None, not at all if 0)
+    before raising LockTimeout.
+
+    Returns (contended, release): whether we had to wait for anyone, and
+    a function to call once the transaction is over (or None).
+    """
+    if not keys:
+        return False, None
+    if connection.vendor == 'postgresql':
+        return _postgresql_acquire(connection, keys, timeout), None
+    elif connection.vendor == 'mysql':
+        return _mysql_acquire(connection, keys, timeout)
+    return False, None
@@ -0,0 +1,51 @@
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ...audit import audit
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the checks Django makes in Python when validating models with "
+        "the database's constraints, reporting redundant validation queries and "
+        "unenforced (race-prone) invariants as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'app_label', nargs='*',
+            help='Only audit the models of these apps.',
+        )
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='The database to introspect. Defaults to the "default" database.',
+        )
+        parser.add_argument(
+            '--indent', type=int, default=None,
+            help='Indent the JSON output by this many spaces.',
+        )
+        parser.add_argument(
+            '--fail-on-unenforced', action='store_true',
+            help='Exit with an error if any invariant is unenforced by the database.',
+        )
+
+    def handle(self, *args, **options):
+        app_labels = options['app_label']
+        if app_labels:
+            try:
+                model_list = [
+                    model
+                    for label in app_labels
+                    for model in apps.get_app_config(label).get_models()
+                ]
+            except LookupError as e:
+                raise CommandError(str(e))
+        else:
+            model_list = apps.get_models()
+        report = audit(model_list, connections[options['database']])
+        self.stdout.write(json.dumps(report, indent=options['indent'], sort_keys=True))
+        if options['fail_on_unenforced'] and report['unenforced']:
+            raise CommandError('%d invariants are not enforced by the database.' % report['unenforced'])
@@ -0,0 +1,156 @@
+"""
+An in-process collector for the signals in signals.py.
+
+This aggregates as it goes (so memory use doesn't grow with traffic),
+and is cheap enough to leave connected in production. Take a
+snapshot() periodically and ship it wherever you keep your metrics, or
+just look at it to find out which constraints are contended.
+"""
+import threading
+
+from . import signals
+
+
+class _Timing(object):
+    __slots__ = ['count', 'total', 'max']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+        }
+
+
+def _hit_rate(hits, misses):
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0,
+    }
+
+
+def _label(model):
+    if model is None:
+        return None
+    opts = getattr(model, '_meta', None)
+    if opts is not None and hasattr(opts, 'label'):
+        return opts.label
+    return '%s.%s' % (model.__module__, model.__name__)
+
+
+class StatsCollector(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def connect(self):
+        signals.transactional_save_finished.connect(self.save_finished, dispatch_uid=id(self))
+        signals.transactional_form_valid_finished.connect(self.form_valid_finished, dispatch_uid=id(self))
+        return self
+
+    def disconnect(self):
+        signals.transactional_save_finished.disconnect(dispatch_uid=id(self))
+        signals.transactional_form_valid_finished.disconnect(dispatch_uid=id(self))
+
+    def reset(self):
+        with self._lock:
+            # model label -> outcome -> count
+            self._outcomes = {}
+            # model label -> _Timing
+            self._transaction_times = {}
+            self._conversion_times = {}
+            self._lock_wait_times = {}
+            self._prepare_times = {}
+            # model label -> [conflict cache hits, misses]
+            self._conflict_cache = {}
+            # (model label, constraint name) -> count
+            self._constraints = {}
+            # model label -> count of extra attempts (ie retries)
+            self._retries = {}
+            # view label -> outcome -> count, and view label -> _Timing
+            self._view_outcomes = {}
+            self._view_times = {}
+
+    def save_finished(self, sender, outcome, attempts, transaction_time, conversion_time, constraint_name=None, model=None, lock_wait_time=None, prepare_time=None, conflict_cache_hit=None, **kwargs):
+        label = _label(sender)
+        with self._lock:
+            outcomes = self._outcomes.setdefault(label, {})
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            self._transaction_times.setdefault(label, _Timing()).add(transaction_time)
+            if attempts > 1:
+                self._retries[label] = self._retries.get(label, 0) + attempts - 1
+            if conversion_time:
+                self._conversion_times.setdefault(label, _Timing()).add(conversion_time)
+            if lock_wait_time is not None:
+                self._lock_wait_times.setdefault(label, _Timing()).add(lock_wait_time)
+            if prepare_time is not None:
+                self._prepare_times.setdefault(label, _Timing()).add(prepare_time)
+            if conflict_cache_hit is not None:
+                counts = self._conflict_cache.setdefault(label, [0, 0])
+                counts[0 if conflict_cache_hit else 1] += 1
+            if constraint_name is not None:
+                key = (_label(model) or label, constraint_name)
+                self._constraints[key] = self._constraints.get(key, 0) + 1
+
+    def form_valid_finished(self, sender, outcome, time, **kwargs):
+        label = _label(sender)
+        with self._lock:
+            outcomes = self._view_outcomes.setdefault(label, {})
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            self._view_times.setdefault(label, _Timing()).add(time)
+
+    def snapshot(self):
+        """A JSON-serialisable copy of everything collected so far."""
+        with self._lock:
+            return {
+                'saves': dict(
+                    (label, {
+                        'outcomes': dict(outcomes),
+                        'retries': self._retries.get(label, 0),
+                        'transaction_time': self._transaction_times[label].as_dict(),
+                        'conversion_time': (
+                            self._conversion_times[label].as_dict()
+                            if label in self._conversion_times else None
+                        ),
+                        'lock_wait_time': (
+                            self._lock_wait_times[label].as_dict()
+                            if label in self._lock_wait_times else None
+                        ),
+                        'prepare_time': (
+                            self._prepare_times[label].as_dict()
+                            if label in self._prepare_times else None
+                        ),
+                        'conflict_cache': (
+                            _hit_rate(*self._conflict_cache[label])
+                            if label in self._conflict_cache else None
+                        ),
+                    })
+                    for label, outcomes in self._outcomes.items()
+                ),
+                'constraints': [
+                    {'model': model, 'constraint': name, 'count': count}
+                    for (model, name), count in sorted(
+                        self._constraints.items(), key=lambda item: -item[1],
+                    )
+                ],
+                'views': dict(
+                    (label, {
+                        'outcomes': dict(outcomes),
+                        'time': self._view_times[label].as_dict(),
+                    })
+                    for label, outcomes in self._view_outcomes.items()
+                ),
+            }
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-16 19:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('object_pk', models.CharField(blank=True, max_length=255)),
+                ('location', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections, models, router, transaction, IntegrityError, OperationalError
+from django.utils import timezone
+
+from . import backends
+from .forms import (
+    NO_SAVEPOINT, TRANSACTION, transaction_strategy,
+    validationerror_from_integrityerror, validationerror_from_operationalerror,
+)
+from .formsets import INSERT, UPDATE, Row, bisect_failures
+
+
+# how long to remember idempotency keys for, in seconds, by default
+DEFAULT_IDEMPOTENCY_KEY_AGE = 24 * 60 * 60
+
+
+class IdempotencyKeyManager(models.Manager):
+    def expire(self, max_age=None):
+        """
+        Forget keys older than max_age (a timedelta, or by default the
+        DATABASE_CONSTRAINTS_IDEMPOTENCY_KEY_AGE setting in seconds),
+        with a single DELETE. Run this periodically (say from cron),
+        rather than on every request. Returns how many were deleted.
+        """
+        if max_age is None:
+            max_age = datetime.timedelta(seconds=getattr(
+                settings, 'DATABASE_CONSTRAINTS_IDEMPOTENCY_KEY_AGE', DEFAULT_IDEMPOTENCY_KEY_AGE,
+            ))
+        deleted, per_model = self.filter(created__lt=timezone.now() - max_age).delete()
+        return deleted
+
+
+class IdempotencyKey(models.Model):
+    """
+    A form submission we've saved, by its idempotency key, so that
+    repeats can be given the same outcome rather than saved again (see
+    views.TransactionalModelFormMixin).
+    """
+    # digest of the key and where it was used (see digest())
+    key = models.CharField(max_length=40, unique=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    # what the first submission did
+    object_pk = models.CharField(max_length=255, blank=True)
+    location = models.TextField(blank=True)
+
+    objects = IdempotencyKeyManager()
+
+    @staticmethod
+    def digest(scope, key):
+        """
+        A fixed length key for key as used in scope (a list of strings),
+        so that clients can't collide with each other's keys.
+        """
+        text = json.dumps([list(scope), key])
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TransactionalModelMixin(object):
+    """
+    Adds .tsave() to a model, for saving outside forms: .save() in a
+    transaction of its own (or a savepoint, inside someone else's), with
+    an IntegrityError converted into a ValidationError attributed to the
+    fields involved, just as for forms.
+    """
+
+    def tsave(self, convertors=None, using=None, savepoint=True, retry=None, **kwargs):
+        # convertors, savepoint and retry are as for
+        # forms.transactional_save(); anything else is passed to save()
+        if using is None:
+            using = router.db_for_write(type(self), instance=self)
+        strategy = transaction_strategy(connections[using], savepoint)
+        if retry is not None and strategy == TRANSACTION:
+            delays = retry.delays()
+        else:
+            delays = iter(())
+        # so a failed insert doesn't leave us looking saved
+        state = (self.pk, self._state.adding)
+        while True:
+            try:
+                with transaction.atomic(using=using, savepoint=strategy != NO_SAVEPOINT):
+                    self.save(using=using, **kwargs)
+                return
+            except IntegrityError as e:
+                self.pk, self._state.adding = state
+                raise validationerror_from_integrityerror(e, convertors, self, using)
+            except OperationalError as e:
+                if retry is None or not backends.is_retryable(e, using):
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    raise validationerror_from_operationalerror(e)
+                self.pk, self._state.adding = state
+                retry.sleep(delay)
+
+
+class BulkSaveResult(namedtuple('BulkSaveResult', ['obj', 'error'])):
+    """
+    What bulk_tsave() did with obj: error is None if it was saved, or
+    the ValidationError saying why it wasn't.
+    """
+    __slots__ = ()
+
+    @property
+    def saved(self):
+        return self.error is None
+
+
+class TransactionalQuerySet(models.QuerySet):
+    def bulk_tsave(self, objs, batch_size=None, convertors=None, check_constraints=True):
+        """
+        Save objs (inserting new ones and updating the rest) with as few
+        statements as we can, batch_size at a time, each batch in a
+        transaction. A row that violates a constraint doesn't stop the
+        others being saved: we find it by bisecting (as for formsets)
+        and report it. Returns a BulkSaveResult for each object, in
+        order.
+
+        Deferred constraints (such as Django's foreign keys on
+        postgresql) are checked at each step of the bisection, so they
+        can be attributed to rows too, unless check_constraints is
+        False; a violation then fails the batch's COMMIT, and we go
+        through that batch again checking them.
+
+        As with any bulk write, save() isn't called and pre_save and
+        post_save aren't sent, and updates write every field.
+        """
+        objs = list(objs)
+        using = self._db or router.db_for_write(self.model)
+        fields = [f.name for f in self.model._meta.concrete_fields if not f.primary_key]
+        rows = [
+            Row(None, obj, INSERT if obj._state.adding else UPDATE, fields)
+            for obj in objs
+        ]
+        errors = {}
+        chunk = batch_size or len(rows) or 1
+        for start in range(0, len(rows), chunk):
+            batch = rows[start:start + chunk]
+            try:
+                errors.update(_bulk_tsave_batch(batch, using, batch_size, convertors, check_constraints))
+            except IntegrityError as e:
+                for row in batch:
+                    row.restore()
+                if check_constraints:
+                    # we checked, and it still failed, so we can't tell
+                    # which row it was
+                    for row in batch:
+                        errors[id(row)] = validationerror_from_integrityerror(e, convertors, row.instance, using)
+                else:
+                    errors.update(_bulk_tsave_batch(batch, using, batch_size, convertors, True))
+        return [BulkSaveResult(row.instance, errors.get(id(row))) for row in rows]
+
+
+def _bulk_tsave_batch(rows, using, batch_size, convertors, check_constraints):
+    # the errors for rows that fail, by id(row)
+    with transaction.atomic(using=using):
+        failures = bisect_failures(rows, using, batch_size, check_constraints)
+        return dict(
+            (id(row), validationerror_from_integrityerror(ierror, convertors, row.instance, using))
+            for row, ierror in failures
+        )
+
+
+class TransactionalManager(models.Manager.from_queryset(TransactionalQuerySet)):
+    pass
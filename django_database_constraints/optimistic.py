@@ -0,0 +1,96 @@
+"""
+Optimistic concurrency control for updates.
+
+Rather than locking a row for as long as someone is editing it, we carry
+the value of a version field (an integer, or a timestamp) in the form,
+and make the UPDATE conditional on it still being the same:
+
+    UPDATE ... SET ..., version = version + 1 WHERE id = %s AND version = %s
+
+If that updates nothing, someone else has changed (or deleted) the row
+since the form was rendered, and rather than overwriting their changes
+we give the form an error. That's one round trip, and no locks held
+between requests.
+"""
+from django import forms
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+from django.db.models import DateTimeField, F, IntegerField, signals
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+CONFLICT_MESSAGE = _(
+    'This %(model_name)s has been changed by someone else since you started '
+    'editing it. Please reload it and make your changes again.'
+)
+
+
+def _version_field(model, version_field):
+    field = model._meta.get_field(version_field)
+    if not isinstance(field, (IntegerField, DateTimeField)):
+        raise ImproperlyConfigured(
+            "%s.%s must be an integer or datetime field to use as a version." % (
+                model._meta.object_name, version_field,
+            )
+        )
+    return field
+
+
+def add_version_field(form, version_field):
+    """
+    Carry the instance's version in a hidden field on form (replacing
+    any field of that name the form has already).
+    """
+    field = _version_field(form._meta.model, version_field)
+    form.fields[version_field] = forms.CharField(widget=forms.HiddenInput)
+    # as a string, so timestamps keep their microseconds
+    form.initial[version_field] = field.value_to_string(form.instance)
+
+
+def versioned_save(form, version_field, using=None):
+    """
+    Save form's (existing) instance with a single UPDATE conditional on
+    the version the form was rendered with, raising a ValidationError if
+    the row has changed since.
+    """
+    instance = form.save(commit=False)
+    model = type(instance)
+    opts = model._meta
+    if opts.parents:
+        raise ValueError("Can't do versioned saves of multi-table inherited models.")
+    if instance.pk is None or instance._state.adding:
+        raise ValueError("Versioned saves are only for existing objects.")
+    if using is None:
+        using = router.db_for_write(model, instance=instance)
+    field = _version_field(model, version_field)
+    seen = field.to_python(form.cleaned_data[version_field])
+    if isinstance(field, IntegerField):
+        new_version = F(field.attname) + 1
+    else:
+        new_version = timezone.now()
+
+    signals.pre_save.send(sender=model, instance=instance, raw=False, using=using, update_fields=None)
+    values = [
+        (f, None, f.pre_save(instance, False))
+        for f in opts.local_concrete_fields
+        if not f.primary_key and f is not field
+    ]
+    values.append((field, None, new_version))
+    updated = model._base_manager.using(using).filter(
+        **{ 'pk': instance.pk, field.attname: seen }
+    )._update(values)
+    if not updated:
+        raise forms.ValidationError(
+            CONFLICT_MESSAGE,
+            code='conflict',
+            params={'model_name': opts.verbose_name},
+        )
+    if isinstance(field, IntegerField):
+        setattr(instance, field.attname, seen + 1)
+    else:
+        setattr(instance, field.attname, new_version)
+    instance._state.db = using
+    signals.post_save.send(sender=model, instance=instance, created=False, update_fields=None, raw=False, using=using)
+    form.save_m2m()
+    return instance
@@ -0,0 +1,52 @@
+"""
+Retrying transactions which failed because of contention.
+
+Serialization failures, deadlocks and lock timeouts aren't the fault of
+the data being saved: the same transaction run again a moment later
+will often succeed. A RetryPolicy says how many times to try, how long
+to back off in between and how long to keep trying for in total.
+"""
+import random
+import time
+
+try:
+    from time import monotonic
+except ImportError: #pragma no cover
+    # python 2
+    from time import time as monotonic
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=3, initial_delay=0.05, max_delay=1.0, multiplier=2, budget=None, sleep=time.sleep):
+        # budget is the total time in seconds (measured from the first
+        # attempt) after which we won't start another attempt
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.budget = budget
+        self.sleep = sleep
+
+    def delays(self):
+        """
+        Yield the time to wait before each retry, stopping when we're out
+        of attempts or the next attempt would start after the budget.
+        Call this just before the first attempt, since that's when the
+        budget starts.
+        """
+        # now, rather than when the generator is first resumed (after
+        # the first attempt has failed)
+        return self._delays(monotonic())
+
+    def _delays(self, start):
+        delay = self.initial_delay
+        for _ in range(1, self.max_attempts):
+            # "full jitter", so racing retries spread out
+            wait = random.uniform(0, delay)
+            if self.budget is not None and monotonic() - start + wait > self.budget:
+                return
+            yield wait
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
+DEFAULT_RETRY = RetryPolicy()
@@ -0,0 +1,215 @@
+"""
+Side effects (calls to external services, emails, cache updates) kept
+out of the database transaction.
+
+Calling an external service from inside save() means the transaction,
+its row locks and its connection are held open for as long as the call
+takes, and that the call has happened even if the transaction then
+fails. Instead, pass a SideEffects as transactional_save()'s
+tx_context_manager and register the calls with it during save(): they
+are run after the transaction commits, on a bounded pool of threads, so
+neither the transaction nor the request waits for them. Anything save()
+has to do externally itself can register a compensation, which is run
+only if the transaction is rolled back.
+
+This needs Python 3.2 or later, so it isn't imported by the rest of the
+package.
+"""
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+
+logger = logging.getLogger(__name__)
+
+# threads in the pool
+DEFAULT_WORKERS = 4
+# side effects waiting or running before anyone adding more has to wait
+DEFAULT_MAX_PENDING = 1000
+
+
+class SideEffectPool(object):
+    """
+    A bounded pool of threads for running side effects. Once max_pending
+    are queued or running, submit() blocks until one finishes, so a slow
+    service pushes back on whoever is producing the work rather than
+    letting the queue grow without limit.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        if workers is None:
+            workers = getattr(settings, 'DATABASE_CONSTRAINTS_SIDE_EFFECT_WORKERS', DEFAULT_WORKERS)
+        if max_pending is None:
+            max_pending = getattr(settings, 'DATABASE_CONSTRAINTS_SIDE_EFFECT_MAX_PENDING', DEFAULT_MAX_PENDING)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='django_database_constraints_side_effects',
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, func, timeout=None):
+        """
+        Run func on the pool, waiting at most timeout seconds (forever
+        if None) for room. Returns a Future, or None if there wasn't room.
+        """
+        if not self._slots.acquire(True, timeout):
+            return None
+        try:
+            future = self.executor.submit(self._run, func)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _run(self, func):
+        # as for a request: don't start with, or leave behind, a
+        # connection that's broken or past CONN_MAX_AGE
+        close_old_connections()
+        try:
+            return _call(func)
+        finally:
+            close_old_connections()
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def drain(self, timeout=None):
+        """
+        Wait at most timeout seconds for everything submitted so far to
+        finish. Returns True if it did.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        done, not_done = wait(pending, timeout)
+        return not not_done
+
+    def shutdown(self, wait=True):
+        """Drain (if wait) and stop the threads."""
+        self.executor.shutdown(wait=wait)
+
+
+def _call(func):
+    try:
+        return func()
+    except Exception:
+        # there's nobody to raise it to
+        logger.exception('Side effect %r failed', func)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The pool side effects run on, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SideEffectPool()
+            # so that side effects of committed transactions aren't lost
+            # when the process exits normally
+            atexit.register(drain)
+        return _pool
+
+
+def set_pool(pool):
+    """
+    Use pool for side effects. Returns the previous one, if any; it's up
+    to you to drain and shut it down.
+    """
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, pool
+    return previous
+
+
+def drain(timeout=None):
+    """
+    Wait for the side effects already submitted to the pool to finish;
+    call this when shutting down (say from a worker's exit hook). Returns
+    True if they all did within timeout seconds.
+    """
+    if _pool is None:
+        return True
+    return _pool.drain(timeout)
+
+
+class SideEffects(object):
+    """
+    A context manager equivalent to transaction.atomic(), to pass to
+    transactional_save() as tx_context_manager, which collects side
+    effects to run once the transaction has committed and compensations
+    to run if it's rolled back.
+
+    If it's inside someone else's atomic block, side effects wait for
+    the outermost transaction to commit (and are dropped if it doesn't),
+    but compensations only run if our own savepoint is rolled back.
+    """
+
+    def __init__(self, using=None, savepoint=True, pool=None, timeout=None):
+        self.using = using
+        self.savepoint = savepoint
+        self.pool = pool
+        # how long dispatching may wait for room in the pool, after which
+        # side effects are run on the committing thread instead
+        self.timeout = timeout
+        self._atomic = None
+        self._effects = []
+        self._compensations = []
+
+    def on_commit(self, func):
+        """Run func on the pool once the transaction has committed."""
+        self._effects.append(func)
+
+    def compensation(self, func):
+        """Run func (straight away) if the transaction is rolled back."""
+        self._compensations.append(func)
+
+    def __enter__(self):
+        # transactional_save() uses us afresh for each attempt
+        self._effects = []
+        self._compensations = []
+        self._atomic = transaction.atomic(using=self.using, savepoint=self.savepoint)
+        return self._atomic.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            effects = self._effects
+            transaction.on_commit(lambda: self._dispatch(effects), using=self.using)
+        try:
+            suppress = self._atomic.__exit__(exc_type, exc_value, traceback)
+        except BaseException:
+            # the COMMIT failed
+            self._compensate()
+            raise
+        if exc_type is not None:
+            self._compensate()
+        return suppress
+
+    def _dispatch(self, effects):
+        pool = self.pool if self.pool is not None else get_pool()
+        for func in effects:
+            if pool.submit(func, self.timeout) is None:
+                # the pool is backed up: doing it ourselves slows us
+                # down, which is the point
+                _call(func)
+
+    def _compensate(self):
+        # like the side effects, these mustn't stop the others running
+        compensations, self._compensations = self._compensations, []
+        self._effects = []
+        for func in reversed(compensations):
+            try:
+                func()
+            except Exception:
+                logger.exception('Compensation %r failed', func)
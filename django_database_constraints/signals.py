@@ -0,0 +1,45 @@
+from django.dispatch import Signal
+
+
+# Outcomes of a transactional save:
+#
+# the transaction committed
+COMMITTED = 'committed'
+# an error (IntegrityError, contention or ValidationError from .save())
+# was turned into form errors
+CONVERTED = 'converted'
+# some other exception escaped
+RERAISED = 're-raised'
+# (for views only) a repeat of a submission already saved, with the
+# same idempotency key
+REPEATED = 'repeated'
+
+
+# Sent when transactional_save() finishes, however it finishes. The
+# sender is the model class (or the form class, for forms without an
+# instance), and the arguments are:
+#
+#  * form
+#  * outcome: one of the outcomes above
+#  * strategy: forms.TRANSACTION, forms.SAVEPOINT or forms.NO_SAVEPOINT
+#  * attempts: how many times we ran the transaction
+#  * transaction_time: seconds spent inside the atomic block, over all
+#    attempts; that is, how long the transaction was held open
+#  * prepare_time: seconds spent in the prepare phase before the
+#    transaction, or None if there wasn't one
+#  * conversion_time: seconds spent turning an IntegrityError into a
+#    ValidationError
+#  * lock_wait_time: seconds spent waiting for advisory locks, or None
+#    if we didn't take any
+#  * conflict_cache_hit: True if the save was rejected by the conflict
+#    cache without a transaction, False if the cache was checked and
+#    had nothing, or None if there wasn't one (see conflicts.py)
+#  * constraint_name: the violated constraint, if we know it
+#  * model: the model that constraint belongs to, if we know it
+transactional_save_finished = Signal()
+
+# Sent when TransactionalModelFormMixin.form_valid() finishes. The sender
+# is the view class, and the arguments are view, form, outcome (as
+# above, with CONVERTED meaning the form was redisplayed with errors)
+# and time (in seconds).
+transactional_form_valid_finished = Signal()
@@ -1,19 +1,41 @@
+import asyncio
+import datetime
+import json
 import os
+import subprocess
+import sys
 import threading
-
-from django.db import models, IntegrityError, OperationalError, connection, transaction
+import time
+import unittest
+from io import StringIO
+
+from django.contrib import admin as django_admin
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import models, IntegrityError, OperationalError, connection, connections, transaction
 import django.forms
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 from django.test.client import RequestFactory
-from django.utils.encoding import smart_bytes, smart_text
-from django.views.generic import CreateView, UpdateView
-
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.encoding import smart_bytes, smart_str
+from django.views.generic import CreateView, FormView, UpdateView
+
+from . import admin, audit, backends, conflicts, constraints, forms, formsets, locks, optimistic, sideeffects, signals
+from .metrics import StatsCollector
+from .models import IdempotencyKey, TransactionalQuerySet
+from .retry import RetryPolicy, monotonic
 from .forms import TransactionalMixin
 from .views import CreateView as TransactionalCreateView, UpdateView as TransactionalUpdateView
+from .views import TransactionalBulkCreateView, TransactionalModelFormMixin
+from testapp.models import (
+    TestArgumentsModel, TestAuditModel, TestModel, TestParentModel, TestSluggedModel,
+    TestTogetherModel, TestTransactionalModel, TestVersionedModel,
+)
 
 
-class TestModel(models.Model):
-    unique = models.IntegerField(unique=True)
+# Django 4.2+ counts BEGIN and COMMIT (or ROLLBACK) as queries
+TRANSACTION_QUERIES = 2 if django.VERSION >= (4, 2) else 0
 
 
 class TestForm(django.forms.ModelForm):
@@ -26,6 +48,96 @@ class TransactionalTestForm(TransactionalMixin, TestForm):
     pass
 
 
+class TestTogetherForm(TransactionalMixin, django.forms.ModelForm):
+    class Meta:
+        model = TestTogetherModel
+        fields = ['parent', 'order']
+
+    def validate_unique(self):
+        # so we can provoke the database into complaining
+        pass
+
+
+if hasattr(models, 'Deferrable'):
+    # Django 3.1+
+    from testapp.models import TestOrderModel
+
+    class TestOrderForm(TransactionalMixin, django.forms.ModelForm):
+        trust_database = True
+
+        class Meta:
+            model = TestOrderModel
+            fields = ['order']
+
+
+class TestVersionedForm(django.forms.ModelForm):
+    class Meta:
+        model = TestVersionedModel
+        fields = ['unique']
+
+    def validate_unique(self):
+        # so we can provoke the database into complaining
+        pass
+
+
+class UncheckedTestForm(TestForm):
+    def validate_unique(self):
+        # so we can provoke the database into complaining
+        pass
+
+
+class TestModelAdmin(admin.ModelAdmin):
+    form = UncheckedTestForm
+    list_display = ['id', 'unique']
+    list_editable = ['unique']
+    list_per_page = 2
+    actions = ['make_all_one']
+
+    def get_changelist_form(self, request, **kwargs):
+        return UncheckedTestForm
+
+    def make_all_one(self, request, queryset):
+        TestModel.objects.create(unique=99)
+        queryset.update(unique=1)
+
+
+class RacingTestForm(TestForm):
+    def validate_unique(self):
+        super(RacingTestForm, self).validate_unique()
+        if not self.errors:
+            # someone else saves the same value between our validation
+            # and our save
+            def create():
+                try:
+                    TestModel.objects.create(unique=self.cleaned_data['unique'])
+                finally:
+                    connection.close()
+            thread = threading.Thread(target=create)
+            thread.start()
+            thread.join()
+
+
+class RacingTestModelAdmin(admin.ModelAdmin):
+    form = RacingTestForm
+
+
+admin_site = django_admin.AdminSite(name='test_admin')
+admin_site.register(TestModel, TestModelAdmin)
+racing_admin_site = django_admin.AdminSite(name='racing_admin')
+racing_admin_site.register(TestModel, RacingTestModelAdmin)
+
+try:
+    from django.urls import re_path
+except ImportError:
+    # before Django 2.0
+    from django.conf.urls import url as re_path
+
+urlpatterns = [
+    re_path(r'^admin/', admin_site.urls),
+    re_path(r'^racing_admin/', racing_admin_site.urls),
+]
+
+
 def get_acquiring_form(form_class, semaphore):
     class AcquiringForm(form_class):
         def save(self, *args, **kwargs):
@@ -260,13 +372,1911 @@ class TestTransactionalSave(TransactionTestCase):
         # before either thread got to saving, so we should get the
         # releasing form (ie the second thread) having succeeded and
         # the first blowing up with a ValidationError that is correctly
-        # added as a non-field error.
+        # attributed to the unique field.
         self.assertEqual(True, first.as_expected)
         self.assertEqual(True, second.as_expected)
         self.assertEqual(1, TestModel.objects.count())
 
-        self.assertEqual(1, len(first.form._errors[django.forms.forms.NON_FIELD_ERRORS]))
-        self.assertEqual(str(first.exception.messages[0]), first.form._errors[django.forms.forms.NON_FIELD_ERRORS][0])
+        self.assertEqual(1, len(first.form._errors['unique']))
+        self.assertEqual(str(first.exception.messages[0]), first.form._errors['unique'][0])
+        self.assertEqual(
+            "Test model with this Unique already exists.",
+            first.form._errors['unique'][0],
+        )
+
+
+class TestConstraintIndex(TransactionTestCase):
+    """Can we attribute database constraint names to fields?"""
+
+    def test_generated_names(self):
+        schema_editor = connection.schema_editor()
+        table = TestTogetherModel._meta.db_table
+        name = schema_editor._create_index_name(table, ['parent_id', 'order'], suffix='_uniq')
+        info = constraints.lookup(name)
+        self.assertEqual(TestTogetherModel, info.model)
+        self.assertEqual(('parent', 'order'), info.fields)
+        self.assertEqual(constraints.UNIQUE, info.kind)
+
+        parent_table = TestParentModel._meta.db_table
+        name = schema_editor._create_index_name(table, ['parent_id'], suffix='_fk_%s_id' % parent_table)
+        info = constraints.lookup(name)
+        self.assertEqual(('parent',), info.fields)
+        self.assertEqual(constraints.FOREIGN_KEY, info.kind)
+
+    def run_setup(self, code):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+
+    def test_no_databases(self):
+        # building it with the dummy backend mustn't fail
+        self.run_setup(
+            "import django\n"
+            "from django.conf import settings\n"
+            "settings.configure(INSTALLED_APPS=['django.contrib.contenttypes', "
+            "'django.contrib.auth', 'django_database_constraints'])\n"
+            "django.setup()\n"
+            "from django_database_constraints import constraints\n"
+            "assert constraints.lookup('no_such_constraint') is None\n"
+        )
+
+    def test_not_built_on_setup(self):
+        # django.setup() mustn't need a database, which db_check() can
+        self.run_setup(
+            "import django\n"
+            "from django.conf import settings\n"
+            "from django.db.models import Field\n"
+            "def db_check(self, connection):\n"
+            "    raise AssertionError('db_check() called')\n"
+            "Field.db_check = db_check\n"
+            "settings.configure(INSTALLED_APPS=['django.contrib.contenttypes', "
+            "'django.contrib.auth', 'django_database_constraints'], "
+            "DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})\n"
+            "django.setup()\n"
+        )
+
+    def test_unknown_name(self):
+        self.assertEqual(None, constraints.lookup('no_such_constraint'))
+
+    def test_unique_together_is_non_field_error(self):
+        parent = TestParentModel.objects.create()
+        TestTogetherModel.objects.create(parent=parent, order=1)
+        form = TestTogetherForm({'parent': parent.pk, 'order': 1})
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave()
+        self.assertEqual(
+            ["Test together model with this Parent and Order already exists."],
+            list(form.non_field_errors()),
+        )
+        self.assertEqual(1, TestTogetherModel.objects.count())
+
+
+class TestTrustDatabase(TransactionTestCase):
+    """Can we leave uniqueness checks to the database?"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_form(self):
+        class InnerTestForm(TransactionalTestForm):
+            trust_database = True
+
+        TestModel.objects.create(unique=1)
+        form = InnerTestForm({ 'unique': 1})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave()
+        self.assertEqual(
+            ["Test model with this Unique already exists."],
+            form.errors['unique'],
+        )
+        self.assertEqual(1, TestModel.objects.count())
+
+    @unittest.skipUnless(hasattr(models, 'Deferrable'), "needs Django 3.1")
+    def test_meta_constraints(self):
+        # which Django 4.1+ validates separately from unique fields
+        TestOrderModel.objects.create(order=1)
+        form = TestOrderForm({ 'order': 1 })
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave()
+        self.assertEqual(1, TestOrderModel.objects.count())
+
+    def test_view(self):
+        class _CreateView(TransactionalCreateView):
+            model = TestModel
+            form_class = TestForm
+            success_url = '/'
+            trust_database = True
+
+        TestModel.objects.create(unique=1)
+        response = _CreateView.as_view()(self.factory.post("/", { 'unique': '1' }))
+        response.render()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('Test model with this Unique already exists.') in response.content)
+
+        response = _CreateView.as_view()(self.factory.post("/", { 'unique': '2' }))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(2, TestModel.objects.count())
+
+
+class TestTrustDatabaseForeignKeys(TransactionTestCase):
+    """Can we leave foreign key existence checks to the database?"""
+
+    class InnerTestForm(TransactionalMixin, django.forms.ModelForm):
+        trust_database = True
+        trust_database_foreign_keys = True
+
+        class Meta:
+            model = TestTogetherModel
+            fields = ['parent', 'order']
+
+    def test_existing(self):
+        parent = TestParentModel.objects.create()
+        form = self.InnerTestForm({'parent': parent.pk, 'order': 1})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        obj = form.tsave()
+        self.assertEqual(parent.pk, TestTogetherModel.objects.get(pk=obj.pk).parent_id)
+
+    def test_missing(self):
+        form = self.InnerTestForm({'parent': 999, 'order': 1})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave()
+        self.assertEqual(
+            [django.forms.ModelChoiceField.default_error_messages['invalid_choice']],
+            form.errors['parent'],
+        )
+        self.assertEqual(0, TestTogetherModel.objects.count())
+
+    def test_missing_in_outer_transaction(self):
+        # the constraint may be deferred until the outer transaction commits
+        with transaction.atomic():
+            form = self.InnerTestForm({'parent': 999, 'order': 1})
+            self.assertTrue(form.is_valid())
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave()
+            self.assertTrue('parent' in form.errors)
+            # and the outer transaction is still usable
+            TestParentModel.objects.create()
+        self.assertEqual(1, TestParentModel.objects.count())
+
+    def test_invalid_value(self):
+        form = self.InnerTestForm({'parent': 'not a pk', 'order': 1})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('parent' in form.errors)
+
+
+class TestTransactionStrategy(TransactionTestCase):
+    """Do we avoid savepoints we don't need?"""
+
+    def test_outside_transaction(self):
+        form = TransactionalTestForm({ 'unique': 1})
+        form.is_valid()
+        form.tsave()
+        self.assertEqual(forms.TRANSACTION, form.transaction_strategy)
+
+    def test_inside_transaction(self):
+        with transaction.atomic():
+            form = TransactionalTestForm({ 'unique': 1})
+            form.is_valid()
+            with self.assertNumQueries(3):
+                # SAVEPOINT, INSERT, RELEASE
+                form.tsave()
+        self.assertEqual(forms.SAVEPOINT, form.transaction_strategy)
+
+    def test_inside_transaction_without_savepoint(self):
+        class InnerTestForm(TransactionalTestForm):
+            tsave_savepoint = False
+
+        with transaction.atomic():
+            form = InnerTestForm({ 'unique': 1})
+            form.is_valid()
+            with self.assertNumQueries(1):
+                form.tsave()
+        self.assertEqual(forms.NO_SAVEPOINT, form.transaction_strategy)
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_failure_without_savepoint(self):
+        class InnerTestForm(TransactionalTestForm):
+            trust_database = True
+            tsave_savepoint = False
+
+        TestModel.objects.create(unique=1)
+        with transaction.atomic():
+            form = InnerTestForm({ 'unique': 1})
+            form.is_valid()
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave()
+            self.assertTrue('unique' in form.errors)
+            self.assertTrue(transaction.get_rollback())
+
+
+def retryable_error():
+    # an OperationalError the current backend's decoder will see as a
+    # serialization failure or deadlock
+    if connection.vendor == 'postgresql':
+        class Cause(Exception):
+            pgcode = '40001'
+        error = OperationalError('could not serialize access')
+        error.__cause__ = Cause()
+        return error
+    elif connection.vendor == 'mysql':
+        return OperationalError(1213, 'Deadlock found when trying to get lock')
+    else:
+        return OperationalError('database is locked')
+
+
+class TestRetry(TransactionTestCase):
+    """Do we retry transactions that lost out to contention?"""
+
+    def setUp(self):
+        self.delays = []
+        self.policy = RetryPolicy(max_attempts=3, sleep=self.delays.append)
+
+    def get_form(self, failures):
+        class InnerTestForm(TransactionalTestForm):
+            attempts = 0
+
+            def save(self):
+                InnerTestForm.attempts += 1
+                obj = super(InnerTestForm, self).save()
+                if InnerTestForm.attempts <= failures:
+                    raise retryable_error()
+                return obj
+
+        form = InnerTestForm({ 'unique': 1})
+        form.is_valid()
+        return form
+
+    def test_retries(self):
+        form = self.get_form(2)
+        obj = form.tsave(retry=self.policy)
+        self.assertEqual(3, form.attempts)
+        self.assertEqual(2, len(self.delays))
+        self.assertEqual([obj.pk], [tm.pk for tm in TestModel.objects.all()])
+
+    def test_out_of_attempts(self):
+        form = self.get_form(3)
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave(retry=self.policy)
+        self.assertEqual(3, form.attempts)
+        self.assertEqual([forms.RETRY_MESSAGE], form.non_field_errors())
+        self.assertEqual(0, TestModel.objects.count())
+
+    def test_out_of_budget(self):
+        form = self.get_form(3)
+        self.policy.budget = 0
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave(retry=self.policy)
+        self.assertEqual(1, form.attempts)
+
+    def test_budget_includes_first_attempt(self):
+        delays = RetryPolicy(initial_delay=0.001, budget=0.05).delays()
+        # as if the first attempt took longer than the budget
+        time.sleep(0.1)
+        self.assertEqual([], list(delays))
+
+    def test_no_policy(self):
+        form = self.get_form(1)
+        with self.assertRaises(OperationalError):
+            form.tsave()
+        self.assertEqual(1, form.attempts)
+
+    def test_not_our_transaction(self):
+        form = self.get_form(1)
+        with transaction.atomic():
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave(retry=self.policy)
+        self.assertEqual(1, form.attempts)
+        self.assertEqual([forms.RETRY_MESSAGE], form.non_field_errors())
+
+    def test_delays(self):
+        policy = RetryPolicy(max_attempts=5, initial_delay=1, max_delay=2)
+        delays = list(policy.delays())
+        self.assertEqual(4, len(delays))
+        self.assertTrue(all(0 <= d <= 2 for d in delays))
+
+
+class TestInstrumentation(TransactionTestCase):
+    """Can we see what transactional saves are doing?"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.collector = StatsCollector().connect()
+        self.addCleanup(self.collector.disconnect)
+
+    def test_signal(self):
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+        signals.transactional_save_finished.connect(receiver)
+        self.addCleanup(signals.transactional_save_finished.disconnect, receiver)
+
+        class InnerTestForm(TransactionalTestForm):
+            trust_database = True
+
+        for i in range(2):
+            form = InnerTestForm({ 'unique': 1})
+            form.is_valid()
+            try:
+                form.tsave()
+            except django.forms.ValidationError:
+                pass
+
+        self.assertEqual(signals.COMMITTED, received[0]['outcome'])
+        self.assertEqual(1, received[0]['attempts'])
+        self.assertTrue(received[0]['transaction_time'] > 0)
+        self.assertEqual(signals.CONVERTED, received[1]['outcome'])
+        self.assertEqual(TestModel, received[1]['model'])
+        self.assertTrue(received[1]['conversion_time'] > 0)
+        self.assertTrue(constraints.lookup(received[1]['constraint_name']) is not None)
+
+    def test_reraised(self):
+        class InnerTestForm(TransactionalTestForm):
+            def save(self):
+                raise ValueError
+
+        form = InnerTestForm({ 'unique': 1})
+        form.is_valid()
+        with self.assertRaises(ValueError):
+            form.tsave()
+        stats = self.collector.snapshot()
+        self.assertEqual(
+            {signals.RERAISED: 1},
+            stats['saves']['testapp.TestModel']['outcomes'],
+        )
+
+    def test_collector(self):
+        class _CreateView(TransactionalCreateView):
+            model = TestModel
+            form_class = TestForm
+            success_url = '/'
+            trust_database = True
+
+        for i in range(3):
+            _CreateView.as_view()(self.factory.post("/", { 'unique': '1' }))
+        stats = self.collector.snapshot()
+        saves = stats['saves']['testapp.TestModel']
+        self.assertEqual({signals.COMMITTED: 1, signals.CONVERTED: 2}, saves['outcomes'])
+        self.assertEqual(3, saves['transaction_time']['count'])
+        self.assertEqual(2, saves['conversion_time']['count'])
+        self.assertEqual(1, len(stats['constraints']))
+        self.assertEqual('testapp.TestModel', stats['constraints'][0]['model'])
+        self.assertEqual(2, stats['constraints'][0]['count'])
+        views = list(stats['views'].values())
+        self.assertEqual({signals.COMMITTED: 1, signals.CONVERTED: 2}, views[0]['outcomes'])
+
+        self.collector.reset()
+        self.assertEqual({}, self.collector.snapshot()['saves'])
+
+
+class PreparingTestForm(TransactionalTestForm):
+    def prepare(self):
+        self.prepared_in_transaction = connection.in_atomic_block
+        if self.cleaned_data['unique'] < 0:
+            raise django.forms.ValidationError('negative', code='negative')
+        # as if this were slow
+        self.instance.unique = self.cleaned_data['unique'] * 10
+
+
+class TestTwoPhase(TransactionTestCase):
+    """Is prepare() run before the transaction?"""
+
+    def setUp(self):
+        self.received = []
+        def receiver(sender, **kwargs):
+            self.received.append(kwargs)
+        signals.transactional_save_finished.connect(receiver, weak=False, dispatch_uid='test_two_phase')
+        self.addCleanup(signals.transactional_save_finished.disconnect, dispatch_uid='test_two_phase')
+
+    def test_prepare(self):
+        form = PreparingTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        form.tsave()
+        self.assertFalse(form.prepared_in_transaction)
+        self.assertEqual(10, TestModel.objects.get().unique)
+        self.assertTrue(self.received[0]['prepare_time'] >= 0)
+        self.assertTrue(self.received[0]['transaction_time'] > 0)
+
+    def test_prepare_error(self):
+        form = PreparingTestForm({ 'unique': '-1' })
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave()
+        self.assertEqual(['negative'], list(form.non_field_errors()))
+        self.assertEqual(signals.CONVERTED, self.received[0]['outcome'])
+        self.assertEqual(0, self.received[0]['attempts'])
+        self.assertEqual(0, TestModel.objects.count())
+
+    def test_no_prepare(self):
+        form = TestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        forms.transactional_save(form)
+        self.assertEqual(None, self.received[0]['prepare_time'])
+
+    def test_view_bypassing_tsave(self):
+        view = TransactionalCreateView.as_view(
+            model=TestModel, form_class=PreparingTestForm, success_url='/',
+            insert_ignoring_conflicts=True,
+        )
+        response = view(RequestFactory().post("/", { 'unique': '2' }))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(20, TestModel.objects.get().unique)
+
+    def test_collector(self):
+        collector = StatsCollector().connect()
+        self.addCleanup(collector.disconnect)
+        form = PreparingTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        form.tsave()
+        saves = collector.snapshot()['saves']['testapp.TestModel']
+        self.assertEqual(1, saves['prepare_time']['count'])
+
+
+class LockHolder(threading.Thread):
+    """Hold advisory locks for instance's unique values, in a transaction."""
+
+    def __init__(self, instance, create=False, keys=None, timeout=None):
+        super(LockHolder, self).__init__()
+        self.instance = instance
+        self.create = create
+        self.keys = keys if keys is not None else locks.lock_keys(instance)
+        self.timeout = timeout
+        self.locked = threading.Event()
+        self.release = threading.Event()
+        self.got = False
+
+    def run(self):
+        try:
+            with transaction.atomic():
+                locks.acquire(connection, self.keys, self.timeout)
+                self.got = True
+                if self.create:
+                    self.instance.save()
+                self.locked.set()
+                self.release.wait(5)
+        finally:
+            self.locked.set()
+            connection.close()
+
+
+class TestAdvisoryLocks(TransactionTestCase):
+    """Do racers for the same unique values queue on a lock?"""
+
+    def setUp(self):
+        if connection.vendor not in ('postgresql', 'mysql'):
+            self.skipTest("no advisory locks")
+
+    def test_keys(self):
+        self.assertEqual(locks.lock_keys(TestModel(unique=1)), locks.lock_keys(TestModel(pk=5, unique=1)))
+        self.assertNotEqual(locks.lock_keys(TestModel(unique=1)), locks.lock_keys(TestModel(unique=2)))
+        self.assertEqual(1, len(locks.lock_keys(TestModel(unique=1))))
+        self.assertEqual([], locks.lock_keys(TestModel()))
+
+    def test_uncontended(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+        signals.transactional_save_finished.connect(receiver)
+        try:
+            form = TransactionalTestForm({ 'unique': '1' })
+            self.assertTrue(form.is_valid())
+            form.tsave(advisory_lock=True)
+        finally:
+            signals.transactional_save_finished.disconnect(receiver)
+        self.assertEqual(1, TestModel.objects.count())
+        self.assertTrue(received[0]['lock_wait_time'] is not None)
+
+    def test_contended_revalidates(self):
+        form = TransactionalTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        holder = LockHolder(TestModel(unique=1), create=True)
+        holder.start()
+        holder.locked.wait(5)
+        threading.Timer(0.2, holder.release.set).start()
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+        signals.transactional_save_finished.connect(receiver)
+        try:
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave(advisory_lock=True)
+        finally:
+            signals.transactional_save_finished.disconnect(receiver)
+            holder.join()
+        self.assertEqual(['Test model with this Unique already exists.'], form.errors['unique'])
+        # we never got as far as the INSERT
+        self.assertIsNone(received[0]['constraint_name'])
+        self.assertTrue(received[0]['lock_wait_time'] >= 0.1)
+
+    def test_timeout(self):
+        holder = LockHolder(TestModel(unique=1))
+        holder.start()
+        holder.locked.wait(5)
+        try:
+            for timeout in (0, 0.1):
+                form = TransactionalTestForm({ 'unique': '1' })
+                self.assertTrue(form.is_valid())
+                with self.assertRaises(django.forms.ValidationError) as cm:
+                    form.tsave(advisory_lock=True, advisory_lock_timeout=timeout)
+                self.assertEqual('retry', cm.exception.error_list[0].code)
+        finally:
+            holder.release.set()
+            holder.join()
+        self.assertEqual(0, TestModel.objects.count())
+        # and once it's released, we can have it
+        form = TransactionalTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        form.tsave(advisory_lock=True, advisory_lock_timeout=0.1)
+        self.assertEqual(1, TestModel.objects.count())
+
+
+    def test_in_order(self):
+        # holding the first key, and so not the second
+        first, second = sorted(locks.lock_keys(TestModel(unique=1)) + locks.lock_keys(TestModel(unique=2)))
+        holder = LockHolder(None, keys=[first])
+        holder.start()
+        holder.locked.wait(5)
+        try:
+            with transaction.atomic():
+                with self.assertRaises(locks.LockTimeout):
+                    locks.acquire(connection, [first, second], 0)
+                # we didn't take the second while failing to get the first
+                other = LockHolder(None, keys=[second], timeout=0)
+                other.start()
+                other.locked.wait(5)
+                other.release.set()
+                other.join()
+                self.assertTrue(other.got)
+        finally:
+            holder.release.set()
+            holder.join()
+
+
+class RowLockHolder(threading.Thread):
+    """Hold a row lock on obj until told to let go."""
+
+    def __init__(self, obj):
+        super(RowLockHolder, self).__init__()
+        self.obj = obj
+        self.locked = threading.Event()
+        self.release = threading.Event()
+
+    def run(self):
+        try:
+            with transaction.atomic():
+                list(TestModel.objects.select_for_update().filter(pk=self.obj.pk))
+                self.locked.set()
+                self.release.wait(5)
+        finally:
+            self.locked.set()
+            connection.close()
+
+
+class TestTimeouts(TransactionTestCase):
+    """Do lock and statement timeouts become form errors?"""
+
+    def setUp(self):
+        if connection.vendor not in ('postgresql', 'mysql'):
+            self.skipTest("no lock or statement timeouts")
+
+    def test_lock_timeout(self):
+        obj = TestModel.objects.create(unique=1)
+        holder = RowLockHolder(obj)
+        holder.start()
+        holder.locked.wait(5)
+        try:
+            form = TransactionalTestForm({ 'unique': '2' }, instance=obj)
+            self.assertTrue(form.is_valid())
+            with self.assertRaises(django.forms.ValidationError) as cm:
+                form.tsave(lock_timeout=0.1)
+            self.assertEqual('retry', cm.exception.error_list[0].code)
+            self.assertEqual([forms.RETRY_MESSAGE], list(form.non_field_errors()))
+        finally:
+            holder.release.set()
+            holder.join()
+        self.assertEqual(1, TestModel.objects.get().unique)
+
+    def test_statement_timeout(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("mysql only limits SELECTs")
+
+        class _Form(TransactionalTestForm):
+            def save(self, *args, **kwargs):
+                obj = super(_Form, self).save(*args, **kwargs)
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_sleep(1)')
+                return obj
+        form = _Form({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            form.tsave(statement_timeout=0.1)
+        self.assertEqual(0, TestModel.objects.count())
+
+    def test_restored(self):
+        def current():
+            with connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    cursor.execute("SELECT current_setting('lock_timeout')")
+                else:
+                    cursor.execute('SELECT @@SESSION.innodb_lock_wait_timeout')
+                return cursor.fetchone()[0]
+        with transaction.atomic():
+            before = current()
+            form = TransactionalTestForm({ 'unique': '1' })
+            self.assertTrue(form.is_valid())
+            form.tsave(lock_timeout=0.5)
+            self.assertEqual(before, current())
+
+    def test_view(self):
+        obj = TestModel.objects.create(unique=1)
+        holder = RowLockHolder(obj)
+        holder.start()
+        holder.locked.wait(5)
+        try:
+            view = TransactionalUpdateView.as_view(
+                model=TestModel, form_class=TestForm, success_url='/', tsave_lock_timeout=0.1,
+            )
+            response = view(RequestFactory().post("/", { 'unique': '2' }), pk=obj.pk)
+            response.render()
+        finally:
+            holder.release.set()
+            holder.join()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('Please try again.') in response.content)
+
+
+class TestOptimistic(TransactionTestCase):
+    """Do versioned updates spot changes made since the form was rendered?"""
+
+    def view(self, version_field='version', **kwargs):
+        return TransactionalUpdateView.as_view(
+            model=TestVersionedModel, form_class=TestVersionedForm, success_url='/',
+            template_name='testapp/testmodel_form.html',
+            version_field=version_field, **kwargs
+        )
+
+    def test_renders_version(self):
+        obj = TestVersionedModel.objects.create(unique=1, version=7)
+        response = self.view()(RequestFactory().get("/"), pk=obj.pk)
+        response.render()
+        self.assertTrue(smart_bytes('type="hidden" name="version" value="7"') in response.content)
+
+    def test_update(self):
+        obj = TestVersionedModel.objects.create(unique=1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.view()(RequestFactory().post("/", { 'unique': '2', 'version': '0' }), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        obj = TestVersionedModel.objects.get()
+        self.assertEqual((2, 1), (obj.unique, obj.version))
+
+    def test_conflict(self):
+        obj = TestVersionedModel.objects.create(unique=1)
+        # someone else saves first
+        TestVersionedModel.objects.filter(pk=obj.pk).update(unique=3, version=1)
+        outcomes = []
+
+        def receiver(sender, outcome, **kwargs):
+            outcomes.append(outcome)
+        signals.transactional_save_finished.connect(receiver)
+        try:
+            response = self.view()(RequestFactory().post("/", { 'unique': '2', 'version': '0' }), pk=obj.pk)
+            response.render()
+        finally:
+            signals.transactional_save_finished.disconnect(receiver)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('has been changed by someone else') in response.content)
+        self.assertEqual([signals.CONVERTED], outcomes)
+        obj = TestVersionedModel.objects.get()
+        self.assertEqual((3, 1), (obj.unique, obj.version))
+
+    def test_deleted(self):
+        obj = TestVersionedModel.objects.create(unique=1)
+        form = TestVersionedForm({ 'unique': '2', 'version': '0' }, instance=obj)
+        optimistic.add_version_field(form, 'version')
+        self.assertTrue(form.is_valid())
+        TestVersionedModel.objects.filter(pk=obj.pk).delete()
+        with self.assertRaises(django.forms.ValidationError) as cm:
+            forms.transactional_save(form, save=lambda: optimistic.versioned_save(form, 'version'))
+        self.assertEqual('conflict', cm.exception.error_list[0].code)
+
+    def test_timestamp(self):
+        obj = TestVersionedModel.objects.create(unique=1)
+        seen = TestVersionedModel._meta.get_field('modified').value_to_string(obj)
+        response = self.view('modified')(RequestFactory().post("/", { 'unique': '2', 'modified': seen }), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        # the same timestamp again is now stale
+        response = self.view('modified')(RequestFactory().post("/", { 'unique': '3', 'modified': seen }), pk=obj.pk)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, TestVersionedModel.objects.get().unique)
+
+    def test_integrity_error(self):
+        TestVersionedModel.objects.create(unique=1)
+        obj = TestVersionedModel.objects.create(unique=2)
+        response = self.view()(RequestFactory().post("/", { 'unique': '1', 'version': '0' }), pk=obj.pk)
+        response.render()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('already exists') in response.content)
+        self.assertEqual(0, TestVersionedModel.objects.get(pk=obj.pk).version)
+
+
+class TestSelectForUpdate(TransactionTestCase):
+    """Does UpdateView lock the row inside the save's transaction?"""
+
+    def setUp(self):
+        if not connection.features.has_select_for_update_nowait:
+            self.skipTest("no SELECT ... FOR UPDATE NOWAIT")
+
+    def view(self, **kwargs):
+        return TransactionalUpdateView.as_view(
+            model=TestModel, form_class=TestForm, success_url='/',
+            select_for_update=True, **kwargs
+        )
+
+    def post_while_locked(self, view, obj):
+        holder = RowLockHolder(obj)
+        holder.start()
+        holder.locked.wait(5)
+        try:
+            response = view(RequestFactory().post("/", { 'unique': '2' }), pk=obj.pk)
+            response.render()
+        finally:
+            holder.release.set()
+            holder.join()
+        return response
+
+    def test_locks(self):
+        obj = TestModel.objects.create(unique=1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.view()(RequestFactory().post("/", { 'unique': '2' }), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(2, TestModel.objects.get().unique)
+        sql = [q['sql'] for q in queries.captured_queries]
+        locking = [i for i, q in enumerate(sql) if q.endswith('FOR UPDATE')]
+        updating = [i for i, q in enumerate(sql) if q.startswith('UPDATE')]
+        self.assertEqual(1, len(locking))
+        self.assertTrue(locking[0] < updating[0])
+
+    def test_nowait(self):
+        obj = TestModel.objects.create(unique=1)
+        response = self.post_while_locked(self.view(select_for_update_nowait=True), obj)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('Please try again.') in response.content)
+        self.assertEqual(1, TestModel.objects.get().unique)
+
+    def test_skip_locked(self):
+        if not connection.features.has_select_for_update_skip_locked:
+            self.skipTest("no SELECT ... FOR UPDATE SKIP LOCKED")
+        obj = TestModel.objects.create(unique=1)
+        response = self.post_while_locked(self.view(select_for_update_skip_locked=True), obj)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('being changed by someone else') in response.content)
+        self.assertEqual(1, TestModel.objects.get().unique)
+
+    def test_keeps_concurrent_changes(self):
+        obj = TestVersionedModel.objects.create(unique=1, version=1)
+
+        class _UpdateView(TransactionalUpdateView):
+            def get_object(self, queryset=None):
+                obj = super(_UpdateView, self).get_object(queryset)
+                # someone else changes a field that isn't on the form,
+                # after we've read the row
+                TestVersionedModel.objects.filter(pk=obj.pk).update(version=5)
+                return obj
+        view = _UpdateView.as_view(
+            model=TestVersionedModel, form_class=TestVersionedForm, success_url='/',
+            select_for_update=True,
+        )
+        response = view(RequestFactory().post("/", { 'unique': '2' }), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        obj = TestVersionedModel.objects.get()
+        self.assertEqual(2, obj.unique)
+        self.assertEqual(5, obj.version)
+
+    def test_keeps_validated_changes(self):
+        obj = TestSluggedModel.objects.create(title='Old', slug='old')
+
+        class SluggedForm(django.forms.ModelForm):
+            class Meta:
+                model = TestSluggedModel
+                fields = ['title']
+
+        class _UpdateView(TransactionalUpdateView):
+            def get_object(self, queryset=None):
+                obj = super(_UpdateView, self).get_object(queryset)
+                TestSluggedModel.objects.filter(pk=obj.pk).update(note='theirs')
+                return obj
+        view = _UpdateView.as_view(
+            model=TestSluggedModel, form_class=SluggedForm, success_url='/',
+            select_for_update=True,
+        )
+        response = view(RequestFactory().post("/", { 'title': 'New' }), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        obj = TestSluggedModel.objects.get()
+        # from the form, from Model.clean() and from someone else
+        self.assertEqual(('New', 'new', 'theirs'), (obj.title, obj.slug, obj.note))
+
+    def test_no_longer_matches(self):
+        obj = TestModel.objects.create(unique=1)
+
+        class _UpdateView(TransactionalUpdateView):
+            def get_queryset(self):
+                queryset = TestModel.objects.all()
+                if self.request.method == 'POST' and hasattr(self, 'object'):
+                    # as if it had been dealt with since it was fetched
+                    queryset = queryset.exclude(pk=obj.pk)
+                return queryset
+        view = _UpdateView.as_view(form_class=TestForm, success_url='/', select_for_update=True)
+        response = view(RequestFactory().post("/", { 'unique': '2' }), pk=obj.pk)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, TestModel.objects.get().unique)
+
+
+class TestIdempotencyKeys(TransactionTestCase):
+    """Are repeated submissions absorbed?"""
+
+    def view(self, form_class=TestForm, **kwargs):
+        return TransactionalCreateView.as_view(
+            model=TestModel, form_class=form_class, success_url='/{id}/',
+            idempotency_keys=True, **kwargs
+        )
+
+    def test_header(self):
+        view = self.view()
+        response = view(RequestFactory().post("/", { 'unique': '1' }, HTTP_IDEMPOTENCY_KEY='abc'))
+        self.assertEqual(302, response.status_code)
+        location = response['Location']
+        self.assertEqual('/%s/' % TestModel.objects.get().pk, location)
+        with self.assertNumQueries(1):
+            response = view(RequestFactory().post("/", { 'unique': '1' }, HTTP_IDEMPOTENCY_KEY='abc'))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(location, response['Location'])
+        self.assertEqual(1, TestModel.objects.count())
+        # a different key is a different submission
+        response = view(RequestFactory().post("/", { 'unique': '1' }, HTTP_IDEMPOTENCY_KEY='def'))
+        self.assertEqual(200, response.status_code)
+
+    def test_field(self):
+        view = self.view()
+        for unique in ('1', '2'):
+            response = view(RequestFactory().post("/", { 'unique': unique, 'idempotency_key': 'abc' }))
+            self.assertEqual(302, response.status_code)
+        self.assertEqual([1], [tm.unique for tm in TestModel.objects.all()])
+
+    def test_context(self):
+        response = self.view()(RequestFactory().get("/"))
+        self.assertEqual(32, len(response.context_data['idempotency_key']))
+
+    def test_failure_not_recorded(self):
+        TestModel.objects.create(unique=1)
+        view = self.view(UncheckedTestForm)
+        response = view(RequestFactory().post("/", { 'unique': '1' }, HTTP_IDEMPOTENCY_KEY='abc'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, IdempotencyKey.objects.count())
+        response = view(RequestFactory().post("/", { 'unique': '2' }, HTTP_IDEMPOTENCY_KEY='abc'))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, IdempotencyKey.objects.count())
+
+    def test_racing(self):
+        saved = threading.Event()
+        release = threading.Event()
+
+        class BlockingForm(UncheckedTestForm):
+            def save(self, *args, **kwargs):
+                obj = super(BlockingForm, self).save(*args, **kwargs)
+                saved.set()
+                release.wait(5)
+                return obj
+        responses = {}
+
+        def post(name, form_class):
+            try:
+                responses[name] = self.view(form_class)(
+                    RequestFactory().post("/", { 'unique': '1' }, HTTP_IDEMPOTENCY_KEY='abc'),
+                )
+            finally:
+                connection.close()
+        first = threading.Thread(target=post, args=['first', BlockingForm])
+        first.start()
+        saved.wait(5)
+        second = threading.Thread(target=post, args=['second', UncheckedTestForm])
+        second.start()
+        # give the second time to queue behind the first's key
+        second.join(0.5)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(302, responses['first'].status_code)
+        self.assertEqual(302, responses['second'].status_code)
+        self.assertEqual(responses['first']['Location'], responses['second']['Location'])
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_expire(self):
+        IdempotencyKey.objects.create(key='old', created=timezone.now() - datetime.timedelta(days=2))
+        IdempotencyKey.objects.create(key='new')
+        self.assertEqual(1, IdempotencyKey.objects.expire())
+        self.assertEqual(['new'], [k.key for k in IdempotencyKey.objects.all()])
+        self.assertEqual(1, IdempotencyKey.objects.expire(datetime.timedelta(0)))
+
+    def test_migrations(self):
+        # runtests.py sets DEFAULT_AUTO_FIELD to something other than
+        # what the migration has
+        call_command('makemigrations', 'django_database_constraints', check=True, dry_run=True, verbosity=0)
+
+
+class SideEffectsTestForm(UncheckedTestForm):
+    def tsave(self, convertors=None):
+        self.side_effects = sideeffects.SideEffects(pool=self.pool)
+        return forms.transactional_save(self, convertors, self.side_effects)
+
+    def save(self):
+        # as if we'd done something external before the INSERT
+        self.side_effects.compensation(lambda: self.log.append('compensated'))
+        obj = super(SideEffectsTestForm, self).save()
+        self.side_effects.on_commit(lambda: self.log.append(threading.current_thread().name))
+        return obj
+
+
+class TestSideEffects(TransactionTestCase):
+    """Are side effects run after commit, and compensations on rollback?"""
+
+    def setUp(self):
+        self.pool = sideeffects.SideEffectPool(workers=2, max_pending=4)
+        self.addCleanup(self.pool.shutdown)
+        self.log = []
+
+    def form(self, unique):
+        form = SideEffectsTestForm({ 'unique': unique })
+        form.pool = self.pool
+        form.log = self.log
+        self.assertTrue(form.is_valid())
+        return form
+
+    def test_committed(self):
+        self.form('1').tsave()
+        self.assertTrue(self.pool.drain(5))
+        self.assertEqual(1, len(self.log))
+        self.assertTrue(self.log[0].startswith('django_database_constraints_side_effects'))
+
+    def test_rolled_back(self):
+        TestModel.objects.create(unique=1)
+        with self.assertRaises(django.forms.ValidationError):
+            self.form('1').tsave()
+        self.assertTrue(self.pool.drain(5))
+        self.assertEqual(['compensated'], self.log)
+
+    def test_outer_transaction(self):
+        with transaction.atomic():
+            self.form('1').tsave()
+            self.assertTrue(self.pool.drain(5))
+            # not until the outer transaction commits
+            self.assertEqual([], self.log)
+        self.assertTrue(self.pool.drain(5))
+        self.assertEqual(1, len(self.log))
+
+        del self.log[:]
+        try:
+            with transaction.atomic():
+                self.form('2').tsave()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(self.pool.drain(5))
+        self.assertEqual([], self.log)
+
+    def test_back_pressure(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        pool = sideeffects.SideEffectPool(workers=1, max_pending=1)
+        self.addCleanup(pool.shutdown)
+        self.assertTrue(pool.submit(lambda: release.wait(5)) is not None)
+        self.assertEqual(None, pool.submit(lambda: None, timeout=0.1))
+        self.assertFalse(pool.drain(0.1))
+        release.set()
+        self.assertTrue(pool.drain(5))
+        self.assertTrue(pool.submit(lambda: None, timeout=0.1) is not None)
+
+    def test_back_pressure_waits(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        pool = sideeffects.SideEffectPool(workers=1, max_pending=1)
+        self.addCleanup(pool.shutdown)
+        pool.submit(lambda: release.wait(5))
+        timer = threading.Timer(0.2, release.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = monotonic()
+        # no timeout, so we wait for room rather than giving up
+        future = pool.submit(lambda: 'done')
+        self.assertTrue(monotonic() - started >= 0.1)
+        self.assertEqual('done', future.result(5))
+
+    def test_failures_logged(self):
+        def fail():
+            raise ValueError
+        with self.assertLogs('django_database_constraints.sideeffects', 'ERROR'):
+            self.pool.submit(fail).result(5)
+
+
+class OtherRouter(object):
+    """Send TestModel to the other database."""
+
+    def db_for_read(self, model, **hints):
+        if model is TestModel:
+            return 'other'
+
+    db_for_write = db_for_read
+
+
+class ReplicaRouter(object):
+    """Read TestModel from the other database, as if it were a replica."""
+
+    def db_for_read(self, model, **hints):
+        if model is TestModel:
+            return 'other'
+
+
+@override_settings(DATABASE_ROUTERS=[OtherRouter()])
+class TestMultipleDatabases(TransactionTestCase):
+    """Do saves follow the router?"""
+    databases = {'default', 'other'}
+
+    def test_routed(self):
+        with transaction.atomic(using='default'):
+            form = TransactionalTestForm({ 'unique': '1' })
+            self.assertTrue(form.is_valid())
+            form.tsave()
+            # our own transaction, since default's isn't the one we're on
+            self.assertEqual(forms.TRANSACTION, form.transaction_strategy)
+        self.assertEqual(1, TestModel.objects.using('other').count())
+        self.assertEqual(0, TestModel.objects.using('default').count())
+
+    def test_converted(self):
+        TestModel.objects.create(unique=1)
+        form = UncheckedTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            forms.transactional_save(form)
+        self.assertEqual(['unique'], list(form.errors.keys()))
+        self.assertFalse(connections['other'].in_atomic_block)
+
+    def test_view(self):
+        view = TransactionalUpdateView.as_view(
+            model=TestModel, form_class=TestForm, success_url='/',
+            select_for_update=True, idempotency_keys=True,
+        )
+        obj = TestModel.objects.create(unique=1)
+        response = view(RequestFactory().post("/", { 'unique': '2' }, HTTP_IDEMPOTENCY_KEY='abc'), pk=obj.pk)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(2, TestModel.objects.get().unique)
+        self.assertEqual(1, IdempotencyKey.objects.using('other').count())
+
+    @override_settings(DATABASE_ROUTERS=[ReplicaRouter()])
+    def test_create_ignoring_conflicts(self):
+        view = TransactionalCreateView.as_view(
+            model=TestModel, form_class=TestForm, success_url='/',
+            insert_ignoring_conflicts=True,
+        )
+        TestModel.objects.create(unique=1)
+        # the "replica" doesn't have it, so only the INSERT notices
+        response = view(RequestFactory().post("/", { 'unique': '1' }))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            ['Test model with this Unique already exists.'],
+            response.context_data['form'].errors['unique'],
+        )
+
+    def test_nested_atomic(self):
+        class BothForm(UncheckedTestForm):
+            def save(self):
+                TestParentModel.objects.create()
+                return super(BothForm, self).save()
+        TestModel.objects.create(unique=1)
+        for unique, saved in (('1', False), ('2', True)):
+            form = BothForm({ 'unique': unique })
+            self.assertTrue(form.is_valid())
+            try:
+                forms.transactional_save(
+                    form, tx_context_manager=forms.nested_atomic(['other', 'default']),
+                )
+            except django.forms.ValidationError:
+                self.assertFalse(saved)
+            else:
+                self.assertTrue(saved)
+            self.assertEqual(1 if saved else 0, TestParentModel.objects.using('default').count())
+        self.assertEqual(2, TestModel.objects.using('other').count())
+
+
+class TestTransactionalModelMixin(TransactionTestCase):
+    """Can models be saved transactionally outside forms?"""
+
+    def test_tsave(self):
+        obj = TestTransactionalModel(unique=1)
+        obj.tsave()
+        self.assertFalse(obj._state.adding)
+        self.assertEqual(1, TestTransactionalModel.objects.count())
+
+    def test_tsave_conflict(self):
+        TestTransactionalModel.objects.create(unique=1)
+        obj = TestTransactionalModel(unique=1)
+        with transaction.atomic():
+            with self.assertRaises(django.forms.ValidationError) as cm:
+                obj.tsave()
+            # in a savepoint, so the outer transaction is still usable
+            self.assertEqual(1, TestTransactionalModel.objects.count())
+        self.assertEqual(['unique'], list(cm.exception.message_dict.keys()))
+        self.assertEqual(None, obj.pk)
+        self.assertTrue(obj._state.adding)
+
+    def test_bulk_tsave(self):
+        existing = TestTransactionalModel.objects.create(unique=1)
+        other = TestTransactionalModel.objects.create(unique=2)
+        existing.name = 'changed'
+        other.unique = 1
+        objs = [
+            existing,
+            TestTransactionalModel(unique=3),
+            TestTransactionalModel(unique=3),
+            other,
+            TestTransactionalModel(unique=4),
+        ]
+        results = TestTransactionalModel.objects.bulk_tsave(objs, batch_size=3)
+        self.assertEqual(objs, [r.obj for r in results])
+        self.assertEqual([True, True, False, False, True], [r.saved for r in results])
+        self.assertEqual(['unique'], list(results[2].error.message_dict.keys()))
+        self.assertEqual(['unique'], list(results[3].error.message_dict.keys()))
+        self.assertEqual(None, objs[2].pk)
+        self.assertTrue(objs[4].pk is not None)
+        self.assertEqual(
+            [(1, 'changed'), (2, ''), (3, ''), (4, '')],
+            list(TestTransactionalModel.objects.order_by('unique').values_list('unique', 'name')),
+        )
+
+    def test_bulk_tsave_deferred(self):
+        parent = TestParentModel.objects.create()
+        for check_constraints in [True, False]:
+            TestTogetherModel.objects.all().delete()
+            objs = [
+                TestTogetherModel(parent=parent, order=1),
+                TestTogetherModel(parent=parent, order=2),
+                TestTogetherModel(parent_id=parent.pk + 100, order=3),
+                TestTogetherModel(parent=parent, order=4),
+            ]
+            results = TransactionalQuerySet(TestTogetherModel).bulk_tsave(
+                objs, batch_size=2, check_constraints=check_constraints,
+            )
+            self.assertEqual([True, True, False, True], [r.saved for r in results])
+            self.assertEqual(['parent'], list(results[2].error.message_dict.keys()))
+            self.assertEqual(None, objs[2].pk)
+            self.assertEqual([1, 2, 4], list(TestTogetherModel.objects.order_by('order').values_list('order', flat=True)))
+
+    def test_bulk_tsave_statements(self):
+        objs = [TestTransactionalModel(unique=i) for i in range(10)]
+        with CaptureQueriesContext(connection) as queries:
+            results = TestTransactionalModel.objects.bulk_tsave(objs, batch_size=5)
+        self.assertTrue(all(r.saved for r in results))
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        # without the primary keys back from a bulk insert, one per row
+        self.assertEqual(2 if formsets._can_return_rows_from_bulk_insert(connection) else 10, len(inserts))
+
+
+class TestAudit(TransactionTestCase):
+    """Does the audit find redundant and missing checks?"""
+
+    def findings(self, report, model):
+        for entry in report['models']:
+            if entry['model'] == model._meta.label:
+                return dict(
+                    ((f['kind'], f['check'], tuple(f['fields'])), f) for f in entry['findings']
+                )
+
+    def test_audit(self):
+        out = StringIO()
+        call_command('audit_constraints', 'testapp', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual('default', report['database'])
+
+        findings = self.findings(report, TestModel)
+        self.assertEqual([(audit.REDUNDANT, 'unique', ('unique',))], list(findings.keys()))
+        self.assertEqual(1, findings[(audit.REDUNDANT, 'unique', ('unique',))]['queries_per_save'])
+
+        findings = self.findings(report, TestTogetherModel)
+        self.assertEqual(
+            set([
+                (audit.REDUNDANT, 'unique', ('parent', 'order')),
+                (audit.REDUNDANT, 'foreign_key', ('parent',)),
+            ]),
+            set(findings.keys()),
+        )
+        self.assertEqual(2, findings[(audit.REDUNDANT, 'foreign_key', ('parent',))]['queries_per_save'])
+
+        findings = self.findings(report, TestAuditModel)
+        self.assertEqual(
+            set([
+                (audit.UNENFORCED, 'unique_for_date', ('slug', 'date')),
+                (audit.UNENFORCED, 'foreign_key', ('parent',)),
+                (audit.UNENFORCED, 'clean', ()),
+            ]),
+            set(findings.keys()),
+        )
+        self.assertTrue(report['unenforced'] >= 3)
+        self.assertTrue(report['redundant_queries_per_save'] >= 4)
+
+    def test_model_needing_arguments(self):
+        findings = audit.audit_model(TestArgumentsModel, {})
+        self.assertEqual(
+            [(audit.UNENFORCED, 'unique', ['code'])],
+            [(f['kind'], f['check'], f['fields']) for f in findings],
+        )
+
+    def test_fail_on_unenforced(self):
+        with self.assertRaises(CommandError):
+            call_command('audit_constraints', 'testapp', '--fail-on-unenforced', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('audit_constraints', 'no_such_app', stdout=StringIO())
+
+
+class ConflictCacheTestForm(TransactionalTestForm):
+    trust_database = True
+
+
+class TestConflictCache(TransactionTestCase):
+    """Are repeats of a duplicate rejected without a transaction?"""
+
+    def setUp(self):
+        self.cache = conflicts.LocalConflictCache().connect()
+        self.addCleanup(self.cache.disconnect)
+        self.received = []
+        def receiver(sender, **kwargs):
+            self.received.append(kwargs)
+        signals.transactional_save_finished.connect(receiver, weak=False, dispatch_uid='test_conflict_cache')
+        self.addCleanup(signals.transactional_save_finished.disconnect, dispatch_uid='test_conflict_cache')
+        self.existing = TestModel.objects.create(unique=1)
+
+    def tsave(self, data, instance=None):
+        form = ConflictCacheTestForm(data, instance=instance)
+        self.assertTrue(form.is_valid())
+        form.tsave(conflict_cache=self.cache)
+        return form
+
+    def test_short_circuit(self):
+        first = ConflictCacheTestForm({ 'unique': '1' })
+        self.assertTrue(first.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            first.tsave(conflict_cache=self.cache)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(False, self.received[0]['conflict_cache_hit'])
+
+        form = ConflictCacheTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave(conflict_cache=self.cache)
+        self.assertEqual(first.errors, form.errors)
+        self.assertEqual(True, self.received[1]['conflict_cache_hit'])
+        self.assertEqual(signals.CONVERTED, self.received[1]['outcome'])
+        self.assertEqual(0, self.received[1]['attempts'])
+        self.assertEqual(TestModel, self.received[1]['model'])
+        self.assertEqual(self.received[0]['constraint_name'], self.received[1]['constraint_name'])
+
+        # other values aren't affected
+        self.tsave({ 'unique': '2' })
+        self.assertEqual(2, TestModel.objects.count())
+
+    def test_own_row(self):
+        with self.assertRaises(django.forms.ValidationError):
+            self.tsave({ 'unique': '1' })
+        self.tsave({ 'unique': '1' }, instance=self.existing)
+        self.assertEqual(False, self.received[1]['conflict_cache_hit'])
+
+    def test_invalidated_on_change(self):
+        with self.assertRaises(django.forms.ValidationError):
+            self.tsave({ 'unique': '1' })
+        self.existing.unique = 3
+        self.existing.save()
+        self.assertEqual(0, len(self.cache))
+        self.tsave({ 'unique': '1' })
+
+    def test_invalidated_on_delete(self):
+        with self.assertRaises(django.forms.ValidationError):
+            self.tsave({ 'unique': '1' })
+        with transaction.atomic():
+            self.existing.delete()
+            # not until the delete commits
+            self.assertEqual(1, len(self.cache))
+        self.assertEqual(0, len(self.cache))
+        self.tsave({ 'unique': '1' })
+
+    def test_unique_together(self):
+        parent = TestParentModel.objects.create()
+        TestTogetherModel.objects.create(parent=parent, order=1)
+        for i in range(2):
+            form = TestTogetherForm({ 'parent': parent.pk, 'order': '1' })
+            form.trust_database = True
+            form.validate_unique = lambda: None
+            self.assertTrue(form.is_valid())
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave(conflict_cache=self.cache)
+            self.assertEqual(1, len(form.non_field_errors()))
+        self.assertEqual([False, True], [r['conflict_cache_hit'] for r in self.received])
+
+    def test_model_needing_arguments(self):
+        self.assertTrue(conflicts._has_unique_values(TestArgumentsModel))
+        self.assertFalse(conflicts._has_unique_values(TestParentModel))
+        # as when one is saved, which mustn't fail in our receiver
+        models.signals.post_save.send(
+            sender=TestArgumentsModel, instance=TestArgumentsModel('tenant', pk=1),
+            created=False, raw=False, using='default', update_fields=None,
+        )
+
+    def test_eviction(self):
+        cache = conflicts.LocalConflictCache(max_size=2, ttl=60)
+        cache.add('a', 'x', 'c')
+        cache.add('b', 'y', 'c')
+        cache.get('a')
+        cache.add('c', 'y', 'c')
+        self.assertEqual(('x', 'c'), cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        cache.invalidate('y')
+        self.assertEqual(None, cache.get('c'))
+        self.assertEqual(1, len(cache))
+
+        cache = conflicts.LocalConflictCache(ttl=0)
+        cache.add('a', 'x', 'c')
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_django_cache(self):
+        cache = conflicts.DjangoConflictCache().connect()
+        self.addCleanup(cache.disconnect)
+        self.addCleanup(cache.cache.clear)
+        with self.assertRaises(django.forms.ValidationError):
+            ConflictCacheTestForm({ 'unique': '1' }).tsave(conflict_cache=cache)
+        form = ConflictCacheTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            with self.assertRaises(django.forms.ValidationError):
+                form.tsave(conflict_cache=cache)
+        self.existing.delete()
+        form = ConflictCacheTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        form.tsave(conflict_cache=cache)
+
+    def test_view_and_collector(self):
+        collector = StatsCollector().connect()
+        self.addCleanup(collector.disconnect)
+        view = TransactionalCreateView.as_view(
+            model=TestModel, form_class=TestForm, success_url='/',
+            trust_database=True, tsave_conflict_cache=self.cache,
+        )
+        for i in range(4):
+            response = view(RequestFactory().post("/", { 'unique': '1' }))
+            self.assertEqual(200, response.status_code)
+        saves = collector.snapshot()['saves']['testapp.TestModel']
+        self.assertEqual({ 'hits': 3, 'misses': 1, 'hit_rate': 0.75 }, saves['conflict_cache'])
+        self.assertEqual({signals.CONVERTED: 4}, saves['outcomes'])
+
+    def test_default_cache(self):
+        self.assertTrue(conflicts.get_cache() is conflicts.get_cache())
+        previous = conflicts.set_cache(self.cache)
+        self.addCleanup(conflicts.set_cache, previous)
+        with self.assertRaises(django.forms.ValidationError):
+            self.tsave({ 'unique': '1' })
+        form = ConflictCacheTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        with self.assertRaises(django.forms.ValidationError):
+            forms.transactional_save(form, conflict_cache=True)
+        self.assertEqual(True, self.received[1]['conflict_cache_hit'])
+
+
+class TestBackendDecoders(TransactionTestCase):
+    """Can we get structured information out of database errors?"""
+
+    def test_decoder_is_cached(self):
+        self.assertIs(backends.get_decoder(), backends.get_decoder())
+
+    def test_not_null(self):
+        try:
+            with transaction.atomic():
+                TestModel.objects.create(unique=None)
+        except IntegrityError as e:
+            info = backends.decode(e)
+        self.assertEqual(constraints.NOT_NULL, info.kind)
+        self.assertEqual(('unique',), info.columns)
+
+    def test_mysql_duplicate_entry(self):
+        info = backends.MySQLDecoder().decode(IntegrityError(
+            1062, "Duplicate entry '1' for key 'testapp_testmodel.unique'",
+        ))
+        self.assertEqual(constraints.UNIQUE, info.kind)
+        self.assertEqual('unique', info.constraint_name)
+        self.assertEqual('testapp_testmodel', info.table)
+
+    def test_mysql_foreign_key(self):
+        info = backends.MySQLDecoder().decode(IntegrityError(
+            1452,
+            "Cannot add or update a child row: a foreign key constraint fails "
+            "(`test_dummy`.`testapp_testtogethermodel`, "
+            "CONSTRAINT `some_fk_name` FOREIGN KEY (`parent_id`) REFERENCES "
+            "`testapp_testparentmodel` (`id`))",
+        ))
+        self.assertEqual(constraints.FOREIGN_KEY, info.kind)
+        self.assertEqual('some_fk_name', info.constraint_name)
+        self.assertEqual(('parent_id',), info.columns)
+
+    def test_retryable(self):
+        self.assertTrue(backends.is_retryable(retryable_error()))
+        info = backends.MySQLDecoder().decode(OperationalError(1213, 'Deadlock found'))
+        self.assertEqual(backends.DEADLOCK, info.kind)
+        info = backends.SQLiteDecoder().decode(OperationalError('database is locked'))
+        self.assertEqual(backends.LOCKED, info.kind)
+
+    def test_timeouts(self):
+        info = backends.MySQLDecoder().decode(OperationalError(3024, 'Query execution was interrupted'))
+        self.assertEqual(backends.STATEMENT_TIMEOUT, info.kind)
+        self.assertFalse(backends.STATEMENT_TIMEOUT in backends.RETRYABLE)
+
+    def test_sqlite_unique(self):
+        info = backends.SQLiteDecoder().decode(IntegrityError(
+            "UNIQUE constraint failed: "
+            "testapp_testtogethermodel.parent_id, "
+            "testapp_testtogethermodel.order",
+        ))
+        self.assertEqual(constraints.UNIQUE, info.kind)
+        self.assertEqual(('parent_id', 'order'), info.columns)
+        constraint = constraints.lookup_columns(info.table, info.columns)
+        self.assertEqual(('parent', 'order'), constraint.fields)
+
+
+def run_async(func, *args, **kwargs):
+    # on a loop of its own, so func can make futures for it
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(func(*args, **kwargs))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "async needs Python 3.5")
+class TestAsync(TransactionTestCase):
+    """Do the async versions save on the executor, and overlap?"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_atransactional_save(self):
+        from .asynchronous import atransactional_save
+
+        form = TestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        TestModel.objects.create(unique=1)
+        with self.assertRaises(django.forms.ValidationError):
+            run_async(atransactional_save, form)
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_atsave(self):
+        form = TransactionalTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        obj = run_async(form.atsave)
+        self.assertEqual(1, TestModel.objects.get(pk=obj.pk).unique)
+
+    def test_atsave_arguments(self):
+        form = TransactionalTestForm({ 'unique': '1' })
+        self.assertTrue(form.is_valid())
+        TestModel.objects.create(unique=1)
+        cache = conflicts.LocalConflictCache()
+        with self.assertRaises(django.forms.ValidationError):
+            run_async(form.atsave, advisory_lock=True, lock_timeout=1, conflict_cache=cache)
+        self.assertEqual(1, len(cache))
+
+    def test_overlapping(self):
+        barrier = threading.Barrier(2, timeout=5)
+        threads = []
+
+        class _Form(TransactionalTestForm):
+            def save(self, *args, **kwargs):
+                obj = super(_Form, self).save(*args, **kwargs)
+                threads.append(threading.current_thread())
+                # both are inside their transactions at once
+                barrier.wait()
+                return obj
+
+        forms = [ _Form({ 'unique': str(i) }) for i in range(2) ]
+        for form in forms:
+            self.assertTrue(form.is_valid())
+        run_async(lambda: asyncio.gather(*[ form.atsave() for form in forms ]))
+        self.assertEqual(2, TestModel.objects.count())
+        self.assertNotEqual(threads[0], threads[1])
+        self.assertTrue(threading.current_thread() not in threads)
+
+    def test_view(self):
+        from .asynchronous import AsyncCreateView
+
+        class _CreateView(AsyncCreateView):
+            model = TestModel
+            form_class = TestForm
+            success_url = '/'
+
+        view = _CreateView.as_view()
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        response = run_async(view, self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(302, response.status_code)
+        # the handlers we don't make async
+        self.assertEqual(200, run_async(view, self.factory.options("/")).status_code)
+        self.assertEqual(405, run_async(view, self.factory.delete("/")).status_code)
+        TestModel.objects.all().update(unique=2)
+        response = run_async(view, self.factory.post("/", { 'unique': '2' }))
+        response.render()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('Test model with this Unique already exists.') in response.content)
+
+
+def formset_data(rows, initial=0, prefix='form'):
+    data = {
+        '%s-TOTAL_FORMS' % prefix: str(len(rows)),
+        '%s-INITIAL_FORMS' % prefix: str(initial),
+    }
+    for i, row in enumerate(rows):
+        for key, value in row.items():
+            data['%s-%d-%s' % (prefix, i, key)] = str(value)
+    return data
+
+
+@unittest.skipUnless(hasattr(models, 'Deferrable'), "needs Django 3.1")
+class TestDeferredConstraints(TransactionTestCase):
+    """Can saves pass through states that violate deferred constraints?"""
+
+    def setUp(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("only postgresql has deferrable constraints")
+        self.rows = [ TestOrderModel.objects.create(order=i) for i in range(3) ]
+
+    def get_form(self, order, then=()):
+        # move the first row to order, then the others as in then
+        rows = self.rows
+
+        class _Form(TestOrderForm):
+            def save(self, *args, **kwargs):
+                obj = super(_Form, self).save(*args, **kwargs)
+                for row, order in zip(rows[1:], then):
+                    TestOrderModel.objects.filter(pk=row.pk).update(order=order)
+                return obj
+        form = _Form({ 'order': str(order) }, instance=rows[0])
+        self.assertTrue(form.is_valid())
+        return form
+
+    def orders(self):
+        return list(TestOrderModel.objects.order_by('pk').values_list('order', flat=True))
+
+    def test_not_deferred(self):
+        form = self.get_form(1, then=[2, 0])
+        with self.assertRaises(django.forms.ValidationError):
+            forms.transactional_save(form)
+        self.assertEqual(['Test order model with this Order already exists.'], form.errors['order'])
+        self.assertEqual([0, 1, 2], self.orders())
+
+    def test_deferred(self):
+        form = self.get_form(1, then=[2, 0])
+        forms.transactional_save(form, defer_constraints=['test_order_unique'])
+        self.assertEqual([1, 2, 0], self.orders())
+
+    def test_violated_on_commit(self):
+        form = self.get_form(1)
+        with self.assertRaises(django.forms.ValidationError):
+            forms.transactional_save(form, defer_constraints=True)
+        self.assertEqual(['Test order model with this Order already exists.'], form.errors['order'])
+        self.assertEqual([0, 1, 2], self.orders())
+
+    def test_violated_in_outer_transaction(self):
+        form = self.get_form(1)
+        with transaction.atomic():
+            with self.assertRaises(django.forms.ValidationError):
+                forms.transactional_save(form, defer_constraints=['test_order_unique'])
+            # the savepoint was rolled back, and we can carry on
+            self.assertEqual([0, 1, 2], self.orders())
+        self.assertEqual(['Test order model with this Order already exists.'], form.errors['order'])
+
+    def test_restored_in_outer_transaction(self):
+        form = self.get_form(1, then=[2, 0])
+        with transaction.atomic():
+            forms.transactional_save(form, defer_constraints=True)
+            # Django's foreign keys are INITIALLY DEFERRED, and should be
+            # again for the rest of the transaction
+            TestTogetherModel.objects.create(parent_id=1000, order=0)
+            TestParentModel.objects.create(pk=1000)
+        self.assertEqual([1, 2, 0], self.orders())
+        self.assertEqual(1, TestTogetherModel.objects.count())
+
+    def test_formset_reorder(self):
+        formset_class = django.forms.modelformset_factory(
+            TestOrderModel, form=TestOrderForm, formset=formsets.BaseModelFormSet, extra=0,
+        )
+        formset_class.tsave_defer_constraints = ['test_order_unique']
+        formset = formset_class(
+            formset_data([
+                { 'id': row.pk, 'order': (i + 1) % 3 } for i, row in enumerate(self.rows)
+            ], initial=3),
+            queryset=TestOrderModel.objects.order_by('pk'),
+        )
+        self.assertTrue(formset.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            formset.tsave()
+        updates = [ q for q in queries if q['sql'].startswith('UPDATE') ]
+        self.assertEqual(1, len(updates))
+        self.assertEqual([1, 2, 0], self.orders())
+
+
+class TestFormSets(TransactionTestCase):
+    """Do formsets save in bulk, and put errors on the right rows?"""
+
+    def get_formset_class(self, **kwargs):
+        return django.forms.modelformset_factory(
+            TestModel, fields=['unique'], formset=formsets.BaseModelFormSet, **kwargs
+        )
+
+    def test_create(self):
+        formset = self.get_formset_class(extra=0)(
+            formset_data([{ 'unique': i } for i in range(10)]),
+            queryset=TestModel.objects.none(),
+        )
+        self.assertTrue(formset.is_valid())
+        queries = 3 if formsets._can_return_rows_from_bulk_insert(connection) else 12
+        with self.assertNumQueries(queries + TRANSACTION_QUERIES):
+            # SAVEPOINT, INSERT, RELEASE SAVEPOINT
+            saved = formset.tsave()
+        self.assertEqual(10, len(saved))
+        self.assertTrue(all(obj.pk is not None for obj in saved))
+        self.assertEqual(list(range(10)), sorted(TestModel.objects.values_list('unique', flat=True)))
+
+    def test_failing_rows(self):
+        formset = self.get_formset_class(extra=0)(
+            formset_data([{ 'unique': i } for i in range(8)]),
+            queryset=TestModel.objects.none(),
+        )
+        self.assertTrue(formset.is_valid())
+        TestModel.objects.create(unique=2)
+        TestModel.objects.create(unique=5)
+        with self.assertRaises(django.forms.ValidationError):
+            formset.tsave()
+        for i, form in enumerate(formset.forms):
+            if i in (2, 5):
+                self.assertEqual(
+                    { 'unique': ['Test model with this Unique already exists.'] },
+                    form.errors,
+                )
+            else:
+                self.assertEqual({}, form.errors)
+                self.assertIsNone(form.instance.pk)
+        self.assertEqual(2, TestModel.objects.count())
+
+    def test_update_and_delete(self):
+        objs = [ TestModel.objects.create(unique=i) for i in range(3) ]
+        formset = self.get_formset_class(extra=1, can_delete=True)(
+            formset_data([
+                { 'id': objs[0].pk, 'unique': 10 },
+                { 'id': objs[1].pk, 'unique': 1, 'DELETE': 'on' },
+                { 'id': objs[2].pk, 'unique': 2 },
+                { 'unique': 3 },
+            ], initial=3),
+            queryset=TestModel.objects.order_by('pk'),
+        )
+        self.assertTrue(formset.is_valid())
+        formset.tsave()
+        self.assertEqual([2, 3, 10], sorted(TestModel.objects.values_list('unique', flat=True)))
+
+    def test_failed_delete_is_restored(self):
+        objs = [ TestModel.objects.create(unique=i) for i in range(2) ]
+        formset = self.get_formset_class(extra=1, can_delete=True)(
+            formset_data([
+                { 'id': objs[0].pk, 'unique': 0, 'DELETE': 'on' },
+                { 'id': objs[1].pk, 'unique': 1 },
+                { 'unique': 5 },
+            ], initial=2),
+            queryset=TestModel.objects.order_by('pk'),
+        )
+        self.assertTrue(formset.is_valid())
+        TestModel.objects.create(unique=5)
+        with self.assertRaises(django.forms.ValidationError):
+            formset.tsave()
+        self.assertEqual(objs[0].pk, formset.forms[0].instance.pk)
+        self.assertEqual(3, TestModel.objects.count())
+
+    def test_inline(self):
+        parent = TestParentModel.objects.create()
+        formset_class = django.forms.inlineformset_factory(
+            TestParentModel, TestTogetherModel, form=TestTogetherForm,
+            formset=formsets.BaseInlineFormSet, extra=0,
+        )
+        prefix = formset_class.get_default_prefix()
+        formset = formset_class(
+            formset_data([{ 'order': i } for i in range(3)], prefix=prefix),
+            instance=parent,
+        )
+        self.assertTrue(formset.is_valid())
+        TestTogetherModel.objects.create(parent=parent, order=1)
+        with self.assertRaises(django.forms.ValidationError):
+            formset.tsave()
+        self.assertEqual(
+            ["Test together model with this Parent and Order already exists."],
+            list(formset.forms[1].non_field_errors()),
+        )
+        self.assertEqual(1, TestTogetherModel.objects.count())
+
+
+class TestBulkCreateView(TransactionTestCase):
+    """Does the bulk create view create all or nothing, and say why?"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def post(self, items, **initkwargs):
+        view = TransactionalBulkCreateView.as_view(
+            model=TestModel, form_class=TestForm, batch_size=3, **initkwargs
+        )
+        response = view(self.factory.post("/", json.dumps(items), content_type='application/json'))
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def test_create(self):
+        status, content = self.post([{ 'unique': i } for i in range(10)])
+        self.assertEqual(201, status)
+        self.assertEqual(['created'] * 10, [r['status'] for r in content['results']])
+        self.assertEqual(
+            [r['id'] for r in content['results']],
+            [TestModel.objects.get(unique=i).pk for i in range(10)],
+        )
+
+    def test_invalid(self):
+        status, content = self.post([{ 'unique': 1 }, { 'unique': 'x' }])
+        self.assertEqual(400, status)
+        self.assertEqual('not_created', content['results'][0]['status'])
+        self.assertEqual({ 'unique': ['Enter a whole number.'] }, content['results'][1]['errors'])
+        self.assertEqual(0, TestModel.objects.count())
+
+    def test_integrity_error(self):
+        # trust the database, so the duplicate gets as far as the INSERT
+        status, content = self.post([{ 'unique': i } for i in range(5)] + [{ 'unique': 3 }], trust_database=True)
+        self.assertEqual(400, status)
+        self.assertEqual(['not_created'] * 5, [r['status'] for r in content['results'][:5]])
+        self.assertEqual(
+            { 'unique': ['Test model with this Unique already exists.'] },
+            content['results'][5]['errors'],
+        )
+        self.assertEqual(0, TestModel.objects.count())
+
+    def test_partial(self):
+        TestModel.objects.create(unique=2)
+        status, content = self.post([{ 'unique': i } for i in range(5)], trust_database=True, partial=True)
+        self.assertEqual(207, status)
+        self.assertEqual(
+            ['created', 'created', 'invalid', 'created', 'created'],
+            [r['status'] for r in content['results']],
+        )
+        self.assertEqual(5, TestModel.objects.count())
+
+    def test_integrity_error_on_commit(self):
+        if not connection.features.can_defer_constraint_checks:
+            self.skipTest("constraints aren't deferred")
+
+        class _TestTogetherForm(TestTogetherForm):
+            trust_database_foreign_keys = True
+
+        parent = TestParentModel.objects.create()
+        view = TransactionalBulkCreateView.as_view(
+            model=TestTogetherModel, form_class=_TestTogetherForm, partial=True,
+        )
+        items = [{ 'parent': parent.pk, 'order': 1 }, { 'parent': parent.pk + 100, 'order': 2 }]
+        response = view(self.factory.post("/", json.dumps(items), content_type='application/json'))
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(['invalid', 'invalid'], [r['status'] for r in content['results']])
+        self.assertEqual(0, TestTogetherModel.objects.count())
+
+    def test_not_a_list(self):
+        view = TransactionalBulkCreateView.as_view(model=TestModel, form_class=TestForm)
+        response = view(self.factory.post("/", '{"unique": 1}', content_type='application/json'))
+        self.assertEqual(400, response.status_code)
+
+
+@override_settings(ROOT_URLCONF='django_database_constraints.tests')
+class TestAdmin(TransactionTestCase):
+    """Does the admin show constraint violations as errors?"""
+
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_add(self):
+        TestModel.objects.create(unique=1)
+        response = self.client.post('/admin/testapp/testmodel/add/', { 'unique': '1' })
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            ['Test model with this Unique already exists.'],
+            response.context['adminform'].form.errors['unique'],
+        )
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_add_racing(self):
+        # the form is validated again after the failed save, and this
+        # time sees the conflict for itself
+        response = self.client.post('/racing_admin/testapp/testmodel/add/', { 'unique': '1' })
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            ['Test model with this Unique already exists.'],
+            response.context['adminform'].form.errors['unique'],
+        )
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_add_succeeds(self):
+        response = self.client.post('/admin/testapp/testmodel/add/', { 'unique': '1' })
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, TestModel.objects.count())
+
+    def changelist_data(self, rows):
+        data = formset_data(rows, initial=len(rows))
+        data['_save'] = 'Save'
+        return data
+
+    def test_changelist(self):
+        a = TestModel.objects.create(unique=1)
+        b = TestModel.objects.create(unique=2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/admin/testapp/testmodel/', self.changelist_data([
+                { 'id': b.pk, 'unique': 20 },
+                { 'id': a.pk, 'unique': 10 },
+            ]))
+        self.assertEqual(302, response.status_code)
+        updates = [ q for q in queries if q['sql'].startswith('UPDATE') and TestModel._meta.db_table in q['sql'] ]
+        self.assertEqual(1, len(updates))
+        self.assertEqual([10, 20], sorted(TestModel.objects.values_list('unique', flat=True)))
+
+    def test_changelist_conflict(self):
+        # not on the first page of the changelist
+        TestModel.objects.create(unique=5)
+        a = TestModel.objects.create(unique=1)
+        b = TestModel.objects.create(unique=2)
+        response = self.client.post('/admin/testapp/testmodel/', self.changelist_data([
+            { 'id': b.pk, 'unique': 5 },
+            { 'id': a.pk, 'unique': 10 },
+        ]))
+        self.assertEqual(200, response.status_code)
+        formset = response.context['cl'].formset
+        errors = dict((form.instance.pk, form.errors) for form in formset.forms)
+        self.assertEqual({ 'unique': ['Test model with this Unique already exists.'] }, errors[b.pk])
+        self.assertEqual({}, errors[a.pk])
+        self.assertEqual([], list(response.context['messages']))
+        self.assertEqual([1, 2, 5], sorted(TestModel.objects.values_list('unique', flat=True)))
+
+    def test_action(self):
+        a = TestModel.objects.create(unique=1)
+        b = TestModel.objects.create(unique=2)
+        response = self.client.post('/admin/testapp/testmodel/', {
+            'action': 'make_all_one',
+            '_selected_action': [a.pk, b.pk],
+        }, follow=True)
+        self.assertEqual(1, len(list(response.context['messages'])))
+        self.assertEqual([1, 2], sorted(TestModel.objects.values_list('unique', flat=True)))
+
+    def test_patch_admin(self):
+        site = django_admin.AdminSite(name='patched')
+        site.register(TestParentModel)
+        admin.patch_admin(site)
+        site.register(TestTogetherModel, django_admin.ModelAdmin)
+        for model_admin in site._registry.values():
+            self.assertTrue(isinstance(model_admin, admin.TransactionalModelAdminMixin))
 
 
 class TestViews(TransactionTestCase):
@@ -284,10 +2294,70 @@ class TestViews(TransactionTestCase):
     def test_create_override_conversion(self):
         class _CreateView(TransactionalCreateView):
             def validationerror_from_integrityerror(self, ierror):
-                return django.forms.ValidationError(smart_text('poop'))
+                return django.forms.ValidationError(smart_str('poop'))
         first, second = self._test_create(TestForm, _CreateView)
         self.assertTrue(smart_bytes('poop') in first.response.content)
 
+    def test_form_view(self):
+        class _FormView(TransactionalModelFormMixin, FormView):
+            form_class = TransactionalTestForm
+            success_url = '/'
+            template_name = 'testapp/testmodel_form.html'
+
+        response = _FormView.as_view()(self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, TestModel.objects.count())
+        response = _FormView.as_view(trust_database=True)(self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['Test model with this Unique already exists.'], response.context_data['form'].errors['unique'])
+
+    def test_create_ignoring_conflicts(self):
+        class _CreateView(TransactionalCreateView):
+            model = TestModel
+            form_class = TransactionalTestForm
+            success_url = '/'
+            trust_database = True
+            insert_ignoring_conflicts = True
+
+        view = _CreateView.as_view()
+        response = view(self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(302, response.status_code)
+
+        with self.assertNumQueries(2 + TRANSACTION_QUERIES):
+            # the INSERT that does nothing, and finding the existing row
+            response = view(self.factory.post("/", { 'unique': '1' }))
+            response.render()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(smart_bytes('Test model with this Unique already exists.') in response.content)
+        self.assertEqual(1, TestModel.objects.count())
+
+    def test_create_returning_existing(self):
+        class _CreateView(TransactionalCreateView):
+            model = TestModel
+            form_class = TestForm
+            insert_ignoring_conflicts = True
+            return_existing = True
+
+            def get_success_url(self):
+                return '/%s/' % self.object.pk
+
+        class InnerTestForm(TestForm):
+            def validate_unique(self):
+                pass
+
+        view = _CreateView.as_view(form_class=InnerTestForm)
+        response = view(self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(302, response.status_code)
+        tm = TestModel.objects.get()
+        self.assertEqual('/%s/' % tm.pk, response['Location'])
+
+        with self.assertNumQueries(2 + TRANSACTION_QUERIES):
+            # the INSERT that does nothing, and finding the existing row
+            response = view(self.factory.post("/", { 'unique': '1' }))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('/%s/' % tm.pk, response['Location'])
+        self.assertEqual(1, TestModel.objects.count())
+
     def _test_create(self, base_form, create_view=TransactionalCreateView):
         self.assertEqual(0, TestModel.objects.count())
 
@@ -348,7 +2418,7 @@ class TestViews(TransactionTestCase):
     def test_update_override_conversion(self):
         class _UpdateView(TransactionalUpdateView):
             def validationerror_from_integrityerror(self, ierror):
-                return django.forms.ValidationError(smart_text('poop'))
+                return django.forms.ValidationError(smart_str('poop'))
         first, second = self._test_update(TestForm, _UpdateView)
         self.assertTrue(smart_bytes('poop') in first.response.content)
 
@@ -1,28 +1,407 @@
+import json
+import uuid
+
 import django.forms
-from django.views.generic.edit import CreateView as _CreateView, UpdateView as _UpdateView
+from django.db import router, transaction, IntegrityError, OperationalError
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
+from django.utils.encoding import force_str
+from django.utils.translation import gettext_lazy as _
+from django.views.generic import View
+from django.views.generic.edit import CreateView as _CreateView, UpdateView as _UpdateView, ModelFormMixin
+
+from . import backends, signals
+from .forms import (
+    TransactionalMixin, add_validationerror_to_form, transactional_save, trust_database_form,
+    validationerror_from_integrityerror, validationerror_from_operationalerror,
+)
+from .formsets import INSERT, Row, bisect_failures
+from .insert import insert_form, insert_ignoring_conflicts
+from .models import IdempotencyKey
+from .optimistic import add_version_field, versioned_save
+from .retry import monotonic
+
+
+def _prepare(form):
+    # for saves that bypass .tsave(), which would have called it
+    return form.prepare if isinstance(form, TransactionalMixin) else None
+
 
-from .forms import transactional_save
+def _concrete_values(obj):
+    return dict((field.attname, getattr(obj, field.attname)) for field in obj._meta.concrete_fields)
+
+
+class _Repeated(Exception):
+    def __init__(self, previous):
+        super(_Repeated, self).__init__()
+        self.previous = previous
 
 
 class TransactionalModelFormMixin(object):
+    # skip Django's uniqueness queries during validation, and let the
+    # database be the only check (see TransactionalMixin)
+    trust_database = False
+    # a retry.RetryPolicy for contention (see transactional_save)
+    tsave_retry = None
+    # take advisory locks on the unique values before saving, waiting at
+    # most this many seconds (see transactional_save)
+    tsave_advisory_lock = False
+    tsave_advisory_lock_timeout = None
+    # seconds a statement in the save may wait for a lock, or run for,
+    # before the form gets a "please try again" error
+    tsave_lock_timeout = None
+    tsave_statement_timeout = None
+    # a conflicts.ConflictCache (or True for the default one), so that
+    # repeats of a duplicate that just failed get the same error without
+    # a transaction (see transactional_save)
+    tsave_conflict_cache = None
+    # absorb repeated submissions (double clicks, client retries) carrying
+    # the same idempotency key, from the Idempotency-Key header or the
+    # idempotency_key field: the key is recorded in the same transaction
+    # as the save, and repeats are redirected to wherever the first went,
+    # without saving again (see models.IdempotencyKey)
+    idempotency_keys = False
+    idempotency_key_header = 'HTTP_IDEMPOTENCY_KEY'
+    idempotency_key_field = 'idempotency_key'
+
     def validationerror_from_integrityerror(self, ierror):
         return None
 
+    def get_idempotency_key(self):
+        """The digested idempotency key for this request, or None."""
+        key = (
+            self.request.META.get(self.idempotency_key_header) or
+            self.request.POST.get(self.idempotency_key_field)
+        )
+        if not key:
+            return None
+        scope = [type(self).__module__, type(self).__name__]
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated:
+            # so users can't see where each other's submissions went
+            scope.append(force_str(user.pk))
+        return IdempotencyKey.digest(scope, key)
+
+    def get_context_data(self, **kwargs):
+        if self.idempotency_keys and 'idempotency_key' not in kwargs:
+            # for the form's hidden field: the one submitted, if we're
+            # showing errors, or a new one
+            kwargs['idempotency_key'] = (
+                self.request.POST.get(self.idempotency_key_field) or uuid.uuid4().hex
+            )
+        return super(TransactionalModelFormMixin, self).get_context_data(**kwargs)
+
+    def idempotent_response(self, previous):
+        """The response to a repeat of a submission we've saved."""
+        return HttpResponseRedirect(previous.location)
+
+    def post(self, request, *args, **kwargs):
+        self.idempotency_key = None
+        if self.idempotency_keys:
+            self.idempotency_key = self.get_idempotency_key()
+            if self.idempotency_key is not None:
+                # the usual case for a repeat; racing ones are caught
+                # when we record the key
+                using = router.db_for_write(self.get_form_class()._meta.model)
+                for previous in IdempotencyKey.objects.using(using).filter(key=self.idempotency_key):
+                    return self.idempotent_response(previous)
+        return super(TransactionalModelFormMixin, self).post(request, *args, **kwargs)
+
+    def get_form_class(self):
+        form_class = super(TransactionalModelFormMixin, self).get_form_class()
+        if self.trust_database:
+            form_class = trust_database_form(form_class)
+        return form_class
+
+    def get_tsave_kwargs(self):
+        # only what's been set, so that a form's own tsave() needn't
+        # take everything transactional_save() does
+        kwargs = {}
+        if self.tsave_retry is not None:
+            kwargs['retry'] = self.tsave_retry
+        if self.tsave_advisory_lock:
+            kwargs['advisory_lock'] = True
+            kwargs['advisory_lock_timeout'] = self.tsave_advisory_lock_timeout
+        if self.tsave_lock_timeout is not None:
+            kwargs['lock_timeout'] = self.tsave_lock_timeout
+        if self.tsave_statement_timeout is not None:
+            kwargs['statement_timeout'] = self.tsave_statement_timeout
+        if self.tsave_conflict_cache is not None:
+            kwargs['conflict_cache'] = self.tsave_conflict_cache
+        return kwargs
+
+    def save_form(self, form, convertors):
+        if hasattr(form, "tsave"):
+            return form.tsave(convertors, **self.get_tsave_kwargs())
+        return transactional_save(form, convertors, **self.get_tsave_kwargs())
+
+    def save_form_once(self, form, convertors, key):
+        # Claim the key first, so a racing repeat waits on our row in
+        # the unique index and then sees it, rather than saving too.
+        # This puts the save in our transaction, so it's run in a
+        # savepoint (and can't be retried).
+        # where the save will be, since we need to share its transaction
+        using = router.db_for_write(type(form.instance), instance=form.instance)
+        with transaction.atomic(using=using):
+            record = IdempotencyKey(key=key)
+            if not insert_ignoring_conflicts(record, using):
+                raise _Repeated(IdempotencyKey.objects.using(using).get(key=key))
+            self.object = self.save_form(form, convertors)
+            record.object_pk = force_str(self.object.pk)
+            record.location = self.get_success_url()
+            record.save(using=using, update_fields=['object_pk', 'location'])
+        return self.object
+
     def form_valid(self, form):
+        started = monotonic()
+        outcome = signals.RERAISED
         try:
             convertors = [ lambda i: self.validationerror_from_integrityerror(i) ]
-            if hasattr(form, "tsave"):
-                self.object = form.tsave(convertors)
+            key = getattr(self, 'idempotency_key', None)
+            if key is None:
+                self.object = self.save_form(form, convertors)
             else:
-                self.object = transactional_save(form, convertors)
+                self.object = self.save_form_once(form, convertors, key)
+            outcome = signals.COMMITTED
+            if isinstance(self, ModelFormMixin):
+                # skip ModelFormMixin.form_valid(), which would save
+                # again (outside our transaction)
+                return super(ModelFormMixin, self).form_valid(form)
             return super(TransactionalModelFormMixin, self).form_valid(form)
+        except _Repeated as e:
+            outcome = signals.REPEATED
+            return self.idempotent_response(e.previous)
         except django.forms.ValidationError:
+            outcome = signals.CONVERTED
             return self.form_invalid(form)
+        finally:
+            signals.transactional_form_valid_finished.send(
+                sender=type(self), view=self, form=form, outcome=outcome,
+                time=monotonic() - started,
+            )
 
 
 class CreateView(TransactionalModelFormMixin, _CreateView):
-    pass
+    # INSERT ... ON CONFLICT DO NOTHING (or INSERT IGNORE) rather than
+    # letting a unique constraint fail the INSERT; a conflict gives the
+    # same form error. Note this bypasses any .tsave() on the form.
+    insert_ignoring_conflicts = False
+    # with insert_ignoring_conflicts, treat a conflict as success with
+    # the existing row as self.object (for idempotent creates)
+    return_existing = False
+
+    def save_form(self, form, convertors):
+        if not self.insert_ignoring_conflicts:
+            return super(CreateView, self).save_form(form, convertors)
+        # so that the conflict is looked for inside the transaction
+        using = router.db_for_write(type(form.instance), instance=form.instance)
+        return transactional_save(
+            form, convertors,
+            save=lambda: insert_form(form, self.return_existing, using),
+            prepare=_prepare(form),
+            using=using,
+            **self.get_tsave_kwargs()
+        )
+
+
+UNAVAILABLE_MESSAGE = _(
+    'This %(model_name)s is being changed by someone else, or no longer '
+    'exists, and your changes were not saved.'
+)
 
 
 class UpdateView(TransactionalModelFormMixin, _UpdateView):
+    # the name of an integer or datetime field on the model, to save with
+    # an UPDATE conditional on it not having changed since the form was
+    # rendered (see optimistic.py). Note this bypasses any .tsave() on
+    # the form.
+    version_field = None
+    # lock the object's row with SELECT ... FOR UPDATE (through
+    # get_queryset(), so it must still match) inside the save's
+    # transaction, before saving. With select_for_update_nowait, a row
+    # someone else has locked gives the form a "please try again" error
+    # at once, rather than waiting; with select_for_update_skip_locked
+    # it's as if the row had gone, which suits queue-style editors where
+    # someone else is working on it. Also bypasses .tsave().
+    select_for_update = False
+    select_for_update_nowait = False
+    select_for_update_skip_locked = False
+
+    def get_form(self, form_class=None):
+        form = super(UpdateView, self).get_form(form_class)
+        if self.version_field is not None:
+            add_version_field(form, self.version_field)
+        if self.select_for_update:
+            # what get_object() read, so that save_object() can tell what
+            # validation has changed since
+            self.loaded_values = _concrete_values(form.instance)
+        return form
+
+    def save_form(self, form, convertors):
+        if self.version_field is None and not self.select_for_update:
+            return super(UpdateView, self).save_form(form, convertors)
+        return transactional_save(
+            form, convertors,
+            save=lambda: self.save_object(form),
+            prepare=_prepare(form),
+            **self.get_tsave_kwargs()
+        )
+
+    def save_object(self, form):
+        # inside transactional_save()'s atomic block
+        if self.select_for_update:
+            # get_object() read the row before the transaction, without a
+            # lock, so lock it now and take anyone else's changes since to
+            # the fields that neither the form nor validation (such as
+            # Model.clean()) has set
+            obj = form.instance
+            locked = self.lock_object(obj)
+            loaded = getattr(self, 'loaded_values', {})
+            for field in obj._meta.concrete_fields:
+                if field.primary_key or field.name in form.fields:
+                    continue
+                if field.attname in loaded and getattr(obj, field.attname) != loaded[field.attname]:
+                    continue
+                setattr(obj, field.attname, getattr(locked, field.attname))
+        if self.version_field is not None:
+            return versioned_save(form, self.version_field)
+        return form.save()
+
+    def lock_object(self, obj):
+        """
+        Fetch obj's row again with SELECT ... FOR UPDATE (on the
+        connection the save's transaction is on), and return it.
+        """
+        using = router.db_for_write(type(obj), instance=obj)
+        lock_kwargs = {}
+        if self.select_for_update_nowait:
+            lock_kwargs['nowait'] = True
+        if self.select_for_update_skip_locked:
+            # only from Django 1.11
+            lock_kwargs['skip_locked'] = True
+        queryset = self.get_queryset().using(using).select_for_update(**lock_kwargs)
+        try:
+            # without joins, so we don't lock any related rows
+            locked = list(queryset.select_related(None).filter(pk=obj.pk))
+        except OperationalError as e:
+            info = backends.decode(e, using)
+            if info is None or info.kind != backends.LOCKED or self.tsave_retry is not None:
+                # a retry policy gets to try again
+                raise
+            raise validationerror_from_operationalerror(e)
+        if not locked:
+            raise django.forms.ValidationError(
+                UNAVAILABLE_MESSAGE,
+                code='unavailable',
+                params={'model_name': obj._meta.verbose_name},
+            )
+        return locked[0]
+
+
+class _NotAllCreated(Exception):
     pass
+
+
+class TransactionalBulkCreateView(TransactionalModelFormMixin, ModelFormMixin, View):
+    """
+    POST a JSON array of objects, each validated with the model form,
+    and create them in one transaction with bulk_create. Responds with a
+    result per item: its id, or its errors (including those converted
+    from IntegrityErrors, found by bisecting as for formsets).
+    """
+    http_method_names = ['post', 'options']
+    # rows per INSERT
+    batch_size = 500
+    # refuse bigger requests than this
+    max_items = 10000
+    # by default one bad item means nothing is created; set this to
+    # create all the items that can be
+    partial = False
+    # see formsets.transactional_formset_save
+    tsave_check_constraints = False
+
+    def get_items(self):
+        try:
+            items = json.loads(force_str(self.request.body))
+        except ValueError:
+            return None
+        if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+            return None
+        return items
+
+    def get_item_form(self, item):
+        return self.get_form_class()(data=item)
+
+    def post(self, request, *args, **kwargs):
+        self.object = None
+        items = self.get_items()
+        if items is None:
+            return HttpResponseBadRequest('Expected a JSON array of objects.')
+        if len(items) > self.max_items:
+            return HttpResponseBadRequest('Too many items (at most %d).' % self.max_items)
+        forms = [self.get_item_form(item) for item in items]
+        valid = [form for form in forms if form.is_valid()]
+        if len(valid) < len(forms) and not self.partial:
+            return self.items_response(forms, created=())
+        return self.items_response(forms, self.create(valid))
+
+    def create(self, forms):
+        """Create the objects for valid forms, returning those created."""
+        if not forms:
+            return []
+        rows = [Row(form, form.save(commit=False), INSERT) for form in forms]
+        using = router.db_for_write(self.get_form_class()._meta.model)
+        convertors = [ lambda i: self.validationerror_from_integrityerror(i) ]
+        failures = []
+        try:
+            with transaction.atomic(using=using):
+                failures = bisect_failures(rows, using, self.batch_size, self.tsave_check_constraints)
+                if failures and not self.partial:
+                    raise _NotAllCreated()
+                failed = set(id(row) for row, ierror in failures)
+                created = [row.form for row in rows if id(row) not in failed]
+                for form in created:
+                    form.save_m2m()
+        except _NotAllCreated:
+            for row in rows:
+                row.restore()
+            created = []
+        except IntegrityError as e:
+            # from the commit (a deferred constraint we didn't check), so
+            # we can't tell which item it was, and nothing was created
+            for row in rows:
+                row.restore()
+            v = validationerror_from_integrityerror(e, convertors)
+            for row in rows:
+                add_validationerror_to_form(row.form, django.forms.ValidationError(v.messages))
+            return []
+        for row, ierror in failures:
+            add_validationerror_to_form(
+                row.form,
+                validationerror_from_integrityerror(ierror, convertors, row.instance, using),
+            )
+        return created
+
+    def item_result(self, form, created):
+        if created:
+            return {'status': 'created', 'id': form.instance.pk}
+        elif form.errors:
+            return {
+                'status': 'invalid',
+                'errors': dict(
+                    (field, [force_str(m) for m in messages])
+                    for field, messages in form.errors.items()
+                ),
+            }
+        # valid, but not created because another item wasn't
+        return {'status': 'not_created'}
+
+    def items_response(self, forms, created):
+        created = set(id(form) for form in created)
+        results = [self.item_result(form, id(form) in created) for form in forms]
+        if len(created) == len(forms):
+            status = 201
+        elif self.partial and created:
+            status = 207
+        else:
+            status = 400
+        return JsonResponse({'results': results}, status=status)
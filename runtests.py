@@ -29,22 +29,47 @@ DATABASES = {
     #},
 }
 
+def other_database(db):
+    # a second database, for testing routing
+    return dict(DATABASES[db], NAME=DATABASES[db]['NAME'] + '_other')
+
+
 settings.configure(
     DEBUG=True,
+    SECRET_KEY='django_database_constraints',
     INSTALLED_APPS = [
+        'django.contrib.admin',
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.messages',
+        'django.contrib.sessions',
         'django_database_constraints',
+        # the models for the tests
+        'testapp',
+    ],
+    MIDDLEWARE = [
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
     ],
     DATABASES = {
         'default': DATABASES['postgresql'],
+        'other': other_database('postgresql'),
     },
     CONTEXT_PROCESSORS=[],
+    # as startproject sets it
+    DEFAULT_AUTO_FIELD='django.db.models.BigAutoField',
     TEMPLATES = [
         {
             'BACKEND': 'django.template.backends.django.DjangoTemplates',
             'DIRS': [],
             'APP_DIRS': True,
             'OPTIONS': {
-                'context_processors': [],
+                'context_processors': [
+                    'django.template.context_processors.request',
+                    'django.contrib.auth.context_processors.auth',
+                    'django.contrib.messages.context_processors.messages',
+                ],
             }
         },
     ]
@@ -57,7 +82,7 @@ from django.test.utils import override_settings
 
 
 def run_against(db):
-    @override_settings(DATABASES = { 'default': DATABASES[db] })
+    @override_settings(DATABASES = { 'default': DATABASES[db], 'other': other_database(db) })
     def run_tests():
         print("Running tests against %s database." % db)
 
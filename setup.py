@@ -12,19 +12,29 @@ setup(
     description="Django library for more easily working with transactions and constraints in Forms, ModelForms and the Views that use them.",
     packages=[
         'django_database_constraints',
+        'django_database_constraints.management',
+        'django_database_constraints.management.commands',
+        'django_database_constraints.migrations',
     ],
     license='MIT',
     author='James Aylett',
     author_email='james@tartarus.org',
     install_requires=[
-        'Django>=1.10.3',
+        'Django>=3.2,<6.0',
     ],
     url = 'https://github.com/jaylett/django-database-constraints',
     classifiers = [
         'Intended Audience :: Developers',
         'Framework :: Django',
+        'Framework :: Django :: 3.2',
+        'Framework :: Django :: 4.0',
+        'Framework :: Django :: 4.1',
+        'Framework :: Django :: 4.2',
+        'Framework :: Django :: 5.0',
+        'Framework :: Django :: 5.1',
+        'Framework :: Django :: 5.2',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 )
@@ -0,0 +1,77 @@
+"""Models for the tests in django_database_constraints.tests."""
+from django.db import models
+
+from django_database_constraints.models import TransactionalManager, TransactionalModelMixin
+
+
+class TestModel(models.Model):
+    unique = models.IntegerField(unique=True)
+
+
+class TestParentModel(models.Model):
+    pass
+
+
+class TestTogetherModel(models.Model):
+    parent = models.ForeignKey(TestParentModel, on_delete=models.CASCADE)
+    order = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [('parent', 'order')]
+
+
+if hasattr(models, 'Deferrable'):
+    # Django 3.1+
+    class TestOrderModel(models.Model):
+        order = models.IntegerField()
+
+        class Meta:
+            constraints = [
+                models.UniqueConstraint(
+                    fields=['order'], name='test_order_unique',
+                    deferrable=models.Deferrable.IMMEDIATE,
+                ),
+            ]
+
+
+class TestVersionedModel(models.Model):
+    unique = models.IntegerField(unique=True)
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+
+class TestSluggedModel(models.Model):
+    title = models.CharField(max_length=20)
+    slug = models.CharField(max_length=20)
+    note = models.CharField(max_length=20, default='')
+
+    def clean(self):
+        self.slug = self.title.lower()
+
+
+class TestTransactionalModel(TransactionalModelMixin, models.Model):
+    unique = models.IntegerField(unique=True)
+    name = models.CharField(max_length=10, default='')
+
+    objects = TransactionalManager()
+
+
+class TestAuditModel(models.Model):
+    date = models.DateField()
+    slug = models.CharField(max_length=10, unique_for_date='date')
+    parent = models.ForeignKey(TestParentModel, on_delete=models.CASCADE, db_constraint=False)
+
+    def clean(self):
+        pass
+
+
+class TestArgumentsModel(models.Model):
+    """A model that can't be instantiated without arguments."""
+    code = models.CharField(max_length=10, unique=True)
+
+    class Meta:
+        managed = False
+
+    def __init__(self, tenant, *args, **kwargs):
+        super(TestArgumentsModel, self).__init__(*args, **kwargs)
+        self.tenant = tenant